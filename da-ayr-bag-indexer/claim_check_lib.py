@@ -0,0 +1 @@
+../lib/claim_check_lib.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lib/index_shard_lib.py
\ No newline at end of file
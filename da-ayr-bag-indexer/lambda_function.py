@@ -1,5 +1,9 @@
-import boto3
+import os
+import claim_check_lib
+import client_lib
+import index_shard_lib
 import s3_bag_reader
+import tar_bag_reader
 
 
 class AYRBagIndexerError(Exception):
@@ -12,9 +16,24 @@ KEY_S3_BUCKET = 's3_bucket'
 KEY_BAG_NAME = 'bag_name'
 KEY_BAG_OUTPUT_S3_PATH = 'bag_output_s3_path'
 KEY_UNPACKED_FILES = 'unpacked_files'
+KEY_BAG_DATA = 'bag_data'
+KEY_INDEX_ACTION = 'index_action'
+KEY_SHARDS = 'shards'
+KEY_SHARD = 'shard'
+KEY_SHARD_RESULTS = 'shard_results'
+ACTION_PLAN = 'plan'
+ACTION_SHARD = 'shard'
+ACTION_MERGE = 'merge'
 BAG_FILE_INFO = 'bag-info'
-
-s3 = boto3.client('s3')
+READ_MAX_WORKERS = int(os.getenv('AYR_INDEX_READ_MAX_WORKERS', default=s3_bag_reader.READ_MAX_WORKERS))
+READ_MAX_IN_FLIGHT_BYTES = int(os.getenv(
+    'AYR_INDEX_READ_MAX_IN_FLIGHT_BYTES', default=s3_bag_reader.READ_MAX_IN_FLIGHT_BYTES))
+SUB_FILE_MAX_BYTES = int(os.getenv('AYR_INDEX_SUB_FILE_MAX_BYTES', default=s3_bag_reader.SUB_FILE_MAX_BYTES))
+SUB_FILES_MAX_BYTES = int(os.getenv('AYR_INDEX_SUB_FILES_MAX_BYTES', default=s3_bag_reader.SUB_FILES_MAX_BYTES))
+SUB_FILE_OVERFLOW = os.getenv('AYR_INDEX_SUB_FILE_OVERFLOW', default=s3_bag_reader.SUB_FILE_OVERFLOW_TRUNCATE)
+SUB_FILE_DECODE_ERRORS = os.getenv('AYR_INDEX_SUB_FILE_DECODE_ERRORS', default=s3_bag_reader.SUB_FILE_DECODE_ERRORS)
+SHARD_MAX_SUB_FILES = int(os.getenv('AYR_INDEX_SHARD_MAX_SUB_FILES', default=index_shard_lib.SHARD_MAX_SUB_FILES))
+SHARD_MAX_CSV_BYTES = int(os.getenv('AYR_INDEX_SHARD_MAX_CSV_BYTES', default=index_shard_lib.SHARD_MAX_CSV_BYTES))
 
 
 def validate_event(event):
@@ -29,8 +48,15 @@ def validate_event(event):
         raise AYRBagIndexerError(f'Key "{KEY_BAG_NAME} not found"')
     if KEY_BAG_OUTPUT_S3_PATH not in event:
         raise AYRBagIndexerError(f'Key "{KEY_BAG_OUTPUT_S3_PATH} not found"')
-    if KEY_UNPACKED_FILES not in event:
+    action = event.get(KEY_INDEX_ACTION)
+    if action not in (None, ACTION_PLAN, ACTION_SHARD, ACTION_MERGE):
+        raise AYRBagIndexerError(f'Unknown {KEY_INDEX_ACTION} "{action}"')
+    if action in (ACTION_PLAN, ACTION_SHARD) and KEY_UNPACKED_FILES not in event:
         raise AYRBagIndexerError(f'Key "{KEY_UNPACKED_FILES} not found"')
+    if action == ACTION_SHARD and KEY_SHARD not in event:
+        raise AYRBagIndexerError(f'Key "{KEY_SHARD} not found"')
+    if action == ACTION_MERGE and KEY_SHARD_RESULTS not in event:
+        raise AYRBagIndexerError(f'Key "{KEY_SHARD_RESULTS} not found"')
 
 
 def lambda_handler(event, context):
@@ -46,7 +72,9 @@ def lambda_handler(event, context):
             'bag_sub_files' [
                 {
                     'object': 'ayr-in/TDR-2022-D6WD.tar.gz/TDR-2022-D6WD/data/content/file-c1.txt',
-                    'data': 'dummy data in sample for file-c1.txt'
+                    'data': 'dummy data in sample for file-c1.txt',
+                    'size': 36,
+                    'truncated': False
                 },
                 ...
             ]
@@ -72,6 +100,20 @@ def lambda_handler(event, context):
       ]
     }
 
+    If `unpacked_files` is omitted the bag is read straight from the tar at
+    `bag_output_s3_path` in one streaming pass (`TarBagReader`), so it need
+    not have been unpacked; the output is the same.
+
+    Large bags can instead be indexed in parallel shards (see
+    `index_shard_lib`), with optional `index_action` set to:
+
+    * "plan": return the event with a list of `shards` added
+    * "shard": index the event's `shard` and return its partial result
+    * "merge": merge the event's `shard_results` and return the record above
+
+    `unpacked_files`, `bag_data` and each shard result's `data` may be
+    passed by claim check (see `claim_check_lib`).
+
     :param event: AWS Lambda event
     :param context: AWS Lambda context
     :return: AWS Lambda response
@@ -80,38 +122,79 @@ def lambda_handler(event, context):
     print(f'context:\n{context}')
     validate_event(event)
     print('event validated')
+    if event.get(KEY_INDEX_ACTION) != ACTION_MERGE:
+        event = claim_check_lib.resolve(event, [KEY_UNPACKED_FILES])
     s3_bucket = event[KEY_S3_BUCKET]
     print(f's3_bucket={s3_bucket}')
     bag_name = event[KEY_BAG_NAME]
     print(f'bag_name={bag_name}')
     bag_output_s3_path = event[KEY_BAG_OUTPUT_S3_PATH]
     print(f'bag_output_s3_path={bag_output_s3_path}')
-    unpacked_file_list = event[KEY_UNPACKED_FILES]
     bag_s3_url = f's3://{s3_bucket}/{bag_output_s3_path}'
     print(f'bag_s3_url={bag_s3_url}')
     bag_unpack_folder = bag_name.removesuffix('.tar.gz')
     path_prefix = bag_output_s3_path + '/' + bag_unpack_folder + '/'
-
-    bag = s3_bag_reader.S3BagReader(
-        s3_bucket=s3_bucket,
-        file_list=unpacked_file_list,
-        path_prefix=path_prefix
-    )
-
-    bag_data = {}
-    bag_data.update(bag.get_bag_info_txt_as_dict())
-    bag_data.update(bag.get_bagit_txt_as_dict())
-    bag_data.update(bag.get_file_av_csv_as_dict())
-    bag_data.update(bag.get_file_ffid_csv_as_dict())
-    bag_data.update(bag.get_file_metadata_csv_as_dict())
-    bag_data.update(bag.get_manifest_sha256_as_dict())
-    bag_data.update(bag.get_tagmanifest_sha256_as_dict())
-    bag_data.update(bag.get_sub_files_dict())
+    action = event.get(KEY_INDEX_ACTION)
+    print(f'action={action}')
+
+    if action == ACTION_MERGE:
+        bag = None
+    elif KEY_UNPACKED_FILES in event:
+        bag = s3_bag_reader.S3BagReader(
+            s3_bucket=s3_bucket,
+            file_list=event[KEY_UNPACKED_FILES],
+            path_prefix=path_prefix
+        )
+    else:
+        print(f'No {KEY_UNPACKED_FILES}; reading bag from tar {bag_output_s3_path}')
+        bag = tar_bag_reader.TarBagReader(
+            s3_bucket=s3_bucket,
+            object_name=bag_output_s3_path,
+            output_prefix=bag_output_s3_path + '/',
+            max_file_bytes=SUB_FILE_MAX_BYTES,
+            max_total_bytes=SUB_FILES_MAX_BYTES,
+            overflow=SUB_FILE_OVERFLOW
+        )
+
+    if action == ACTION_PLAN:
+        shards = index_shard_lib.plan_shards(
+            bag,
+            max_sub_files=SHARD_MAX_SUB_FILES,
+            max_csv_bytes=SHARD_MAX_CSV_BYTES,
+            max_file_bytes=SUB_FILE_MAX_BYTES,
+            max_total_bytes=SUB_FILES_MAX_BYTES,
+            overflow=SUB_FILE_OVERFLOW,
+            errors=SUB_FILE_DECODE_ERRORS
+        )
+        print(f'{len(shards)} shard(s) planned')
+        return claim_check_lib.check_in({**event, KEY_SHARDS: shards}, [KEY_UNPACKED_FILES])
+
+    if action == ACTION_SHARD:
+        shard_result = index_shard_lib.process_shard(bag, event[KEY_SHARD])
+        print(f'client_stats={client_lib.get_client_stats()}')
+        return claim_check_lib.check_in(shard_result, [index_shard_lib.KEY_DATA])
+
+    if action == ACTION_MERGE:
+        shard_results = [
+            claim_check_lib.resolve(shard_result, [index_shard_lib.KEY_DATA])
+            for shard_result in event[KEY_SHARD_RESULTS]]
+        bag_data = index_shard_lib.merge_shard_results(shard_results)
+    else:
+        bag_data = bag.read_all(
+            max_workers=READ_MAX_WORKERS,
+            max_in_flight_bytes=READ_MAX_IN_FLIGHT_BYTES,
+            max_file_bytes=SUB_FILE_MAX_BYTES,
+            max_total_bytes=SUB_FILES_MAX_BYTES,
+            overflow=SUB_FILE_OVERFLOW,
+            errors=SUB_FILE_DECODE_ERRORS
+        )
 
     opensearch_record = {
         'ayr_role': None,
         'bag_s3_url': bag_s3_url,
-        'bag_data': bag_data
+        KEY_BAG_DATA: bag_data
     }
 
+    opensearch_record = claim_check_lib.check_in(opensearch_record, [KEY_BAG_DATA])
+    print(f'client_stats={client_lib.get_client_stats()}')
     return opensearch_record
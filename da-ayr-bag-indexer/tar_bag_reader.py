@@ -0,0 +1 @@
+../lib/tar_bag_reader.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lib/tar_lib.py
\ No newline at end of file
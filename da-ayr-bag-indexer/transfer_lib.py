@@ -0,0 +1 @@
+../lib/transfer_lib.py
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import client_lib
 import object_lib
 from urllib.parse import urlparse
 
@@ -13,9 +14,22 @@ S3_OUTPUT_BUCKET = os.getenv('AYR_TARGET_S3_BUCKET')
 if not S3_OUTPUT_BUCKET:
     raise AYRBagReceiverError('AYR_TARGET_S3_BUCKET not set')
 S3_OUTPUT_PREFIX = os.getenv('AYR_TARGET_S3_OUTPUT_PREFIX', default='ayr-in/')
+TRANSFER_MAX_WORKERS = int(os.getenv(
+    'AYR_TRANSFER_MAX_WORKERS', default=object_lib.TRANSFER_MAX_WORKERS))
+TRANSFER_PART_SIZE = int(os.getenv(
+    'AYR_TRANSFER_PART_SIZE', default=object_lib.READ_BLOCK_SIZE))
+TRANSFER_MAX_IN_FLIGHT_BYTES = int(os.getenv(
+    'AYR_TRANSFER_MAX_IN_FLIGHT_BYTES', default=object_lib.TRANSFER_MAX_IN_FLIGHT_BYTES))
+TRANSFER_SERVER_SIDE_COPY = os.getenv('AYR_TRANSFER_SERVER_SIDE_COPY', default='TRUE') == 'TRUE'
+TRANSFER_CONDITIONAL_WRITE = os.getenv('AYR_TRANSFER_CONDITIONAL_WRITE', default='TRUE') == 'TRUE'
 
 print(f'S3_OUTPUT_BUCKET={S3_OUTPUT_BUCKET}')
 print(f'S3_OUTPUT_PREFIX={S3_OUTPUT_PREFIX}')
+print(f'TRANSFER_MAX_WORKERS={TRANSFER_MAX_WORKERS}')
+print(f'TRANSFER_PART_SIZE={TRANSFER_PART_SIZE}')
+print(f'TRANSFER_MAX_IN_FLIGHT_BYTES={TRANSFER_MAX_IN_FLIGHT_BYTES}')
+print(f'TRANSFER_SERVER_SIDE_COPY={TRANSFER_SERVER_SIDE_COPY}')
+print(f'TRANSFER_CONDITIONAL_WRITE={TRANSFER_CONDITIONAL_WRITE}')
 
 KEY_TRE_EVENT = 'dri-preingest-sip-available'
 KEY_BAG_URL = 'bag-url'
@@ -58,12 +72,37 @@ def lambda_handler(event, context):
     bag_output_s3_path = S3_OUTPUT_PREFIX + bag_name
     print(f'bag_output_s3_path={bag_output_s3_path}')
 
-    object_lib.url_to_s3_object(
-        source_url=bag_url,
-        target_bucket_name=S3_OUTPUT_BUCKET,
-        target_object_name=bag_output_s3_path,
-        allow_overwrite=False
-    )
+    ingest_marker = None
+    if TRANSFER_CONDITIONAL_WRITE:
+        # Duplicate deliveries of the same bag stop here, before any download
+        ingest_marker = object_lib.IngestMarker(S3_OUTPUT_BUCKET, bag_output_s3_path)
+        ingest_marker.acquire(source=bag_name)
+
+    try:
+        transfer_stats = object_lib.url_to_s3_object(
+            source_url=bag_url,
+            target_bucket_name=S3_OUTPUT_BUCKET,
+            target_object_name=bag_output_s3_path,
+            allow_overwrite=False,
+            max_workers=TRANSFER_MAX_WORKERS,
+            part_size=TRANSFER_PART_SIZE,
+            max_in_flight_bytes=TRANSFER_MAX_IN_FLIGHT_BYTES,
+            allow_server_side_copy=TRANSFER_SERVER_SIDE_COPY,
+            conditional_write=TRANSFER_CONDITIONAL_WRITE
+        )
+    except Exception as e:
+        if ingest_marker is not None:
+            ingest_marker.release()
+        raise e
+    if ingest_marker is not None:
+        try:
+            ingest_marker.complete()
+        except Exception as e:
+            # The bag is in place (and its conditional write refuses another
+            # copy); the marker has been released rather than left to expire
+            print(f'Unable to complete ingest marker: {e}')
+    print(f'transfer_stats={transfer_stats}')
+    print(f'client_stats={client_lib.get_client_stats()}')
 
     response = {
         's3_bucket': S3_OUTPUT_BUCKET,
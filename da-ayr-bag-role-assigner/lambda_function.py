@@ -1,6 +1,6 @@
 import os
-import boto3
-import json
+import claim_check_lib
+import role_map_lib
 
 
 class AYRBagRoleAssignerError(Exception):
@@ -15,34 +15,38 @@ ENV_AYR_ROLE_MAP_PARAM_STORE_KEY = 'AYR_ROLE_MAP_PARAM_STORE_KEY'
 KEY_AYR_ROLE = 'ayr_role'
 KEY_BAG_S3_URL = 'bag_s3_url'
 KEY_BAG_DATA = 'bag_data'
+KEY_RECORDS = 'records'
 
-KEY_ROLE_MAP_BAG_DEPARTMENT = 'bag_department'
-KEY_ROLE_MAP_AYR_ROLE = 'ayr_role'
+# Kept across warm invocations
+_env_role_map = None
+_role_map_cache = None
 
 
-def get_ayr_role_map_list() -> list:
+def get_ayr_role_map() -> role_map_lib.RoleMap:
     """
-    Gets AYR role map list from AWS ParameterStore; or, for local testing,
-    environment variable AYR_ROLE_MAP. The AWS ParameterStore key name is
-    loaded from environment variable AYR_ROLE_MAP_PARAM_STORE_KEY.
+    Gets the compiled AYR role map from AWS ParameterStore; or, for local
+    testing, environment variable AYR_ROLE_MAP. The AWS ParameterStore key
+    name is loaded from environment variable AYR_ROLE_MAP_PARAM_STORE_KEY.
 
-    :return: List of AYR department to role mappings.
+    The role map is compiled once and kept across warm invocations; the
+    Parameter Store value is only checked again after the role map's TTL
+    (env var AYR_ROLE_MAP_TTL_SECONDS) and only re-read if its version has
+    changed.
+
+    :return: Compiled AYR department to role mappings.
     """
-    try:
-        return json.loads(os.environ[ENV_AYR_ROLE_MAP])
-    except KeyError:
-        print(f'Environment variable "{ENV_AYR_ROLE_MAP}" not set')
-        print(f'Getting param store key from "{ENV_AYR_ROLE_MAP_PARAM_STORE_KEY}"')
-        param_store_key = os.environ[ENV_AYR_ROLE_MAP_PARAM_STORE_KEY]
-        print(f'param_store_key={param_store_key}')
-        client_ssm = boto3.client('ssm')
-        print('Calling client_ssm.get_parameter')
-        return json.loads(
-            client_ssm.get_parameter(
-                Name=param_store_key,
-                WithDecryption=True
-            )['Parameter']['Value']
-        )
+    global _env_role_map, _role_map_cache
+    role_map_json = os.environ.get(ENV_AYR_ROLE_MAP)
+    if role_map_json is not None:
+        if _env_role_map is None or _env_role_map.version != role_map_json:
+            _env_role_map = role_map_lib.RoleMap.from_json(role_map_json, version=role_map_json)
+        return _env_role_map
+
+    param_store_key = os.environ[ENV_AYR_ROLE_MAP_PARAM_STORE_KEY]
+    if _role_map_cache is None or _role_map_cache.param_store_key != param_store_key:
+        print(f'Environment variable "{ENV_AYR_ROLE_MAP}" not set; using param_store_key={param_store_key}')
+        _role_map_cache = role_map_lib.RoleMapCache(param_store_key)
+    return _role_map_cache.get()
 
 
 def validate_event(event):
@@ -59,23 +63,48 @@ def validate_event(event):
         raise AYRBagRoleAssignerError(f'Key "{KEY_BAG_DATA} not found"')
 
 
-def get_ayr_role(department: str) -> str:
-    print(f'get_ayr_role: department={department}')
-    role_map_list = get_ayr_role_map_list()
-    print(f'role_map_list:\n{role_map_list}')
-    for role_map in role_map_list:
-        bag_department = str(role_map[KEY_ROLE_MAP_BAG_DEPARTMENT]).strip()
-        if bag_department == department:
-            return str(role_map[KEY_ROLE_MAP_AYR_ROLE]).strip()
-
-    raise AYRBagRoleAssignerError(
-        f'Bag department "{department}" is not mapped to an AYR role; add '
-        f'a corresponding mapping record to parameter "'
-        f'{os.environ[ENV_AYR_ROLE_MAP_PARAM_STORE_KEY]}" in AWS Parameter '
+def get_unmapped_error(departments: list) -> AYRBagRoleAssignerError:
+    return AYRBagRoleAssignerError(
+        f'Bag department(s) {", ".join(f"{d!r}" for d in departments)} not mapped to an AYR role; add '
+        f'corresponding mapping record(s) to parameter "'
+        f'{os.getenv(ENV_AYR_ROLE_MAP_PARAM_STORE_KEY)}" in AWS Parameter '
         f'Store (or, if used, env var "{ENV_AYR_ROLE_MAP}")'
     )
 
 
+def get_ayr_role(department: str) -> str:
+    print(f'get_ayr_role: department={department}')
+    role = get_ayr_role_map().get_role(department)
+    if role is None:
+        raise get_unmapped_error([department])
+    return role
+
+
+def assign_ayr_roles(records: list) -> list:
+    """
+    Sets `ayr_role` in each of `records` (validated events, as for
+    `lambda_handler`) from one lookup of the role map. If any department is
+    unmapped an error naming every unmapped department is raised and no
+    records are returned.
+
+    :param records: List of records with (resolved) `bag_data`
+    :return: The updated `records`
+    """
+    role_map = get_ayr_role_map()
+    unmapped = []
+    for record in records:
+        department = record[KEY_BAG_DATA]['bag-info.txt']['Source-Organization']
+        role = role_map.get_role(department)
+        if role is None:
+            if department not in unmapped:
+                unmapped.append(department)
+        else:
+            record[KEY_AYR_ROLE] = role
+    if unmapped:
+        raise get_unmapped_error(unmapped)
+    return records
+
+
 def lambda_handler(event, context):
     """
     Sets the `ayr_role` key in the incoming `event` parameter according to the
@@ -112,17 +141,55 @@ def lambda_handler(event, context):
             "bag_department": "Testing A",
             "ayr_role": "department_a_role"
         },
+        {
+            "bag_department_pattern": "Testing [BC]",
+            "ayr_role": "department_bc_role"
+        },
         ...
     ]
 
+    Departments are matched exactly (ignoring surrounding whitespace) before
+    any `bag_department_pattern` regular expressions, which are tried in
+    list order (see `role_map_lib.RoleMap`).
+
+    `bag_data` may be passed by claim check (see `claim_check_lib`); if so
+    it is read from S3 and passed on with the same reference.
+
+    For batches, the event can instead hold a list of such records, each of
+    which is assigned its role from a single role map lookup:
+
+    {
+      "records": [
+        {"ayr_role": "...", "bag_s3_url": "...", "bag_data": {...}},
+        ...
+      ]
+    }
+
+    Each record's `bag_data` is checked in as for a single record; if the
+    batch is still over the claim check threshold the whole `records` list
+    is checked in as one reference (and such a reference is accepted as
+    input).
+
     :param event: AWS Lambda event
     :param context: AWS Lambda context
     :return: AWS Lambda response
     """
     print(f'--- event start {"-" * 64}\n{event}\n--- event end {"-" * 66}')
     print(f'--- context start {"-" * 62}\n{context}\n--- context end {"-" * 64}')
+    if KEY_RECORDS in event:
+        records = claim_check_lib.resolve(event, [KEY_RECORDS])[KEY_RECORDS]
+        for record in records:
+            validate_event(record)
+        records = [claim_check_lib.resolve(record, [KEY_BAG_DATA]) for record in records]
+        assign_ayr_roles(records)
+        print(f'Assigned roles to {len(records)} record(s)')
+        records = [claim_check_lib.check_in(record, [KEY_BAG_DATA]) for record in records]
+        # Records under the threshold can still add up to more than it
+        return claim_check_lib.check_in({KEY_RECORDS: records}, [KEY_RECORDS])
+
     validate_event(event)
+    event = claim_check_lib.resolve(event, [KEY_BAG_DATA])
     source_organization = event['bag_data']['bag-info.txt']['Source-Organization']
     print(f'source_organization={source_organization}')
     event['ayr_role'] = get_ayr_role(department=source_organization)
-    return event
+    return claim_check_lib.check_in(event, [KEY_BAG_DATA])
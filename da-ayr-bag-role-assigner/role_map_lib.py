@@ -0,0 +1 @@
+../lib/role_map_lib.py
\ No newline at end of file
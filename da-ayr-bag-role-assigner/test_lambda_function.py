@@ -1,7 +1,23 @@
+import copy
+import functools
+import io
 import unittest
+import unittest.mock
+import claim_check_lib
 import lambda_function
 
 
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+
 class TestLambdaAYRBagRoleAssigner(unittest.TestCase):
     test_event_1 = {
         "ayr_role": None,
@@ -32,3 +48,18 @@ class TestLambdaAYRBagRoleAssigner(unittest.TestCase):
         self.assertIn('bag_data', result)
         self.assertTrue(len(result) == 3)
         self.assertEqual(result['ayr_role'], 'department_a_role')
+
+    def test_batch_checked_in(self):
+        s3 = FakeS3Client()
+        records = [copy.deepcopy(self.test_event_1) for _ in range(20)]
+        event_size = len(claim_check_lib._serialise(records[0]))
+        check_in = functools.partial(
+            claim_check_lib.check_in, s3_bucket='b', threshold_bytes=4 * event_size, s3_client=s3)
+        with unittest.mock.patch.object(lambda_function.claim_check_lib, 'check_in', side_effect=check_in), \
+                unittest.mock.patch.object(claim_check_lib.client_lib, 'get_client', return_value=s3):
+            result = lambda_function.lambda_handler({'records': records}, None)
+            # Each record is under the threshold but the batch is not
+            self.assertTrue(claim_check_lib.is_reference(result['records']))
+            records = claim_check_lib.resolve(result, ['records'])['records']
+        self.assertEqual(len(records), 20)
+        self.assertEqual({record['ayr_role'] for record in records}, {'department_a_role'})
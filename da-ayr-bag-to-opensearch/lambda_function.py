@@ -1,7 +1,11 @@
 import os
-import boto3
-import requests
+import gzip
 import json
+import claim_check_lib
+import client_lib
+import opensearch_lib
+import param_cache_lib
+import row_lib
 
 
 class AYRBagToOpenSearchError(Exception):
@@ -21,6 +25,10 @@ ENV_OPENSEARCH_DEFAULT_INDEX = 'OPENSEARCH_DEFAULT_INDEX'
 KEY_AYR_ROLE = 'ayr_role'
 KEY_BAG_S3_URL = 'bag_s3_url'
 KEY_BAG_DATA = 'bag_data'
+KEY_RECORDS = 'records'
+KEY_RECORDS_S3 = 'records_s3'
+KEY_S3_BUCKET = 's3_bucket'
+KEY_S3_KEY = 's3_key'
 
 
 def check_verify_ssl_cert() -> bool:
@@ -50,7 +58,8 @@ def get_opensearch_user_password() -> str:
     Gets OpenSearch password from AWS ParameterStore; or, for local testing
     only, environment variable OPENSEARCH_USER_PASSWORD. The AWS
     ParameterStore key name is loaded from environment variable
-    OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY.
+    OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY. Parameter Store values are
+    cached across warm invocations (see `param_cache_lib`).
 
     :return: String containing OpenSearch password.
     """
@@ -61,12 +70,9 @@ def get_opensearch_user_password() -> str:
         print(f'Getting param store key from "{ENV_OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY}"')
         param_store_key = os.environ[ENV_OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY]
         print(f'param_store_key={param_store_key}')
-        client_ssm = boto3.client('ssm')
-        print('Calling client_ssm.get_parameter')
-        return client_ssm.get_parameter(
-            Name=param_store_key,
-            WithDecryption=True
-        )['Parameter']['Value']
+        password = param_cache_lib.get_value(param_store_key)
+        print(f'param_cache_lib stats: {param_cache_lib.get_stats()}')
+        return password
 
 
 def get_opensearch_url() -> str:
@@ -98,9 +104,38 @@ def validate_event(event):
         raise AYRBagToOpenSearchError(f'Key "{KEY_BAG_DATA} not found"')
 
 
+def iter_s3_ndjson_records(s3_bucket: str, s3_key: str):
+    """
+    Yield the records in S3 object `s3_key`, one JSON record per line;
+    objects with a `.gz` suffix are decompressed as they are read.
+    """
+    print(f'iter_s3_ndjson_records: s3://{s3_bucket}/{s3_key}')
+    body = client_lib.get_client('s3').get_object(Bucket=s3_bucket, Key=s3_key)['Body']
+    if s3_key.endswith('.gz'):
+        body = gzip.GzipFile(fileobj=body)
+    for line in row_lib.iter_byte_lines(body):
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_records(event):
+    """
+    Yield the records in `event`: the event itself, the records in its
+    `records` list (which may be passed by claim check), or those in the
+    NDJSON S3 objects in `records_s3`.
+    """
+    if KEY_RECORDS in event:
+        yield from claim_check_lib.resolve(event, [KEY_RECORDS])[KEY_RECORDS]
+    elif KEY_RECORDS_S3 in event:
+        for s3_object in event[KEY_RECORDS_S3]:
+            yield from iter_s3_ndjson_records(s3_object[KEY_S3_BUCKET], s3_object[KEY_S3_KEY])
+    else:
+        yield event
+
+
 def lambda_handler(event, context):
     """
-    Insert incoming Bag OpenSearch record into OpenSearch.
+    Insert incoming Bag OpenSearch record(s) into OpenSearch.
 
     Expects the following input event format (e.g. from da-ayr-bag-unpacker):
 
@@ -122,13 +157,26 @@ def lambda_handler(event, context):
       }
     }
 
+    or a batch of such records, either as a list (e.g. from the role
+    assigner's batch output) or in NDJSON S3 objects (one record per line,
+    gzipped if the key ends in `.gz`):
+
+    {"records": [{...}, ...]}
+    {"records_s3": [{"s3_bucket": "...", "s3_key": "backfill/records-0001.ndjson.gz"}, ...]}
+
+    Records are written with the OpenSearch `_bulk` API (see
+    `opensearch_lib.BulkWriter`), each with its `Internal-Sender-Identifier`
+    as the document id. Requests are throttled to the cluster's capacity and
+    retried on 429/5xx (see `opensearch_lib.WriteClient`).
+
+    `bag_data` may be passed by claim check (see `claim_check_lib`).
+
     :param event: AWS Lambda event
     :param context: AWS Lambda context
     :return: AWS Lambda response
     """
     print(f'--- event start {"-" * 64}\n{event}\n--- event end {"-" * 66}')
     print(f'--- context start {"-" * 62}\n{context}\n--- context end {"-" * 64}')
-    validate_event(event)
     verify_ssl_cert = check_verify_ssl_cert()
     print(f'verify_ssl_cert={verify_ssl_cert}')
     opensearch_host_url = get_opensearch_url()
@@ -137,30 +185,18 @@ def lambda_handler(event, context):
     credentials = (opensearch_user, opensearch_user_password)
     opensearch_index = os.environ[ENV_OPENSEARCH_INDEX]
     print(f'opensearch_index={opensearch_index}')
-    opensearch_insert_id = event['bag_data']['bag-info.txt']['Internal-Sender-Identifier']
-    url = f'{opensearch_host_url}{opensearch_index}/_doc/{opensearch_insert_id}'
-    print(f'url={url}')
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    data = json.dumps(event)
-    print(f'--- data start {"-" * 65}\n{data}\n--- data end {"-" * 67}')
-
-    response = requests.put(
-        url,
-        verify=verify_ssl_cert,
-        auth=credentials,
-        headers=headers,
-        data=data
-    )
 
-    response.raise_for_status()  # raise error if response not OK
-    response_json = response.json()
-    print(response_json)
+    with opensearch_lib.BulkWriter(
+            url=opensearch_host_url, index=opensearch_index, auth=credentials, verify=verify_ssl_cert) as writer:
+        for record in iter_records(event):
+            validate_event(record)
+            record = claim_check_lib.resolve(record)
+            opensearch_insert_id = record['bag_data']['bag-info.txt']['Internal-Sender-Identifier']
+            writer.add(opensearch_insert_id, record)
+    print(f'bulk write stats: {writer.stats}')
+    print(f'write client stats: {writer.client.get_stats()}')
 
     return {
         'statusCode': 200,
-        'body': json.dumps(response_json)
+        'body': json.dumps(writer.stats)
     }
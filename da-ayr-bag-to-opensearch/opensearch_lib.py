@@ -0,0 +1 @@
+../lib/opensearch_lib.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lib/param_cache_lib.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lib/fixity_lib.py
\ No newline at end of file
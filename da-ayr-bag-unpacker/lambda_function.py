@@ -1,4 +1,7 @@
 import os
+import claim_check_lib
+import client_lib
+import fixity_lib
 import tar_lib
 
 
@@ -9,10 +12,21 @@ class AYRBagUnpackerError(Exception):
 
 
 S3_OUTPUT_PREFIX = os.getenv('AYR_S3_OUTPUT_PREFIX', default='ayr-in/')
+UNPACK_BUFFER_SIZE = int(os.getenv('AYR_UNPACK_BUFFER_SIZE', default=tar_lib.STREAM_BUFFER_SIZE))
+UNPACK_MAX_WORKERS = int(os.getenv('AYR_UNPACK_MAX_WORKERS', default=tar_lib.UPLOAD_MAX_WORKERS))
+UNPACK_MAX_IN_FLIGHT_BYTES = int(os.getenv('AYR_UNPACK_MAX_IN_FLIGHT_BYTES', default=tar_lib.UPLOAD_MAX_IN_FLIGHT_BYTES))
+UNPACK_BUILD_INDEX = os.getenv('AYR_UNPACK_BUILD_INDEX', default='FALSE') == 'TRUE'
+UNPACK_TIME_RESERVE_MS = int(os.getenv('AYR_UNPACK_TIME_RESERVE_MS', default=60000))
+UNPACK_DECOMPRESSION_BACKEND = os.getenv('AYR_UNPACK_DECOMPRESSION_BACKEND') or None
 PATH_JOIN = '/'
 KEY_S3_BUCKET = 's3_bucket'
 KEY_BAG_NAME = 'bag_name'
 KEY_BAG_OUTPUT_S3_PATH = 'bag_output_s3_path'
+KEY_CONTINUATION_TOKEN = 'continuation_token'
+KEY_UNPACK_COMPLETE = 'unpack_complete'
+KEY_UNPACK_ROUNDS = 'unpack_rounds'
+KEY_UNPACKED_FILES = 'unpacked_files'
+KEY_FIXITY_REPORT = 'fixity_report'
 
 
 def lambda_handler(event, context):
@@ -24,9 +38,20 @@ def lambda_handler(event, context):
     {
         "s3_bucket": "",
         "bag_name": "",
-        "bag_output_s3_path": ""
+        "bag_output_s3_path": "",
+        "continuation_token": "",  # optional; from a previous incomplete run
+        "unpack_rounds": 1  # optional; from a previous incomplete run
     }
 
+    If the Lambda is about to time out, progress is checkpointed to S3 and
+    the response has "unpack_complete" set to false and a
+    "continuation_token"; calling again with that response resumes the
+    unpack. "unpack_rounds" counts the incomplete runs, so the state machine
+    can give up on a bag that is not finishing; a run that stops without
+    completing any file raises `tar_lib.TarUnpackStalledError`. A complete response has "unpack_complete" set to true and lists
+    "unpacked_files". Large values in the response are passed by claim check
+    (see `claim_check_lib`).
+
     :param event: AWS Lambda event
     :param context: AWS Lambda context
     :return: AWS Lambda response
@@ -44,19 +69,54 @@ def lambda_handler(event, context):
     s3_bucket = event[KEY_S3_BUCKET]
     bag_name = event[KEY_BAG_NAME]
     bag_output_s3_path = event[KEY_BAG_OUTPUT_S3_PATH]
+    checkpoint_object_name = tar_lib.get_checkpoint_object_name(bag_output_s3_path)
+    continuation_token = event.get(KEY_CONTINUATION_TOKEN)
+    if continuation_token is not None and continuation_token != checkpoint_object_name:
+        raise AYRBagUnpackerError(
+            f'Invalid {KEY_CONTINUATION_TOKEN} "{continuation_token}" for "{bag_output_s3_path}"')
+
+    should_stop = None
+    if context is not None:
+        def should_stop():
+            return context.get_remaining_time_in_millis() < UNPACK_TIME_RESERVE_MS
 
-    extracted_object_names = tar_lib.untar_s3_object(
+    untar_result = tar_lib.untar_s3_object_streaming(
         input_bucket_name=s3_bucket,
         output_bucket_name=s3_bucket,
         object_name=bag_output_s3_path,
-        output_prefix=S3_OUTPUT_PREFIX + bag_name + PATH_JOIN
+        output_prefix=S3_OUTPUT_PREFIX + bag_name + PATH_JOIN,
+        buffer_size=UNPACK_BUFFER_SIZE,
+        max_workers=UNPACK_MAX_WORKERS,
+        max_in_flight_bytes=UNPACK_MAX_IN_FLIGHT_BYTES,
+        should_stop=should_stop,
+        fixity_checker=fixity_lib.BagFixityChecker(),
+        build_index=UNPACK_BUILD_INDEX,
+        decompression_backend=UNPACK_DECOMPRESSION_BACKEND
     )
+    print(f'client_stats={client_lib.get_client_stats()}')
+
+    if not untar_result[tar_lib.KEY_COMPLETE]:
+        checkpoint = untar_result[tar_lib.KEY_CHECKPOINT]
+        print(f'Unpack incomplete; checkpoint at member_index={checkpoint["member_index"]}')
+        return {
+            's3_bucket': s3_bucket,
+            'bag_name': bag_name,
+            'bag_output_s3_path': bag_output_s3_path,
+            KEY_UNPACK_COMPLETE: False,
+            KEY_CONTINUATION_TOKEN: checkpoint_object_name,
+            KEY_UNPACK_ROUNDS: event.get(KEY_UNPACK_ROUNDS, 0) + 1
+        }
 
     response = {
         's3_bucket': s3_bucket,
         'bag_name': bag_name,
         'bag_output_s3_path': bag_output_s3_path,
-        'unpacked_files': extracted_object_names
+        KEY_UNPACKED_FILES: untar_result[tar_lib.KEY_FILES],
+        'memory_report': untar_result[tar_lib.KEY_MEMORY_REPORT],
+        KEY_FIXITY_REPORT: untar_result[tar_lib.KEY_FIXITY_REPORT],
+        'tar_index_s3_path': untar_result.get(tar_lib.KEY_TAR_INDEX),
+        'decompression': untar_result[tar_lib.KEY_DECOMPRESSION],
+        KEY_UNPACK_COMPLETE: True
     }
 
-    return response
+    return claim_check_lib.check_in(response, [KEY_UNPACKED_FILES, KEY_FIXITY_REPORT])
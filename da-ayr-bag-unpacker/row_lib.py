@@ -0,0 +1 @@
+../lib/row_lib.py
\ No newline at end of file
@@ -1,28 +1,27 @@
-import boto3
 import os
 import requests
 import json
+import param_cache_lib
 
 ENV_PARAM_STORE_KEY_KEYCLOAK_CLIENT_SECRET = 'PARAM_STORE_KEY_KEYCLOAK_CLIENT_SECRET'
 ENV_KEYCLOAK_HOST = 'KEYCLOAK_HOST'
 ENV_KEYCLOAK_CLIENT_ID = 'KEYCLOAK_CLIENT_ID'
 ENV_KEYCLOAK_REALM = 'KEYCLOAK_REALM'
-client_ssm = boto3.client('ssm')
 
 
 def get_parameter_store_key_value(key: str, encrypted=True) -> str:
     """
-    Get string value of `key` in Parameter Store.
+    Get string value of `key` in Parameter Store; values are cached across
+    warm invocations (see `param_cache_lib`).
 
     :param key: Name of key whose value will be returned.
     :param encrypted: Whether key is encrypted (boolean).
     :return: String value of requested Parameter Store key.
     """
     print(f'get_parameter_store_key_value: key="{key}"')
-    return client_ssm.get_parameter(
-        Name=key,
-        WithDecryption=encrypted
-    )['Parameter']['Value']
+    value = param_cache_lib.get_value(key, decrypt=encrypted)
+    print(f'param_cache_lib stats: {param_cache_lib.get_stats()}')
+    return value
 
 
 def get_keycloak_token_introspect_response(token: str):
@@ -1,7 +1,7 @@
 import json
 import os
 import requests
-import boto3
+import param_cache_lib
 
 ENV_DO_NOT_VERIFY_SSL = 'DO_NOT_VERIFY_SSL'  # e.g. set to TRUE for local testing via ssh tunnel
 ENV_OPENSEARCH_HOST_URL = 'OPENSEARCH_HOST_URL'
@@ -45,7 +45,8 @@ def get_opensearch_user_password() -> str:
     Gets OpenSearch password from AWS ParameterStore; or, for local testing
     only, environment variable OPENSEARCH_USER_PASSWORD. The AWS
     ParameterStore key name is loaded from environment variable
-    OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY.
+    OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY. Parameter Store values are
+    cached across warm invocations (see `param_cache_lib`).
 
     :return: String containing OpenSearch password.
     """
@@ -56,12 +57,9 @@ def get_opensearch_user_password() -> str:
         print(f'Getting param store key from "{ENV_OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY}"')
         param_store_key = os.environ[ENV_OPENSEARCH_USER_PASSWORD_PARAM_STORE_KEY]
         print(f'param_store_key={param_store_key}')
-        client_ssm = boto3.client('ssm')
-        print('Calling client_ssm.get_parameter')
-        return client_ssm.get_parameter(
-            Name=param_store_key,
-            WithDecryption=True
-        )['Parameter']['Value']
+        password = param_cache_lib.get_value(param_store_key)
+        print(f'param_cache_lib stats: {param_cache_lib.get_stats()}')
+        return password
 
 
 def get_opensearch_url() -> str:
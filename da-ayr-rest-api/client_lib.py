@@ -0,0 +1 @@
+../lib/client_lib.py
\ No newline at end of file
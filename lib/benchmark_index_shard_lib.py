@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Compare indexing a synthetic bag in one pass (`S3BagReader.read_all`) with
+the `index_shard_lib` fan-out run on a local thread or process pool; e.g.:
+
+    python3 benchmark_index_shard_lib.py --sub-files 2000 --rows 100000 --latency-ms 20
+
+s3 is simulated in memory, with a fixed latency per request.
+"""
+import argparse
+import io
+import time
+import index_shard_lib
+import s3_bag_reader
+
+PREFIX = 'ayr-in/bench.tar.gz/bench/'
+
+
+class LatencyS3Api:
+    """
+    In-memory stand-in for the s3 client calls used in indexing, sleeping
+    `latency` seconds per request.
+    """
+
+    def __init__(self, objects: dict, latency: float):
+        self.objects = objects
+        self.latency = latency
+
+    def get_object(self, Bucket, Key, Range=None):
+        time.sleep(self.latency)
+        data = self.objects[Key]
+        if Range is None:
+            return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+        first, last = Range.removeprefix('bytes=').split('-')
+        part = data[int(first):int(last) + 1] if last else data[int(first):]
+        return {
+            'Body': io.BytesIO(part), 'ContentLength': len(part),
+            'ContentRange': f'bytes {first}-{int(first) + len(part) - 1}/{len(data)}'}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        time.sleep(self.latency)
+        yield {'Contents': [
+            {'Key': key, 'Size': len(data)} for key, data in self.objects.items() if key.startswith(Prefix)]}
+
+
+def make_bag(sub_files: int, rows: int) -> dict:
+    """
+    Return {s3 key: content} for an unpacked bag with `sub_files` small
+    text files and bag CSVs and manifest of `rows` rows.
+    """
+    objects = {
+        PREFIX + 'bag-info.txt': b'Source-Organization: Benchmark\n',
+        PREFIX + 'bagit.txt': b'BagIt-Version: 1.0\n',
+        PREFIX + 'tagmanifest-sha256.txt': b'00 bag-info.txt\n',
+        PREFIX + 'file-metadata.csv': b'Filepath,Filesize,FileType\n' + b''.join(
+            f'data/{i}.txt,{i},File\n'.encode() for i in range(rows)),
+        PREFIX + 'file-ffid.csv': b'Filepath,Extension,PUID\n' + b''.join(
+            f'data/{i}.txt,txt,x-fmt/111\n'.encode() for i in range(rows)),
+        PREFIX + 'manifest-sha256.txt': b''.join(f'{i:064x}  data/{i}.txt\n'.encode() for i in range(rows))
+    }
+    for i in range(sub_files):
+        objects[PREFIX + f'data/{i}.txt'] = f'content of file {i}\n'.encode()
+    return objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark index_shard_lib fan-out')
+    parser.add_argument('--sub-files', type=int, default=1000, help='Number of text sub-files')
+    parser.add_argument('--rows', type=int, default=50000, help='Rows in each bag CSV and the manifest')
+    parser.add_argument('--latency-ms', type=float, default=10, help='Simulated s3 request latency')
+    parser.add_argument('--workers', type=int, default=16, help='Local pool size')
+    parser.add_argument('--max-sub-files', type=int, default=index_shard_lib.SHARD_MAX_SUB_FILES)
+    parser.add_argument('--max-csv-bytes', type=int, default=index_shard_lib.SHARD_MAX_CSV_BYTES)
+    args = parser.parse_args()
+
+    objects = make_bag(args.sub_files, args.rows)
+    s3_api = LatencyS3Api(objects, args.latency_ms / 1000)
+    bag = s3_bag_reader.S3BagReader(s3_bucket='bench', file_list=list(objects), path_prefix=PREFIX, s3_api=s3_api)
+    total_bytes = sum(len(data) for data in objects.values())
+    print(f'Synthetic bag: {len(objects)} objects, {total_bytes / 1024 / 1024:.1f} MiB')
+
+    start = time.perf_counter()
+    expected = bag.read_all(max_workers=args.workers)
+    print(f'{"read_all":<16}{time.perf_counter() - start:>8.2f}s')
+
+    start = time.perf_counter()
+    shards = index_shard_lib.plan_shards(bag, max_sub_files=args.max_sub_files, max_csv_bytes=args.max_csv_bytes)
+    print(f'{"plan":<16}{time.perf_counter() - start:>8.2f}s  {len(shards)} shard(s)')
+    for processes in (False, True):
+        start = time.perf_counter()
+        data = index_shard_lib.run_shards_locally(bag, shards, max_workers=args.workers, processes=processes)
+        label = 'shards (procs)' if processes else 'shards (threads)'
+        print(f'{label:<16}{time.perf_counter() - start:>8.2f}s  same={data == expected}')
+
+
+if __name__ == '__main__':
+    main()
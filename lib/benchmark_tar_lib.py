@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Compare decompression throughput (MB/s of uncompressed tar) of the
+`tar_lib` backends on synthetic bags; e.g.:
+
+    python3 benchmark_tar_lib.py --size-mb 64 --repeat 3
+
+Each synthetic bag is a tar of text, random and zero-filled payload files,
+compressed in each available format and then read back through
+`tar_lib.open_decompressed_stream` and `tarfile` as the unpacker does.
+"""
+import argparse
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import tarfile
+import time
+import tar_lib
+
+FILE_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+MIB = 1024 * 1024
+
+
+def make_bag(size_bytes: int, seed: int = 0) -> bytes:
+    """
+    Return an uncompressed tar of roughly `size_bytes` with a mix of text
+    (compressible), random (incompressible) and zero-filled files.
+    """
+    rng = random.Random(seed)
+    words = [bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+             for _ in range(2000)]
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode='w') as tar:
+        written = 0
+        index = 0
+        while written < size_bytes:
+            size = min(FILE_SIZE, size_bytes - written)
+            kind = ('text', 'random', 'zeros')[index % 3]
+            if kind == 'text':
+                data = b' '.join(rng.choice(words) for _ in range(size // 6))[:size]
+            elif kind == 'random':
+                data = os.urandom(size)
+            else:
+                data = bytes(size)
+            info = tarfile.TarInfo(f'bag/data/{kind}-{index:04d}.bin')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            written += len(data)
+            index += 1
+    return output.getvalue()
+
+
+def compress(tar: bytes, compression: str) -> bytes:
+    if compression == 'gz':
+        return gzip.compress(tar, compresslevel=6)
+    if compression == 'bz2':
+        return bz2.compress(tar)
+    if compression == 'xz':
+        return lzma.compress(tar, preset=1)
+    if compression == 'zst':
+        return tar_lib.zstandard.ZstdCompressor(level=3).compress(tar)
+    return tar
+
+
+def time_backend(data: bytes, compression: str, backend: str) -> float:
+    """
+    Return seconds taken to decompress `data` and read every member.
+    """
+    start = time.perf_counter()
+    stream, _ = tar_lib.open_decompressed_stream(io.BytesIO(data), compression, backend)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tar_content:
+            for item in tar_content:
+                if item.isfile():
+                    member = tar_content.extractfile(item)
+                    while member.read(READ_SIZE):
+                        pass
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tar_lib decompression backends')
+    parser.add_argument('--size-mb', type=int, default=32, help='Uncompressed synthetic bag size (MiB)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per backend; the fastest is reported')
+    args = parser.parse_args()
+
+    tar = make_bag(args.size_mb * MIB)
+    print(f'Synthetic bag: {len(tar) / MIB:.1f} MiB uncompressed')
+    print(f'{"format":<8}{"backend":<12}{"ratio":>8}{"MB/s":>10}')
+    for compression in ['tar', 'gz', 'bz2', 'xz', 'zst']:
+        backends = tar_lib.get_decompression_backends(compression)
+        if not backends:
+            print(f'{compression:<8}{"(none installed)":<12}')
+            continue
+        data = compress(tar, compression)
+        ratio = len(tar) / len(data)
+        for backend in backends:
+            seconds = min(time_backend(data, compression, backend) for _ in range(args.repeat))
+            print(f'{compression:<8}{backend:<12}{ratio:>8.2f}{len(tar) / MIB / seconds:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Claim-check passing of large values between the ingester's Lambdas. Step
+Functions payloads are limited in size and re-serialised (and logged) by
+every state, so when an event is over a threshold its largest named values
+are written to s3 as compressed JSON and replaced by small references, which
+the receiving Lambda resolves only for the values it reads. Small events are
+left inline, costing no s3 calls.
+"""
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import client_lib
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CLAIM_CHECK_S3_BUCKET = os.getenv('AYR_CLAIM_CHECK_S3_BUCKET') or None
+CLAIM_CHECK_S3_PREFIX = os.getenv('AYR_CLAIM_CHECK_S3_PREFIX', default='ayr-claim-check/')
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.getenv('AYR_CLAIM_CHECK_THRESHOLD_BYTES', default=64 * 1024))
+CLAIM_CHECK_COMPRESS_LEVEL = 6
+KEY_CLAIM_CHECK = 'ayr_claim_check'
+KNOWN_REFERENCES_MAX = 64
+
+# sha256 -> reference, for values written or read by this process; lets a
+# Lambda pass on a value it resolved without writing it again
+_known_references = collections.OrderedDict()
+
+
+class ClaimCheckError(Exception):
+    """
+    Used to indicate a claim check specific error condition.
+    """
+
+
+def _serialise(value) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _remember(reference: dict):
+    sha256 = reference[KEY_CLAIM_CHECK]['sha256']
+    _known_references[sha256] = reference
+    _known_references.move_to_end(sha256)
+    while len(_known_references) > KNOWN_REFERENCES_MAX:
+        _known_references.popitem(last=False)
+
+
+def is_reference(value) -> bool:
+    """
+    Return `True` if `value` is a claim check reference.
+    """
+    return isinstance(value, dict) and len(value) == 1 and KEY_CLAIM_CHECK in value
+
+
+def put_value(value, s3_bucket: str, key_prefix: str = CLAIM_CHECK_S3_PREFIX, s3_client=None,
+              serialised: bytes = None) -> dict:
+    """
+    Write `value` to s3 as gzipped JSON and return a reference to it:
+
+        {'ayr_claim_check': {'s3_bucket': '', 's3_key': '', 'sha256': '', 'size': 0}}
+
+    The object name is the SHA-256 of the JSON, so retries and repeated
+    values write the same object; values already written or read by this
+    process are not written again.
+    """
+    data = serialised if serialised is not None else _serialise(value)
+    sha256 = hashlib.sha256(data).hexdigest()
+    s3_key = f'{key_prefix}{sha256}.json.gz'
+    known = _known_references.get(sha256)
+    if known is not None and known[KEY_CLAIM_CHECK]['s3_bucket'] == s3_bucket:
+        logger.info(f'Claim check s3://{s3_bucket}/{known[KEY_CLAIM_CHECK]["s3_key"]} reused')
+        return known
+    s3_client = s3_client or client_lib.get_client('s3')
+    body = gzip.compress(data, compresslevel=CLAIM_CHECK_COMPRESS_LEVEL)
+    s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=body, ContentType='application/gzip')
+    logger.info(f'Claim check s3://{s3_bucket}/{s3_key} written: {len(data)} bytes ({len(body)} compressed)')
+    reference = {KEY_CLAIM_CHECK: {'s3_bucket': s3_bucket, 's3_key': s3_key, 'sha256': sha256, 'size': len(data)}}
+    _remember(reference)
+    return reference
+
+
+def get_value(reference: dict, s3_client=None):
+    """
+    Return the value a reference from `put_value` refers to.
+    """
+    claim_check = reference[KEY_CLAIM_CHECK]
+    s3_client = s3_client or client_lib.get_client('s3')
+    s3_object = s3_client.get_object(Bucket=claim_check['s3_bucket'], Key=claim_check['s3_key'])
+    data = gzip.decompress(s3_object['Body'].read())
+    if hashlib.sha256(data).hexdigest() != claim_check['sha256']:
+        raise ClaimCheckError(f'Checksum mismatch for s3://{claim_check["s3_bucket"]}/{claim_check["s3_key"]}')
+    logger.info(f'Claim check s3://{claim_check["s3_bucket"]}/{claim_check["s3_key"]} read: {len(data)} bytes')
+    _remember(reference)
+    return json.loads(data)
+
+
+def check_in(
+        event: dict,
+        keys: list,
+        s3_bucket: str = CLAIM_CHECK_S3_BUCKET,
+        threshold_bytes: int = CLAIM_CHECK_THRESHOLD_BYTES,
+        key_prefix: str = CLAIM_CHECK_S3_PREFIX,
+        s3_client=None
+) -> dict:
+    """
+    Return `event` unchanged if its JSON is no larger than `threshold_bytes`;
+    otherwise return a copy with the largest of the values named by `keys`
+    replaced by references (see `put_value`) until it is. Other values (e.g.
+    those read by Step Functions `Choice` states) always stay inline. If
+    `s3_bucket` is not set the event is returned unchanged.
+
+    :param event: Lambda response
+    :param keys: Names of top level values that may be checked in
+    :param s3_bucket: Claim check bucket (env var AYR_CLAIM_CHECK_S3_BUCKET)
+    :param threshold_bytes: Largest event left inline
+    :param key_prefix: s3 key prefix for claim check objects
+    :param s3_client: Optional s3 client
+    """
+    event_size = len(_serialise(event))
+    if event_size <= threshold_bytes:
+        return event
+    if s3_bucket is None:
+        logger.warning(f'Event is {event_size} bytes (over {threshold_bytes}) but no claim check bucket is set')
+        return event
+    serialised = {
+        key: _serialise(event[key]) for key in keys
+        if key in event and not is_reference(event[key])}
+    output = dict(event)
+    for key in sorted(serialised, key=lambda k: len(serialised[k]), reverse=True):
+        if event_size <= threshold_bytes:
+            break
+        reference = put_value(
+            output[key], s3_bucket, key_prefix=key_prefix, s3_client=s3_client, serialised=serialised[key])
+        event_size -= len(serialised[key]) - len(_serialise(reference))
+        output[key] = reference
+    logger.info(f'Event checked in: {event_size} bytes inline')
+    return output
+
+
+def resolve(event: dict, keys: list = None, s3_client=None) -> dict:
+    """
+    Return a copy of `event` with the references among the values named by
+    `keys` (all values if `None`) replaced by what they refer to. References
+    for other values are passed through untouched.
+    """
+    output = dict(event)
+    for key in output if keys is None else keys:
+        if is_reference(output.get(key)):
+            output[key] = get_value(output[key], s3_client=s3_client)
+    return output
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Shared boto3 clients and resources. Creating a client resolves credentials,
+loads service models and opens new connections, so clients are created once
+per process (and so reused across warm Lambda invocations) with a tuned
+botocore `Config`.
+"""
+import logging
+import os
+import threading
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+import botocore.config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CLIENT_MAX_POOL_CONNECTIONS = int(os.getenv('AYR_CLIENT_MAX_POOL_CONNECTIONS', default=32))
+CLIENT_RETRY_MODE = os.getenv('AYR_CLIENT_RETRY_MODE', default='adaptive')
+CLIENT_RETRY_MAX_ATTEMPTS = int(os.getenv('AYR_CLIENT_RETRY_MAX_ATTEMPTS', default=10))
+CLIENT_CONNECT_TIMEOUT_SECONDS = int(os.getenv('AYR_CLIENT_CONNECT_TIMEOUT_SECONDS', default=5))
+CLIENT_READ_TIMEOUT_SECONDS = int(os.getenv('AYR_CLIENT_READ_TIMEOUT_SECONDS', default=60))
+
+DEFAULT_CONFIG = botocore.config.Config(
+    max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+    retries={'mode': CLIENT_RETRY_MODE, 'max_attempts': CLIENT_RETRY_MAX_ATTEMPTS},
+    tcp_keepalive=True,
+    connect_timeout=CLIENT_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=CLIENT_READ_TIMEOUT_SECONDS
+)
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = threading.local()  # boto3 resources are not thread safe
+_stats = {'clients_created': 0, 'clients_reused': 0, 'resources_created': 0, 'resources_reused': 0}
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def _without_defaults(config_overrides: dict) -> dict:
+    # Overrides matching the defaults share the default client
+    return {
+        name: value for name, value in config_overrides.items()
+        if getattr(DEFAULT_CONFIG, name, None) != value}
+
+
+def _config_key(config_overrides: dict) -> tuple:
+    return tuple(sorted((name, repr(value)) for name, value in config_overrides.items()))
+
+
+def _make_config(config_overrides: dict):
+    if not config_overrides:
+        return DEFAULT_CONFIG
+    return DEFAULT_CONFIG.merge(botocore.config.Config(**config_overrides))
+
+
+def get_client(service_name: str, **config_overrides):
+    """
+    Return the shared boto3 client for `service_name`; created on first use
+    with `DEFAULT_CONFIG`. Keyword arguments override `botocore.config.Config`
+    settings (e.g. `max_pool_connections=16`); each distinct set of overrides
+    has its own shared client. boto3 clients are thread safe.
+    """
+    config_overrides = _without_defaults(config_overrides)
+    key = (service_name, _config_key(config_overrides))
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats['clients_reused'] += 1
+            return client
+        logger.info(f'Creating {service_name} client: config_overrides={config_overrides}')
+        # Sessions are not thread safe, so clients are created under the lock
+        client = _get_session().client(service_name, config=_make_config(config_overrides))
+        _clients[key] = client
+        _stats['clients_created'] += 1
+        return client
+
+
+def get_resource(service_name: str, **config_overrides):
+    """
+    Return a boto3 resource for `service_name`, shared by calls on the same
+    thread (resources must not be shared between threads).
+    """
+    config_overrides = _without_defaults(config_overrides)
+    key = (service_name, _config_key(config_overrides))
+    resources = getattr(_resources, 'resources', None)
+    if resources is None:
+        resources = _resources.resources = {}
+    resource = resources.get(key)
+    with _lock:
+        if resource is not None:
+            _stats['resources_reused'] += 1
+            return resource
+        logger.info(f'Creating {service_name} resource: config_overrides={config_overrides}')
+        resource = _get_session().resource(service_name, config=_make_config(config_overrides))
+        _stats['resources_created'] += 1
+    resources[key] = resource
+    return resource
+
+
+def get_client_stats() -> dict:
+    """
+    Return counts of clients and resources created and reused by this
+    process.
+    """
+    with _lock:
+        return dict(_stats)
+
+
+def reset_clients():
+    """
+    Drop all shared clients, resources and counters (e.g. after changing
+    credentials, or between tests).
+    """
+    global _session, _resources
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources = threading.local()
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Single-pass BagIt fixity checking: tar members are hashed as they stream
+through the unpacker and compared against the bag's manifests (and
+`Payload-Oxum` in `bag-info.txt`) whenever those arrive, so verifying a bag
+needs no extra reads from s3.
+"""
+import hashlib
+import logging
+import re
+import row_lib
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BAG_BAG_INFO = 'bag-info.txt'
+BAG_DATA_DIR = 'data/'
+PAYLOAD_OXUM = 'Payload-Oxum'
+MANIFEST_PATTERN = re.compile(r'^(tag)?manifest-([a-z0-9]+)\.txt$')
+DEFAULT_ALGORITHM = 'sha256'
+
+
+class FixityError(Exception):
+    """
+    Used to indicate a fixity checker specific error condition.
+    """
+
+
+def split_member_name(member_name) -> tuple:
+    """
+    Return (directory prefix including trailing '/', base name) for a member.
+    """
+    head, _, tail = member_name.rpartition('/')
+    return (head + '/' if head else ''), tail
+
+
+class BagFixityChecker:
+    """
+    Accumulates a compact path -> (size, digest) table for every file seen
+    and checks it against each manifest as soon as the manifest has been
+    read, so manifests may appear anywhere in the tar. Digests are kept as
+    raw bytes. Manifest paths are resolved relative to the manifest's own
+    directory (the bag root).
+
+    Feed each tar member with `start_member`, `update` (once per chunk, in
+    order) and `finish_member`. `report` returns the missing, extra and
+    mismatched files. State can be saved and restored with `to_dict` and
+    `load_dict` so that checking survives a resumed unpack.
+
+    :param algorithm: hashlib algorithm name; manifests for other algorithms
+    are reported as unverified
+    """
+
+    def __init__(self, algorithm: str = DEFAULT_ALGORITHM):
+        if algorithm not in hashlib.algorithms_available:
+            raise FixityError(f'Unsupported algorithm "{algorithm}"')
+        self.algorithm = algorithm
+        self.files = {}  # member name -> (size, digest bytes)
+        self.manifests = {}  # manifest member name -> {member name: digest bytes}
+        self.unverified_manifests = []
+        self.payload_oxum = {}  # bag root -> "octets.streams" from bag-info.txt
+        self.mismatched = set()
+        self._member_name = None
+        self._member_size = 0
+        self._hash = None
+        self._tag_kind = None
+        self._tag_lines = []
+        self._partial_line = b''
+
+    def start_member(self, member_name: str, size: int):
+        self._member_name = member_name
+        self._member_size = size
+        self._hash = hashlib.new(self.algorithm)
+        root, base_name = split_member_name(member_name)
+        match = MANIFEST_PATTERN.match(base_name)
+        if base_name == BAG_BAG_INFO:
+            self._tag_kind = BAG_BAG_INFO
+        elif match and match.group(2) == self.algorithm:
+            self._tag_kind = 'manifest'
+        else:
+            if match:
+                logger.warning(f'Cannot verify {member_name}; checking {self.algorithm} only')
+                if member_name not in self.unverified_manifests:
+                    self.unverified_manifests.append(member_name)
+            self._tag_kind = None
+        self._tag_lines = []
+        self._partial_line = b''
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+        if self._tag_kind is not None:
+            # Split into complete lines as data arrives; only a partial line
+            # is carried between chunks
+            lines = (self._partial_line + data).split(b'\n')
+            self._partial_line = lines.pop()
+            self._tag_lines.extend(lines)
+
+    def finish_member(self):
+        digest = self._hash.digest()
+        member_name = self._member_name
+        self.files[member_name] = (self._member_size, digest)
+        self._check_file(member_name, digest)
+        if self._tag_kind is not None:
+            if self._partial_line:
+                self._tag_lines.append(self._partial_line)
+            # Invalid UTF-8 is replaced; paths it affects are then reported
+            # as missing rather than ending the unpack
+            lines = [line.decode('utf-8', errors='replace').rstrip('\r') for line in self._tag_lines]
+            if self._tag_kind == BAG_BAG_INFO:
+                self._read_bag_info(member_name, lines)
+            else:
+                self._read_manifest(member_name, lines)
+        self._member_name = None
+        self._hash = None
+        self._tag_lines = []
+        self._partial_line = b''
+
+    def _read_bag_info(self, member_name, lines):
+        root, _ = split_member_name(member_name)
+        for line in lines:
+            label, separator, value = line.partition(':')
+            if separator and label.strip() == PAYLOAD_OXUM:
+                self.payload_oxum[root] = value.strip()
+
+    def _read_manifest(self, member_name, lines):
+        root, _ = split_member_name(member_name)
+        entries = {}
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise FixityError(f'Invalid line {line_number} in {member_name}: "{line}"')
+            digest_hex, path = parts
+            path = row_lib.decode_manifest_path(path.strip())
+            if path.startswith('./'):
+                path = path[2:]
+            try:
+                entries[root + path] = bytes.fromhex(digest_hex)
+            except ValueError:
+                raise FixityError(f'Invalid digest on line {line_number} in {member_name}: "{digest_hex}"')
+        self.manifests[member_name] = entries
+        logger.info(f'Read {len(entries)} entries from {member_name}')
+        # Check everything already seen against the newly arrived manifest
+        for path, digest in entries.items():
+            if path in self.files:
+                self._compare(path, self.files[path][1], digest)
+
+    def _check_file(self, member_name, digest):
+        for entries in self.manifests.values():
+            expected = entries.get(member_name)
+            if expected is not None:
+                self._compare(member_name, digest, expected)
+
+    def _compare(self, member_name, digest, expected):
+        if digest == expected:
+            self.mismatched.discard(member_name)
+        else:
+            logger.warning(
+                f'Fixity mismatch for {member_name}: expected {expected.hex()} got {digest.hex()}')
+            self.mismatched.add(member_name)
+
+    def _payload_files(self, root) -> list:
+        prefix = root + BAG_DATA_DIR
+        return [name for name in self.files if name.startswith(prefix)]
+
+    def report(self) -> dict:
+        """
+        Return the fixity report:
+
+            {
+                'algorithm': 'sha256',
+                'manifests': [...],
+                'unverified_manifests': [...],  # other algorithms
+                'files_checked': 0,
+                'missing': [...],  # in a manifest but not in the tar
+                'extra': [...],  # payload files not in the payload manifest
+                'mismatched': [...],
+                'payload_oxum': {'bag/': {'expected': '...', 'actual': '...'}},  # by bag root
+                'valid': True
+            }
+        """
+        missing = []
+        extra = []
+        checked = set()
+        for manifest_name, entries in self.manifests.items():
+            root, base_name = split_member_name(manifest_name)
+            for path in entries:
+                if path in self.files:
+                    checked.add(path)
+                else:
+                    missing.append(path)
+            if not base_name.startswith('tag'):
+                extra.extend(p for p in self._payload_files(root) if p not in entries)
+
+        payload_oxum = {}
+        for root, expected in sorted(self.payload_oxum.items()):
+            payload_files = self._payload_files(root)
+            actual = f'{sum(self.files[p][0] for p in payload_files)}.{len(payload_files)}'
+            payload_oxum[root] = {'expected': expected, 'actual': actual}
+
+        report = {
+            'algorithm': self.algorithm,
+            'manifests': sorted(self.manifests),
+            'unverified_manifests': self.unverified_manifests,
+            'files_checked': len(checked),
+            'missing': sorted(set(missing)),
+            'extra': sorted(set(extra)),
+            'mismatched': sorted(self.mismatched),
+            'payload_oxum': payload_oxum
+        }
+        report['valid'] = bool(self.manifests) and not (
+            report['missing'] or report['extra'] or report['mismatched']
+            or any(oxum['expected'] != oxum['actual'] for oxum in payload_oxum.values()))
+        logger.info(
+            f'Fixity report: valid={report["valid"]} files_checked={report["files_checked"]} '
+            f'missing={len(report["missing"])} extra={len(report["extra"])} '
+            f'mismatched={len(report["mismatched"])}')
+        return report
+
+    def to_dict(self) -> dict:
+        """
+        Return JSON serialisable checker state (for unpack checkpoints).
+        """
+        return {
+            'algorithm': self.algorithm,
+            'files': {name: [size, digest.hex()] for name, (size, digest) in self.files.items()},
+            'manifests': {
+                name: {path: digest.hex() for path, digest in entries.items()}
+                for name, entries in self.manifests.items()},
+            'unverified_manifests': self.unverified_manifests,
+            'payload_oxum': self.payload_oxum,
+            'mismatched': sorted(self.mismatched)
+        }
+
+    def load_dict(self, state: dict):
+        """
+        Restore state saved with `to_dict`.
+        """
+        if state.get('algorithm') != self.algorithm:
+            raise FixityError(f'Saved state is for {state.get("algorithm")}, not {self.algorithm}')
+        self.files = {name: (size, bytes.fromhex(digest)) for name, (size, digest) in state['files'].items()}
+        self.manifests = {
+            name: {path: bytes.fromhex(digest) for path, digest in entries.items()}
+            for name, entries in state['manifests'].items()}
+        self.unverified_manifests = list(state['unverified_manifests'])
+        self.payload_oxum = dict(state['payload_oxum'])
+        self.mismatched = set(state['mismatched'])
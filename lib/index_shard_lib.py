@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Split indexing of an unpacked bag into independent shards (e.g. for the
+items of a Step Functions `Map` state), process each shard on its own, and
+merge the partial results into the same `bag_data` as
+`S3BagReader.read_all`, whatever order the shards finish in.
+
+Shards are: the property files; line-aligned byte ranges of the bag CSVs and
+manifests; and index ranges of the text sub-files, each with the content
+budget left at its first file, worked out when planning (from the objects'
+sizes) exactly as a single pass would. Shards hold no file lists, so a plan
+stays small (well within the Step Functions payload limit) however many
+files the bag has.
+"""
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import botocore.client
+import row_lib
+import s3_bag_reader
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SHARD_MAX_SUB_FILES = 100
+SHARD_MAX_CSV_BYTES = 8 * 1024 * 1024
+SHARD_LINE_READ_BYTES = 4 * 1024  # first read past a range; doubled for each further one
+KEY_SHARD = 'shard'
+KEY_KIND = 'kind'
+KEY_DATA = 'data'
+KIND_TAGS = 'tags'
+KIND_CSV = 'csv'
+KIND_CHECKSUM = 'checksum'
+KIND_SUB_FILES = 'sub_files'
+KIND_SUB_FILES_SPENT = 'sub_files_spent'
+
+_worker_bag = None  # per process, for run_shards_locally(processes=True)
+
+
+class ShardError(Exception):
+    """
+    Used to indicate an index shard specific error condition.
+    """
+
+
+def get_object_sizes(bag: s3_bag_reader.S3BagReader) -> dict:
+    """
+    Return {s3 key: size in bytes} for every object under the bag's path
+    prefix (one list request per 1000 objects).
+    """
+    sizes = {}
+    paginator = bag.s3_api.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bag.s3_bucket, Prefix=bag.path_prefix):
+        for s3_object in page.get('Contents', []):
+            sizes[s3_object['Key']] = s3_object['Size']
+    return sizes
+
+
+def plan_shards(
+        bag: s3_bag_reader.S3BagReader,
+        sizes: dict = None,
+        max_sub_files: int = SHARD_MAX_SUB_FILES,
+        max_csv_bytes: int = SHARD_MAX_CSV_BYTES,
+        max_file_bytes: int = s3_bag_reader.SUB_FILE_MAX_BYTES,
+        max_total_bytes: int = s3_bag_reader.SUB_FILES_MAX_BYTES,
+        overflow: str = s3_bag_reader.SUB_FILE_OVERFLOW_TRUNCATE,
+        errors: str = s3_bag_reader.SUB_FILE_DECODE_ERRORS
+) -> list:
+    """
+    Return the list of JSON serialisable shards for `bag`, numbered in
+    output order. Sub-files after the per-bag budget is spent are not read;
+    they are covered by one final shard.
+
+    :param bag: Bag to index
+    :param sizes: {s3 key: size}; listed from s3 if omitted
+    :param max_sub_files: Largest number of sub-files per shard
+    :param max_csv_bytes: Largest CSV or manifest byte range per shard
+    :param max_file_bytes: See `S3BagReader.get_sub_files_dict`
+    :param max_total_bytes: See `S3BagReader.get_sub_files_dict`
+    :param overflow: See `S3BagReader.get_sub_files_dict`
+    :param errors: See `S3BagReader.get_sub_files_dict`
+    """
+    if sizes is None:
+        sizes = get_object_sizes(bag)
+    shards = []
+
+    def add(kind, **fields):
+        shards.append({KEY_SHARD: len(shards), KEY_KIND: kind, **fields})
+
+    add(KIND_TAGS)
+    optional = (bag.BAG_FILE_AV, bag.BAG_FILE_FFID_CSV, bag.BAG_FILE_METADATA)
+    for name, key, kind in [
+        (bag.BAG_FILE_AV, bag.file_av_csv, KIND_CSV),
+        (bag.BAG_FILE_FFID_CSV, bag.file_ffid_csv, KIND_CSV),
+        (bag.BAG_FILE_METADATA, bag.file_metadata_csv, KIND_CSV),
+        (bag.BAG_MANIFEST_SHA256, bag.manifest_sha_256_txt, KIND_CHECKSUM),
+        (bag.BAG_TAGMANIFEST_SHA256, bag.tagmanifest_sha_256_txt, KIND_CHECKSUM)
+    ]:
+        if not key and name in optional:
+            continue
+        if key not in sizes:
+            raise ShardError(f'No size for "{key}"')
+        size = sizes[key]
+        for start in range(0, max(size, 1), max_csv_bytes):
+            add(kind, name=name, key=key, start=start, end=min(start + max_csv_bytes, size),
+                split=size > max_csv_bytes)
+
+    # Spend the content budget in order, as `S3BagReader.make_sub_file_entry`
+    # will, to find what is left at the start of each shard
+    def add_sub_files(first, count, remaining):
+        add(KIND_SUB_FILES, first=first, count=count, remaining=remaining, max_file_bytes=max_file_bytes,
+            overflow=overflow, errors=errors)
+
+    remaining = max_total_bytes
+    first = count = 0
+    first_remaining = remaining
+    spent_from = None
+    sub_file_shards = 0
+    for index, key in enumerate(bag.iter_text_sub_files()):
+        if remaining <= 0:
+            spent_from = index
+            break
+        if key not in sizes:
+            raise ShardError(f'No size for "{key}"')
+        if not count:
+            first, first_remaining = index, remaining
+        size = sizes[key]
+        limit = min(max_file_bytes, remaining)
+        if not (size > limit and overflow == s3_bag_reader.SUB_FILE_OVERFLOW_REFERENCE):
+            remaining -= min(size, limit)
+        count += 1
+        if count >= max_sub_files:
+            add_sub_files(first, count, first_remaining)
+            sub_file_shards += 1
+            count = 0
+    if count or not sub_file_shards:
+        add_sub_files(first, count, first_remaining)
+    if spent_from is not None:
+        add(KIND_SUB_FILES_SPENT, first=spent_from)
+    logger.info(f'Planned {len(shards)} shard(s) for {bag.path_prefix}')
+    return shards
+
+
+class _RangeReader:
+    """
+    File-like reader of s3 object `key` from byte `start`: one ranged GET up
+    to `end`, then (only if reading goes on) further GETs of `read_bytes`,
+    doubling each time, so a shard reads little more than its range and the
+    line running over its end.
+    """
+
+    def __init__(self, bag, key: str, start: int, end: int, read_bytes: int = SHARD_LINE_READ_BYTES):
+        self.bag = bag
+        self.key = key
+        self.offset = start
+        self.range_end = end
+        self.read_bytes = read_bytes
+        self.size = None
+        self.body = None
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            if self.body is None:
+                if self.size is not None and self.offset >= self.size:
+                    return b''
+                s3_object = self.bag.s3_api.get_object(
+                    Bucket=self.bag.s3_bucket, Key=self.key, Range=f'bytes={self.offset}-{self.range_end - 1}')
+                content_range = s3_object.get('ContentRange')
+                if content_range:
+                    self.size = int(content_range.rpartition('/')[2])
+                self.body = s3_object['Body']
+            data = self.body.read(size)
+            if data:
+                self.offset += len(data)
+                return data
+            self.close()
+            if self.offset < self.range_end:
+                return b''  # the object ends within the range
+            self.range_end = self.offset + self.read_bytes
+            self.read_bytes *= 2
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+def _iter_line_range(bag, key, start, end):
+    """
+    Yield the lines of `key` that start at a byte offset in [start, end);
+    the line running over `end` is read to its end.
+    """
+    if end <= start:
+        return
+    # Starting a byte early shows whether `start` begins a line
+    range_start = max(start - 1, 0)
+    lines = row_lib.iter_byte_lines(_RangeReader(bag, key, range_start, end))
+    offset = range_start
+    try:
+        for line in lines:
+            line_start = offset
+            offset += len(line)
+            if line_start < start:
+                continue
+            if line_start >= end:
+                break
+            yield line.decode(row_lib.ENCODING_UTF8)
+    finally:
+        lines.close()
+
+
+def _check_split_line(key, line):
+    # Records spanning lines (quoted newlines) cannot be split by byte range
+    if line.count('"') % 2:
+        raise ShardError(f'"{key}" has a record spanning lines; index it with a larger max_csv_bytes')
+    return line
+
+
+def process_shard(bag: s3_bag_reader.S3BagReader, shard: dict) -> dict:
+    """
+    Return the partial result for one shard from `plan_shards`:
+
+        {'shard': 0, 'data': {...}}
+    """
+    kind = shard[KEY_KIND]
+    data = {}
+    if kind == KIND_TAGS:
+        data.update(bag.get_bag_info_txt_as_dict())
+        data.update(bag.get_bagit_txt_as_dict())
+    elif kind in (KIND_CSV, KIND_CHECKSUM):
+        key = shard['key']
+        lines = _iter_line_range(bag, key, shard['start'], shard['end'])
+        if shard['split']:
+            lines = (_check_split_line(key, line) for line in lines)
+        if kind == KIND_CHECKSUM:
+            data[shard['name']] = list(row_lib.iter_checksum_lines(lines))
+        else:
+            if shard['start'] > 0:
+                with contextlib.closing(_iter_line_range(bag, key, 0, 1)) as header_lines:
+                    header = next(header_lines)
+                lines = itertools.chain([header], lines)
+            data[shard['name']] = list(row_lib.iter_csv_lines(lines))
+    elif kind == KIND_SUB_FILES:
+        first = shard['first']
+        keys = list(itertools.islice(bag.iter_text_sub_files(), first, first + shard['count']))
+        max_file_bytes = shard['max_file_bytes']
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(len(keys), s3_bag_reader.READ_MAX_WORKERS))) as executor:
+            heads = list(executor.map(lambda key: bag.get_sub_file_head(key, max_file_bytes), keys))
+        remaining = shard['remaining']
+        entries = []
+        for key, (head, size) in zip(keys, heads):
+            entry, used = bag.make_sub_file_entry(
+                key, head, size, min(max_file_bytes, remaining), shard['overflow'], shard['errors'])
+            remaining -= used
+            entries.append(entry)
+        data[s3_bag_reader.BAG_SUB_FILES] = entries
+    elif kind == KIND_SUB_FILES_SPENT:
+        data[s3_bag_reader.BAG_SUB_FILES] = [
+            bag.make_sub_file_entry(key, b'', None, 0, None, None)[0]
+            for key in itertools.islice(bag.iter_text_sub_files(), shard['first'], None)]
+    else:
+        raise ShardError(f'Unknown shard kind "{kind}"')
+    return {KEY_SHARD: shard[KEY_SHARD], KEY_DATA: data}
+
+
+def merge_shard_results(results: list) -> dict:
+    """
+    Merge the results of every shard of a plan, in any order, into
+    `bag_data`: list values are concatenated and dictionaries combined in
+    shard order.
+    """
+    results = sorted(results, key=lambda result: result[KEY_SHARD])
+    numbers = [result[KEY_SHARD] for result in results]
+    if numbers != list(range(len(results))):
+        raise ShardError(f'Incomplete or duplicate shard results: {numbers}')
+    bag_data = {}
+    for result in results:
+        for name, value in result[KEY_DATA].items():
+            if name not in bag_data:
+                bag_data[name] = list(value) if isinstance(value, list) else dict(value)
+            elif isinstance(value, list):
+                bag_data[name].extend(value)
+            else:
+                bag_data[name].update(value)
+    return bag_data
+
+
+def _init_worker(s3_bucket, file_list, path_prefix, s3_api):
+    global _worker_bag
+    _worker_bag = s3_bag_reader.S3BagReader(
+        s3_bucket=s3_bucket, file_list=file_list, path_prefix=path_prefix, s3_api=s3_api)
+
+
+def _process_in_worker(shard):
+    return process_shard(_worker_bag, shard)
+
+
+def run_shards_locally(
+        bag: s3_bag_reader.S3BagReader,
+        shards: list,
+        max_workers: int = s3_bag_reader.READ_MAX_WORKERS,
+        processes: bool = False
+) -> dict:
+    """
+    Process `shards` on a local thread (or process) pool and return the
+    merged `bag_data`; the same logic as the Step Functions fan-out, for
+    testing and benchmarking off AWS. Process workers use their own shared
+    s3 client unless the bag's `s3_api` is not a boto3 client.
+    """
+    if not processes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda shard: process_shard(bag, shard), shards))
+        return merge_shard_results(results)
+
+    file_list = [getattr(bag, name) for name in bag.ROOT_FILE_PROPERTIES.values() if getattr(bag, name)]
+    file_list.extend(bag.iter_bag_sub_files())
+    s3_api = None if isinstance(bag.s3_api, botocore.client.BaseClient) else bag.s3_api
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker,
+            initargs=(bag.s3_bucket, file_list, bag.path_prefix, s3_api)) as executor:
+        results = list(executor.map(_process_in_worker, shards))
+    return merge_shard_results(results)
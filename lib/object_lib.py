@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
-import csv
 import logging
 import requests  # https://docs.python-requests.org/en/master/api/
 import hashlib  # https://docs.python.org/3/library/hashlib.html
-import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
-import codecs
+import base64
+import re
+import urllib.parse
+import concurrent.futures
+import json
+import time
+import botocore.exceptions
+import threading
+import urllib3
+import client_lib
+import row_lib
+import transfer_lib
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -18,6 +27,26 @@ logger.setLevel(logging.INFO)
 READ_BLOCK_SIZE = 5 * 1024 * 1024  # s3 multipart min=5MB, except "last" part
 ENCODING_UTF8 = 'utf-8'
 S3_PATH_SEPARATOR = '/'
+S3_MAX_PARTS = 10000
+S3_KEY_PARTS = 'Parts'
+S3_KEY_PART_NUMBER = 'PartNumber'
+S3_KEY_ETAG = 'ETag'
+HTTP_STATUS_PARTIAL_CONTENT = 206
+TRANSFER_MAX_WORKERS = 8
+TRANSFER_MAX_IN_FLIGHT_BYTES = 2 * TRANSFER_MAX_WORKERS * READ_BLOCK_SIZE
+STREAM_READ_SIZE = 64 * 1024
+PART_MAX_ATTEMPTS = 5
+PART_RETRY_BASE_DELAY_SECONDS = 1
+COPY_PART_SIZE = 256 * 1024 * 1024
+S3_HOST_PATTERN = re.compile(
+    r'^(?:(?P<bucket>.+)\.)?s3(?:[.-](?:dualstack\.)?[a-z0-9-]+)?\.amazonaws\.com(?:\.cn)?$')
+S3_RETRYABLE_ERROR_CODES = (
+    'RequestTimeout', 'SlowDown', 'InternalError', 'ServiceUnavailable', 'ConditionalRequestConflict')
+S3_PRECONDITION_FAILED = 'PreconditionFailed'
+INGEST_MARKER_SUFFIX = '.ingest-marker.json'
+INGEST_LEASE_SECONDS = 15 * 60  # the maximum Lambda run time
+INGEST_STATE_IN_PROGRESS = 'IN_PROGRESS'
+INGEST_STATE_COMPLETE = 'COMPLETE'
 
 
 # Error class
@@ -27,71 +56,133 @@ class S3LibError(Exception):
     """
 
 
+class TransientTransferError(Exception):
+    """
+    Used to indicate a transfer failure that may succeed if retried (for
+    example a truncated or refused ranged GET).
+    """
+
+
+class ObjectExistsError(ValueError):
+    """
+    Used to indicate that a write was refused because the target object (or
+    an ingest of it) already exists.
+    """
+
+
+def _is_precondition_failed(e):
+    return (
+        isinstance(e, botocore.exceptions.ClientError)
+        and e.response.get('Error', {}).get('Code') == S3_PRECONDITION_FAILED)
+
+
+def s3_key_exists(bucket_name, object_name):
+    """
+    Return `True` if an object with exactly the key `object_name` is in
+    `bucket_name`, otherwise `False`; a single `HeadObject` call.
+    """
+    logger.info(f's3_key_exists start: bucket_name="{bucket_name}" object_name="{object_name}"')
+    try:
+        client_lib.get_client('s3').head_object(Bucket=bucket_name, Key=object_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            logger.info('s3_key_exists return: False')
+            return False
+        raise
+    logger.info('s3_key_exists return: True')
+    return True
+
+
 def s3_object_exists(bucket_name, object_filter):
     """
-    Return `True` if `object_filter` in `bucket_name`, otherwise `False`.
+    Return `True` if any object in `bucket_name` has a key starting with
+    `object_filter`, otherwise `False`; a single `ListObjectsV2` call
+    whatever the number of matching objects.
     """
     logger.info(
         f's3_object_exists start: bucket_name="{bucket_name}" '
         f'object_filter="{object_filter}"')
 
-    s3_resource = boto3.resource('s3')
-    s3_bucket = s3_resource.Bucket(bucket_name)
-    s3_object_list = list(s3_bucket.objects.filter(Prefix=object_filter))
-    logger.info(f's3_object_exists return: s3_object_list={s3_object_list}')
-    return len(s3_object_list) > 0
+    response = client_lib.get_client('s3').list_objects_v2(
+        Bucket=bucket_name, Prefix=object_filter, MaxKeys=1)
+    exists = response.get('KeyCount', 0) > 0
+    logger.info(f's3_object_exists return: {exists}')
+    return exists
 
 
 def s3_ls(bucket_name, object_filter):
     """
-    Return list of objects in `bucket_name` that match `object_filter`.
+    Yield the keys of objects in `bucket_name` that match `object_filter`,
+    one page of results at a time.
     """
     logger.info(
         f's3_object_ls start: bucket_name="{bucket_name}" '
         f'object_filter="{object_filter}"')
 
-    s3_resource = boto3.resource('s3')
-    s3_bucket = s3_resource.Bucket(bucket_name)
-    s3_objects = s3_bucket.objects.filter(Prefix=object_filter)
-    s3_object_list = []
-    for s3_object in s3_objects:
-        s3_object_list.append(s3_object.key)
-    logger.info(f's3_object_ls return: s3_bucket_list={s3_object_list}')
-    return s3_object_list
+    paginator = client_lib.get_client('s3').get_paginator('list_objects_v2')
+    count = 0
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=object_filter):
+        for s3_object in page.get('Contents', []):
+            count += 1
+            yield s3_object['Key']
+    logger.info(f's3_object_ls end: {count} object(s)')
 
 
 def get_max_s3_subfolder_number(bucket_name, object_filter):
     """
-    Return the max numeric folder name below path `s3_object_prefix` in
-    `s3_bucket`, or `None` if no numeric child folders are found.
+    Return the max numeric folder name below path `object_filter` in
+    `bucket_name` as an int, or `None` if no numeric child folders are
+    found. Only the child folder names are listed (using `Delimiter`), not
+    the objects within them.
 
     For example, given the following list of objects in s3 bucket `foo`,
-    `get_max_s3_subfolder_number('foo', 'alpha/bravo/)` would return `1`:
+    `get_max_s3_subfolder_number('foo', 'alpha/bravo/')` would return `10`:
 
-    * alpha/bravo/0/charlie
-    * alpha/bravo/0/delta
+    * alpha/bravo/9/charlie
+    * alpha/bravo/10/delta
     * alpha/bravo/1/echo/foxtrot
     * alpha/bravo/golf/hotel
     * india/juliet/kilo/lima
-
-    Calling
     """
     logger.info(
         f'get_max_s3_subfolder_number start: bucket_name="{bucket_name}" '
         f'object_filter="{object_filter}"')
 
-    s3_resource = boto3.resource('s3')
-    s3_bucket = s3_resource.Bucket(bucket_name)
-    s3_object_list = list(s3_bucket.objects.filter(Prefix=object_filter))
-    logger.info(f's3_object_list={s3_object_list}')
-    numeric_subfolders = [
-        o.key[len(object_filter):].split(S3_PATH_SEPARATOR, 1)[0]
-        for o in s3_object_list
-        if o.key[len(object_filter):].split(S3_PATH_SEPARATOR, 1)[0].isdigit()
-    ]
-    logger.info(f'numeric_subfolders={numeric_subfolders}')
-    logger.info(f'get_max_s3_subfolder_number return: numeric_subfolders={numeric_subfolders}')
-    return max(numeric_subfolders) if len(numeric_subfolders) > 0 else None
+    paginator = client_lib.get_client('s3').get_paginator('list_objects_v2')
+    max_number = None
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=object_filter, Delimiter=S3_PATH_SEPARATOR):
+        for common_prefix in page.get('CommonPrefixes', []):
+            subfolder = common_prefix['Prefix'][len(object_filter):].rstrip(S3_PATH_SEPARATOR)
+            if subfolder.isascii() and subfolder.isdigit():
+                number = int(subfolder)
+                max_number = number if max_number is None else max(max_number, number)
+    logger.info(f'get_max_s3_subfolder_number return: {max_number}')
+    return max_number
+
+
+def get_url_range_support(source_url):
+    """
+    Return the total size in bytes of `source_url` if the server honours
+    HTTP `Range` requests, otherwise `None`.
+
+    A one byte ranged GET is used rather than HEAD because pre-signed S3 URLs
+    are only valid for the HTTP method they were signed for.
+    """
+    logger.info('get_url_range_support start')
+    response = requests.get(
+        source_url, headers={'Range': 'bytes=0-0'}, stream=True)
+    try:
+        content_range = response.headers.get('Content-Range', '')
+        accept_ranges = response.headers.get('Accept-Ranges', '')
+        logger.info(
+            f'get_url_range_support: status_code={response.status_code} '
+            f'Accept-Ranges="{accept_ranges}" Content-Range="{content_range}"')
+        if response.status_code != HTTP_STATUS_PARTIAL_CONTENT:
+            return None
+        total_size = content_range.rsplit(S3_PATH_SEPARATOR, 1)[-1]
+        return int(total_size) if total_size.isdigit() else None
+    finally:
+        response.close()
 
 
 def url_to_s3_object(
@@ -99,112 +190,828 @@ def url_to_s3_object(
         target_bucket_name,
         target_object_name,
         allow_overwrite=False,
-        expected_checksum=None):
+        expected_checksum=None,
+        max_workers=TRANSFER_MAX_WORKERS,
+        part_size=READ_BLOCK_SIZE,
+        max_in_flight_bytes=TRANSFER_MAX_IN_FLIGHT_BYTES,
+        allow_server_side_copy=True,
+        conditional_write=False):
     """
     Copy the content of the supplied `source_url` into an object with name
     `target_object_name` in bucket `target_bucket_name`.
 
     The `expected_checksum` can be validated during or the copy
     process; checksum validation failure will raise a `ValueException`.
+
+    If `max_workers` is greater than 1 and the source supports HTTP `Range`
+    requests, parts of `part_size` bytes are downloaded and uploaded
+    concurrently, with at most `max_in_flight_bytes` buffered at any time;
+    otherwise the source is streamed sequentially.
+
+    If `allow_server_side_copy` is True and `source_url` is an s3 URL (e.g. a
+    pre-signed URL) for an object these credentials can read, the data is
+    copied within s3 using parallel `UploadPartCopy` requests instead.
+
+    If `conditional_write` is True (and `allow_overwrite` is False) there is
+    no listing before the copy; instead s3 only completes the upload if the
+    target does not exist (`If-None-Match: *`), so of two concurrent copies
+    only one can succeed. The other raises `ObjectExistsError`.
+
+    Returns a dictionary of transfer statistics (bytes, seconds,
+    bytes_per_second, parts_in_flight_max, ...).
     """
     logger.info(
         f'copy_url_data_to_bucket start: source_url="{source_url}" '
         f'target_bucket_name="{target_bucket_name}" '
         f'target_object_name="{target_object_name}" '
         f'allow_overwrite="{allow_overwrite}" '
-        f'expected_checksum="{expected_checksum}"')
+        f'expected_checksum="{expected_checksum}" '
+        f'max_workers={max_workers} part_size={part_size} '
+        f'max_in_flight_bytes={max_in_flight_bytes} '
+        f'allow_server_side_copy={allow_server_side_copy} '
+        f'conditional_write={conditional_write}')
+
+    if part_size < READ_BLOCK_SIZE:
+        raise ValueError(
+            f'part_size {part_size} is below the s3 multipart minimum of '
+            f'{READ_BLOCK_SIZE}')
 
     # Unless allow_overwrite is True, don't copy object if it already exists
-    if not allow_overwrite:
+    if_none_match = not allow_overwrite and conditional_write
+    if not allow_overwrite and not conditional_write:
         raise_error_if_object_exists(target_bucket_name, target_object_name)
 
-    response = requests.get(source_url, stream=True)
+    s3_source = get_s3_source_object(source_url) if allow_server_side_copy else None
+    content_length = None
+    if s3_source is None and max_workers > 1:
+        content_length = get_url_range_support(source_url)
+
+    if s3_source is not None:
+        stats = _s3_object_to_s3_object_copy(
+            source_url=source_url,
+            source_head=s3_source,
+            target_bucket_name=target_bucket_name,
+            target_object_name=target_object_name,
+            expected_checksum=expected_checksum,
+            max_workers=max_workers,
+            if_none_match=if_none_match)
+    elif content_length:
+        stats = _url_to_s3_object_concurrent(
+            source_url=source_url,
+            target_bucket_name=target_bucket_name,
+            target_object_name=target_object_name,
+            content_length=content_length,
+            expected_checksum=expected_checksum,
+            max_workers=max_workers,
+            part_size=_get_part_size(content_length, part_size),
+            max_in_flight_bytes=max_in_flight_bytes,
+            if_none_match=if_none_match)
+    else:
+        logger.info('Range requests not used; falling back to sequential copy')
+        stats = _url_to_s3_object_sequential(
+            source_url=source_url,
+            target_bucket_name=target_bucket_name,
+            target_object_name=target_object_name,
+            expected_checksum=expected_checksum,
+            part_size=part_size,
+            if_none_match=if_none_match)
+
+    logger.info(f'copy_url_data_to_bucket end: stats={stats}')
+    return stats
+
+
+def parse_s3_url(url):
+    """
+    Return `(bucket, key)` if `url` addresses an object on an s3 endpoint
+    (virtual-hosted or path style, optionally pre-signed), otherwise `None`.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    match = S3_HOST_PATTERN.match(parsed_url.hostname or '')
+    if parsed_url.scheme != 'https' or not match:
+        return None
+    path = urllib.parse.unquote(parsed_url.path).lstrip(S3_PATH_SEPARATOR)
+    bucket = match.group('bucket')
+    if bucket is None:
+        bucket, _, path = path.partition(S3_PATH_SEPARATOR)
+    if not bucket or not path:
+        return None
+    return bucket, path
+
+
+def get_s3_source_object(source_url):
+    """
+    If `source_url` is an s3 URL for an object that can be read with the
+    Lambda's own credentials, return its `head_object` response (including
+    `Bucket` and `Key` entries), otherwise `None`.
+    """
+    s3_location = parse_s3_url(source_url)
+    if s3_location is None:
+        return None
+    bucket, key = s3_location
+    logger.info(f'get_s3_source_object: bucket="{bucket}" key="{key}"')
+    try:
+        head = client_lib.get_client('s3').head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    except botocore.exceptions.ClientError as e:
+        logger.info(f'get_s3_source_object: no direct access to source ({e}); will stream')
+        return None
+    if head['ContentLength'] == 0:
+        logger.info('get_s3_source_object: source is empty; will stream')
+        return None
+    head['Bucket'] = bucket
+    head['Key'] = key
+    return head
+
+
+def _get_s3_full_object_sha256(head):
+    """
+    Return the hex SHA-256 of the whole object if s3 holds one for it (a
+    single part upload, or a full object checksum), otherwise `None`.
+    """
+    checksum = head.get('ChecksumSHA256')
+    if not checksum or '-' in checksum or head.get('ChecksumType') == 'COMPOSITE':
+        return None
+    return base64.b64decode(checksum).hex()
+
+
+def _get_part_size(content_length, part_size):
+    """
+    Return `part_size`, grown in whole MiB steps if needed so that
+    `content_length` fits within the s3 multipart part count limit.
+    """
+    min_part_size = -(-content_length // S3_MAX_PARTS)
+    if part_size >= min_part_size:
+        return part_size
+    mib = 1024 * 1024
+    return -(-min_part_size // mib) * mib
+
 
-    if not response.ok:
+def _check_checksum(hex_digest, expected_checksum, source_url):
+    logger.info(f'hexdigest         : "{hex_digest}"')
+    logger.info(f'expected_checksum : "{expected_checksum}"')
+    if hex_digest != expected_checksum:
         raise ValueError(
-            f'Failed to open source URL "{source_url}" : '
-            f'response.status_code={response.status_code} : {response.text}')
+            f'Invalid checksum; calculated "{hex_digest}" but '
+            f'expected "{expected_checksum}" for URL {source_url}')
 
-    hashlib_sha256 = hashlib.sha256()
 
-    # Initiate s3 session
-    s3_session = boto3.session.Session()
-    s3_session_resource = s3_session.resource('s3')
-    s3_target_object = s3_session_resource.Object(target_bucket_name, target_object_name)
-    s3_uploader = s3_target_object.initiate_multipart_upload()
+def _is_retryable_error(e):
+    """
+    Return `True` if `e` is a transient network or s3 service error worth
+    retrying at part level.
+    """
+    if isinstance(e, botocore.exceptions.ClientError):
+        error = e.response.get('Error', {})
+        status_code = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return status_code >= 500 or error.get('Code') in S3_RETRYABLE_ERROR_CODES
+    return isinstance(e, (
+        requests.exceptions.RequestException,
+        botocore.exceptions.BotoCoreError,
+        TransientTransferError))
+
+
+class MultipartTransfer:
+    """
+    State machine for a single s3 multipart upload. Parts are uploaded (and
+    retried individually with backoff); the upload is only completed once the
+    caller has verified the transferred data, otherwise it is aborted so no
+    corrupt object is ever created:
+
+        INITIATED -> TRANSFERRING -> VERIFYING -> COMPLETED
+            (any state except COMPLETED) -> ABORTED
+
+    With `if_none_match` the upload is only completed if the object does not
+    already exist; otherwise `complete` raises `ObjectExistsError`.
+    """
+    STATE_NEW = 'NEW'
+    STATE_INITIATED = 'INITIATED'
+    STATE_TRANSFERRING = 'TRANSFERRING'
+    STATE_VERIFYING = 'VERIFYING'
+    STATE_COMPLETED = 'COMPLETED'
+    STATE_ABORTED = 'ABORTED'
+
+    def __init__(
+            self,
+            s3_client,
+            bucket_name,
+            object_name,
+            max_attempts=PART_MAX_ATTEMPTS,
+            retry_base_delay=PART_RETRY_BASE_DELAY_SECONDS,
+            if_none_match=False):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.if_none_match = if_none_match
+        self.state = self.STATE_NEW
+        self.upload_id = None
+        self.parts = {}
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        logger.info(
+            f'MultipartTransfer {self.object_name}: {self.state} -> {state}')
+        self.state = state
+
+    def _require_state(self, *states):
+        if self.state not in states:
+            raise S3LibError(
+                f'MultipartTransfer {self.object_name} is {self.state}; '
+                f'expected one of {states}')
+
+    def retry(self, fn, description):
+        """
+        Run `fn` with part-level retry and backoff for transient errors.
+        """
+        return transfer_lib.retry_with_backoff(
+            fn,
+            description=f'{self.object_name} {description}',
+            max_attempts=self.max_attempts,
+            base_delay=self.retry_base_delay,
+            is_retryable=_is_retryable_error)
+
+    def initiate(self):
+        self._require_state(self.STATE_NEW)
+        self.upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=self.object_name)['UploadId']
+        self._set_state(self.STATE_INITIATED)
+
+    def upload_part(self, part_number, data):
+        """
+        Upload `data` as part `part_number` (retrying transient failures) and
+        return its ETag.
+        """
+        with self._lock:
+            self._require_state(self.STATE_INITIATED, self.STATE_TRANSFERRING)
+            if self.state == self.STATE_INITIATED:
+                self._set_state(self.STATE_TRANSFERRING)
+
+        part_response = self.retry(
+            lambda: self.s3_client.upload_part(
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data),
+            description=f'UploadPart {part_number}')
+        etag = part_response[S3_KEY_ETAG]
+        with self._lock:
+            self.parts[part_number] = etag
+        logger.debug(f'Multipart upload part {part_number} sent, ETag={etag}')
+        return etag
+
+    def verify(self, hex_digest=None, expected_checksum=None, source_url=None, part_count=None):
+        """
+        Check the parts sent so far form a whole, valid transfer; raise an
+        error (leaving the upload uncompleted) if not.
+        """
+        self._require_state(self.STATE_INITIATED, self.STATE_TRANSFERRING)
+        self._set_state(self.STATE_VERIFYING)
+        if part_count is not None and sorted(self.parts) != list(range(1, part_count + 1)):
+            raise ValueError(
+                f'Only {len(self.parts)} of {part_count} parts were sent '
+                f'for URL {source_url}')
+        if expected_checksum is not None:
+            _check_checksum(hex_digest, expected_checksum, source_url)
+
+    def complete(self):
+        self._require_state(self.STATE_VERIFYING)
+        logger.info(f'Send multipart upload complete notification')
+        s3_parts = {
+            S3_KEY_PARTS: [
+                {S3_KEY_PART_NUMBER: part_number, S3_KEY_ETAG: self.parts[part_number]}
+                for part_number in sorted(self.parts)
+            ]
+        }
+        conditions = {'IfNoneMatch': '*'} if self.if_none_match else {}
+        try:
+            s3_uploader_result = self.retry(
+                lambda: self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.object_name,
+                    UploadId=self.upload_id,
+                    MultipartUpload=s3_parts,
+                    **conditions),
+                description='CompleteMultipartUpload')
+        except botocore.exceptions.ClientError as e:
+            if _is_precondition_failed(e):
+                raise ObjectExistsError(
+                    f'Copy not allowed; "{self.object_name}" already exists in bucket '
+                    f'"{self.bucket_name}"') from e
+            raise
+        logger.debug(f's3_uploader_result={s3_uploader_result}')
+        self._set_state(self.STATE_COMPLETED)
+
+    def upload_part_copy(self, part_number, source_bucket, source_key, copy_range, source_etag):
+        """
+        Copy `copy_range` (e.g. `bytes=0-99`) of the source object into part
+        `part_number` server side (retrying transient failures); the source
+        must still match `source_etag`. Returns the part's ETag.
+        """
+        with self._lock:
+            self._require_state(self.STATE_INITIATED, self.STATE_TRANSFERRING)
+            if self.state == self.STATE_INITIATED:
+                self._set_state(self.STATE_TRANSFERRING)
+
+        part_response = self.retry(
+            lambda: self.s3_client.upload_part_copy(
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                CopySource={'Bucket': source_bucket, 'Key': source_key},
+                CopySourceRange=copy_range,
+                CopySourceIfMatch=source_etag),
+            description=f'UploadPartCopy {part_number}')
+        etag = part_response['CopyPartResult'][S3_KEY_ETAG]
+        with self._lock:
+            self.parts[part_number] = etag
+        logger.debug(f'Multipart copy part {part_number} sent, ETag={etag}')
+        return etag
+
+    def abort(self):
+        if self.state in (self.STATE_NEW, self.STATE_COMPLETED, self.STATE_ABORTED):
+            return
+        logger.info('Abort multipart upload...')
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket_name, Key=self.object_name, UploadId=self.upload_id)
+        self._set_state(self.STATE_ABORTED)
+        logger.debug('Multipart upload abort complete')
+
+
+class ResumableUrlReader:
+    """
+    Read `source_url` sequentially in fixed size chunks. If the connection
+    drops mid-stream it is re-opened with a `Range` request starting at the
+    last byte successfully received, up to `max_attempts` times in a row.
+    """
+
+    def __init__(
+            self,
+            source_url,
+            max_attempts=PART_MAX_ATTEMPTS,
+            retry_base_delay=PART_RETRY_BASE_DELAY_SECONDS):
+        self.source_url = source_url
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.offset = 0
+        self.resume_count = 0
+        self._response = None
+
+    def _open(self):
+        headers = {'Range': f'bytes={self.offset}-'} if self.offset > 0 else {}
+        response = requests.get(self.source_url, headers=headers, stream=True)
+        if self.offset == 0:
+            if not response.ok:
+                error = ValueError(
+                    f'Failed to open source URL "{self.source_url}" : '
+                    f'response.status_code={response.status_code} : {response.text}')
+                if response.status_code >= 500:
+                    raise TransientTransferError(str(error))
+                raise error
+        elif (response.status_code != HTTP_STATUS_PARTIAL_CONTENT or not
+                response.headers.get('Content-Range', '').startswith(f'bytes {self.offset}-')):
+            response.close()
+            raise ValueError(
+                f'Unable to resume "{self.source_url}" at byte {self.offset}; '
+                f'response.status_code={response.status_code}')
+        self._response = response
+        return response.iter_content(chunk_size=STREAM_READ_SIZE)
+
+    def iter_chunks(self, chunk_size):
+        """
+        Yield consecutive `chunk_size` byte chunks (the last may be shorter).
+        """
+        buffer = bytearray()
+        stream = transfer_lib.retry_with_backoff(
+            self._open, f'GET {self.offset}-',
+            max_attempts=self.max_attempts,
+            base_delay=self.retry_base_delay,
+            is_retryable=_is_retryable_error)
+        failures = 0
+        while True:
+            try:
+                data = next(stream, None)
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                failures += 1
+                self._response.close()
+                if failures >= self.max_attempts:
+                    raise
+                logger.warning(
+                    f'Source stream dropped at byte {self.offset} ({e}); '
+                    f'resuming with Range request (attempt {failures})')
+                self.resume_count += 1
+                stream = transfer_lib.retry_with_backoff(
+                    self._open, f'GET {self.offset}-',
+                    max_attempts=self.max_attempts,
+                    base_delay=self.retry_base_delay,
+                    is_retryable=_is_retryable_error)
+                continue
+
+            if data is None:
+                break
+            failures = 0
+            self.offset += len(data)
+            buffer += data
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
 
-    s3_key_parts = 'Parts'
-    s3_key_part_number = 'PartNumber'
-    s3_key_etag = 'ETag'
-    s3_parts = {s3_key_parts: []}
-    s3_part_count = 0
+        if buffer:
+            yield bytes(buffer)
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+
+
+def _url_to_s3_object_sequential(
+        source_url,
+        target_bucket_name,
+        target_object_name,
+        expected_checksum=None,
+        part_size=READ_BLOCK_SIZE,
+        if_none_match=False):
+    """
+    Stream `source_url` into a multipart upload one part at a time; a dropped
+    source stream is resumed from the last byte received and failed parts are
+    retried.
+    """
+    hashlib_sha256 = hashlib.sha256()
+    stats = transfer_lib.TransferStats(mode='sequential')
+    reader = ResumableUrlReader(source_url)
+    transfer = MultipartTransfer(
+        client_lib.get_client('s3'), target_bucket_name, target_object_name, if_none_match=if_none_match)
 
     logger.info('Starting multipart upload and checksum validation')
     try:
-        for chunk in response.iter_content(chunk_size=READ_BLOCK_SIZE):
-            s3_part_count += 1
-            s3_uploader_part = s3_uploader.Part(s3_part_count)
-            s3_part_response = s3_uploader_part.upload(Body=chunk)
-            s3_parts[s3_key_parts].append(
-                {
-                    s3_key_part_number: s3_part_count,
-                    s3_key_etag: s3_part_response[s3_key_etag]
-                })
-
-            logger.debug(
-                f'Multipart upload part {s3_part_count} sent, '
-                f'ETag={s3_part_response[s3_key_etag]}')
+        transfer.initiate()
+        for part_number, chunk in enumerate(reader.iter_chunks(part_size), start=1):
+            stats.part_started()
+            transfer.upload_part(part_number, chunk)
+            stats.part_finished(len(chunk))
 
             if expected_checksum is not None:
                 hashlib_sha256.update(chunk)
                 logger.debug(f'Hash updated')
 
-        logger.info(f'Send multipart upload complete notification')
-        s3_uploader_result = s3_uploader.complete(MultipartUpload=s3_parts)
-        logger.debug(f's3_uploader_result={s3_uploader_result}')
-        if expected_checksum is not None:
-            hex_digest = hashlib_sha256.hexdigest()
-            logger.info(f'hexdigest         : "{hex_digest}"')
-            logger.info(f'expected_checksum : "{expected_checksum}"')
-            if hex_digest != expected_checksum:
-                raise ValueError(
-                    f'Invalid checksum; calculated "{hex_digest}" but '
-                    f'expected "{expected_checksum}" for URL {source_url}')
+        transfer.verify(
+            hex_digest=hashlib_sha256.hexdigest(),
+            expected_checksum=expected_checksum,
+            source_url=source_url)
+        transfer.complete()
     except Exception as e:
         logger.error(f'Error in copy_url_data_to_bucket: {e}')
         logger.exception(e)
-        logger.info('Abort multipart upload...')
-        s3_uploader.abort()
-        logger.debug('Multipart upload abort complete')
+        transfer.abort()
+        raise e
+    finally:
+        reader.close()
+
+    result = stats.as_dict()
+    result['resumes'] = reader.resume_count
+    return result
+
+
+def _url_to_s3_object_concurrent(
+        source_url,
+        target_bucket_name,
+        target_object_name,
+        content_length,
+        expected_checksum,
+        max_workers,
+        part_size,
+        max_in_flight_bytes,
+        if_none_match=False):
+    """
+    Copy `source_url` to s3 using ranged GETs and a pool of `UploadPart`
+    workers. Each part's bytes count against a `ByteBudget` from the start of
+    its download until it has been uploaded and (if required) hashed, which
+    bounds memory use to roughly `max_in_flight_bytes`. Hashing runs in part
+    order on its own thread. A failed ranged GET or upload is retried for
+    that part alone.
+    """
+    part_count = -(-content_length // part_size)
+    logger.info(
+        f'Starting concurrent copy: content_length={content_length} '
+        f'part_size={part_size} part_count={part_count}')
+
+    s3_client = client_lib.get_client(
+        's3', max_pool_connections=max(max_workers, client_lib.CLIENT_MAX_POOL_CONNECTIONS))
+    transfer = MultipartTransfer(s3_client, target_bucket_name, target_object_name, if_none_match=if_none_match)
+
+    stats = transfer_lib.TransferStats(mode='concurrent')
+    budget = transfer_lib.ByteBudget(max(max_in_flight_bytes, part_size))
+    hasher = None
+    if expected_checksum is not None:
+        hasher = transfer_lib.OrderedHasher(hashlib.sha256(), on_consumed=budget.release)
+
+    def get_range(part_number, start, end):
+        response = requests.get(source_url, headers={'Range': f'bytes={start}-{end}'})
+        if response.status_code != HTTP_STATUS_PARTIAL_CONTENT:
+            raise TransientTransferError(
+                f'Ranged GET for part {part_number} failed: '
+                f'response.status_code={response.status_code}')
+        data = response.content
+        if len(data) != end - start + 1:
+            raise TransientTransferError(
+                f'Ranged GET for part {part_number} returned {len(data)} '
+                f'bytes; expected {end - start + 1}')
+        return data
+
+    def transfer_part(part_number, start, end):
+        size = end - start + 1
+        try:
+            data = transfer.retry(
+                lambda: get_range(part_number, start, end),
+                description=f'GET part {part_number}')
+            transfer.upload_part(part_number, data)
+        except Exception:
+            failed.set()
+            stats.part_failed()
+            budget.release(size)
+            # Wake the submitting loop and free later parts held for hashing
+            budget.cancel()
+            if hasher:
+                hasher.cancel()
+            raise
+
+        stats.part_finished(size)
+        if hasher:
+            hasher.submit(part_number, data)  # hasher releases the budget
+        else:
+            budget.release(size)
+
+    futures = []
+    failed = threading.Event()
+    try:
+        transfer.initiate()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for part_index in range(part_count):
+                start = part_index * part_size
+                end = min(start + part_size, content_length) - 1
+                if not budget.acquire(end - start + 1):
+                    break
+                if failed.is_set():
+                    budget.release(end - start + 1)
+                    break
+                stats.part_started()
+                futures.append(executor.submit(transfer_part, part_index + 1, start, end))
+
+        for future in futures:
+            future.result()
+
+        transfer.verify(
+            hex_digest=hasher.close() if hasher else None,
+            expected_checksum=expected_checksum,
+            source_url=source_url,
+            part_count=part_count)
+        transfer.complete()
+    except Exception as e:
+        logger.error(f'Error in copy_url_data_to_bucket: {e}')
+        logger.exception(e)
+        if hasher:
+            hasher.abort()
+        transfer.abort()
         raise e
 
-    logger.info('copy_url_data_to_bucket end')
+    return stats.as_dict()
+
+
+def _s3_object_to_s3_object_copy(
+        source_url,
+        source_head,
+        target_bucket_name,
+        target_object_name,
+        expected_checksum,
+        max_workers,
+        if_none_match=False):
+    """
+    Copy an s3 object to the target with parallel `UploadPartCopy` requests so
+    no object data passes through the Lambda.
+
+    If `expected_checksum` is given it is checked against the SHA-256 s3
+    already holds for the source where available; otherwise the source is
+    read and hashed on a separate thread while the copy runs. The upload is
+    only completed once the checksum has been verified.
+    """
+    source_bucket = source_head['Bucket']
+    source_key = source_head['Key']
+    source_etag = source_head[S3_KEY_ETAG]
+    content_length = source_head['ContentLength']
+    part_size = _get_part_size(content_length, COPY_PART_SIZE)
+    part_count = -(-content_length // part_size)
+    logger.info(
+        f'Starting server side copy: source_bucket={source_bucket} '
+        f'source_key={source_key} content_length={content_length} '
+        f'part_size={part_size} part_count={part_count}')
+
+    s3_client = client_lib.get_client(
+        's3', max_pool_connections=max(max_workers, client_lib.CLIENT_MAX_POOL_CONNECTIONS))
+    transfer = MultipartTransfer(s3_client, target_bucket_name, target_object_name, if_none_match=if_none_match)
+    stats = transfer_lib.TransferStats(mode='server-side-copy')
+
+    def hash_source():
+        s3_object = s3_client.get_object(
+            Bucket=source_bucket, Key=source_key, IfMatch=source_etag)
+        hashlib_sha256 = hashlib.sha256()
+        for chunk in s3_object['Body'].iter_chunks(chunk_size=STREAM_READ_SIZE):
+            hashlib_sha256.update(chunk)
+        return hashlib_sha256.hexdigest()
+
+    def copy_part(part_number, start, end):
+        stats.part_started()
+        try:
+            transfer.upload_part_copy(
+                part_number, source_bucket, source_key, f'bytes={start}-{end}', source_etag)
+        except Exception:
+            stats.part_failed()
+            raise
+        stats.part_finished(end - start + 1)
+
+    hex_digest = None
+    verify_future = None
+    if expected_checksum is not None:
+        hex_digest = _get_s3_full_object_sha256(source_head)
+        logger.info(
+            'Verifying checksum using s3 held SHA-256' if hex_digest
+            else 'Verifying checksum with parallel read of source')
+
+    try:
+        transfer.initiate()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers + 1) as executor:
+            if expected_checksum is not None and hex_digest is None:
+                verify_future = executor.submit(hash_source)
+            futures = []
+            for part_index in range(part_count):
+                start = part_index * part_size
+                end = min(start + part_size, content_length) - 1
+                futures.append(executor.submit(copy_part, part_index + 1, start, end))
+            for future in futures:
+                future.result()
+            if verify_future is not None:
+                hex_digest = verify_future.result()
+
+        transfer.verify(
+            hex_digest=hex_digest,
+            expected_checksum=expected_checksum,
+            source_url=source_url,
+            part_count=part_count)
+        transfer.complete()
+    except Exception as e:
+        logger.error(f'Error in copy_url_data_to_bucket: {e}')
+        logger.exception(e)
+        transfer.abort()
+        raise e
+
+    return stats.as_dict()
 
 
 def string_to_s3_object(
         string,
         target_bucket_name,
         target_object_name,
-        allow_overwrite=False):
+        allow_overwrite=False,
+        conditional_write=False):
     """
     Copy the content of the supplied `string` into an object with name
     `target_object_name` in bucket `target_bucket_name`.
+
+    If `conditional_write` is True (and `allow_overwrite` is False) the
+    existence check is made by s3 as part of the PUT (`If-None-Match: *`)
+    rather than by a listing beforehand; `ObjectExistsError` is raised if
+    the object exists.
     """
     logger.info(
         f'string_to_s3_object start: string="{string}" '
         f'target_bucket_name="{target_bucket_name}" '
         f'target_object_name="{target_object_name}" '
-        f'allow_overwrite="{allow_overwrite}"')
+        f'allow_overwrite="{allow_overwrite}" '
+        f'conditional_write="{conditional_write}"')
+
+    if not allow_overwrite and conditional_write:
+        try:
+            client_lib.get_client('s3').put_object(
+                Bucket=target_bucket_name, Key=target_object_name, Body=string, IfNoneMatch='*')
+        except botocore.exceptions.ClientError as e:
+            if _is_precondition_failed(e):
+                raise ObjectExistsError(
+                    f'Copy not allowed; "{target_object_name}" already exists in bucket '
+                    f'"{target_bucket_name}"') from e
+            raise
+        logger.info('string_to_s3_object end')
+        return
 
     # Unless allow_overwrite is True, don't copy object if it already exists
     if not allow_overwrite:
         raise_error_if_object_exists(target_bucket_name, target_object_name)
 
-    s3r = boto3.resource('s3')
+    s3r = client_lib.get_resource('s3')
     s3r.Object(target_bucket_name, target_object_name).put(Body=string)
     logger.info('string_to_s3_object end')
 
 
+class IngestMarker:
+    """
+    Small per-object marker (`<object_name>.ingest-marker.json`) held while
+    an object is ingested, so that duplicate deliveries of the same ingest
+    are refused with one conditional PUT instead of repeating the transfer.
+
+    `acquire` creates the marker only if it does not exist
+    (`If-None-Match: *`). A marker left `IN_PROGRESS` by a run that died is
+    a lease: once older than `lease_seconds` it is taken over, conditional on
+    its ETag (`If-Match`) so only one of several racing runs wins. `complete`
+    records the ingest as done (releasing the marker if that fails, rather
+    than leaving it to block retries until the lease expires); `release`
+    removes the marker after a failure so that the ingest can be retried.
+
+    :param bucket_name: Bucket holding the ingested object
+    :param object_name: Name of the ingested object
+    :param lease_seconds: Age after which an `IN_PROGRESS` marker is stale
+    :param s3_client: Optionally pass an existing boto3.client('s3') instance
+    """
+
+    def __init__(self, bucket_name, object_name, lease_seconds=INGEST_LEASE_SECONDS, s3_client=None):
+        self.bucket_name = bucket_name
+        self.marker_name = object_name + INGEST_MARKER_SUFFIX
+        self.lease_seconds = lease_seconds
+        self.s3_client = s3_client or client_lib.get_client('s3')
+        self.source = None
+        self.etag = None
+
+    def _put(self, state, **conditions):
+        body = json.dumps({'state': state, 'source': self.source, 'updated': time.time()})
+        response = self.s3_client.put_object(
+            Bucket=self.bucket_name, Key=self.marker_name, Body=body.encode(ENCODING_UTF8),
+            ContentType='application/json', **conditions)
+        self.etag = response[S3_KEY_ETAG]
+
+    def acquire(self, source=None):
+        """
+        Take the marker, or raise `ObjectExistsError` if the ingest is
+        complete or held by another run.
+        """
+        logger.info(f'IngestMarker acquire: bucket={self.bucket_name} marker={self.marker_name}')
+        self.source = source
+        try:
+            self._put(INGEST_STATE_IN_PROGRESS, IfNoneMatch='*')
+            return
+        except botocore.exceptions.ClientError as e:
+            if not _is_precondition_failed(e):
+                raise
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.marker_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                raise
+            # Released since our PUT; one more attempt
+            self._put(INGEST_STATE_IN_PROGRESS, IfNoneMatch='*')
+            return
+        marker = json.loads(response['Body'].read())
+        age = time.time() - marker.get('updated', 0)
+        if marker.get('state') == INGEST_STATE_COMPLETE or age < self.lease_seconds:
+            raise ObjectExistsError(
+                f'Ingest not allowed; "{self.marker_name}" in bucket "{self.bucket_name}" is '
+                f'{marker.get("state")} (source {marker.get("source")}, updated {age:.0f}s ago)')
+        logger.warning(f'Taking over stale ingest marker {self.marker_name} ({age:.0f}s old)')
+        try:
+            self._put(INGEST_STATE_IN_PROGRESS, IfMatch=response[S3_KEY_ETAG])
+        except botocore.exceptions.ClientError as e:
+            if _is_precondition_failed(e):
+                raise ObjectExistsError(
+                    f'Ingest not allowed; "{self.marker_name}" was taken over by another run') from e
+            raise
+
+    def complete(self):
+        """
+        Mark the ingest as complete; later `acquire` calls are refused.
+        Transient errors are retried; if the marker still cannot be completed
+        it is released and the error raised.
+        """
+        try:
+            transfer_lib.retry_with_backoff(
+                lambda: self._put(INGEST_STATE_COMPLETE, IfMatch=self.etag),
+                description=f'{self.marker_name} complete',
+                max_attempts=PART_MAX_ATTEMPTS,
+                base_delay=PART_RETRY_BASE_DELAY_SECONDS,
+                is_retryable=_is_retryable_error)
+        except Exception:
+            self.release()
+            raise
+        logger.info(f'IngestMarker complete: marker={self.marker_name}')
+
+    def release(self):
+        """
+        Remove the marker (if still ours) so the ingest can be retried.
+        """
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.marker_name, IfMatch=self.etag)
+            logger.info(f'IngestMarker released: marker={self.marker_name}')
+        except botocore.exceptions.ClientError as e:
+            logger.warning(f'Unable to release ingest marker {self.marker_name}: {e}')
+
+
 def raise_error_if_object_exists(bucket, object_name):
     """
     Raise a ValueError if `object` exists in `bucket`.
@@ -224,34 +1031,28 @@ def raise_error_if_object_exists(bucket, object_name):
 def s3_object_to_dictionary(s3_bucket, s3_key, separator=':'):
     """
     Split each line in s3 object `s3_key` in `s3_bucket` using the left-most
-    `separator`.
+    `separator`. The object is read line by line.
     """
     logger.info(f's3_object_to_dictionary start: s3_bucket={s3_bucket} s3_key={s3_key}')
-    dictionary = {}
-    s3_client = boto3.client('s3')
+    s3_client = client_lib.get_client('s3')
     s3o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    reader = codecs.getreader(ENCODING_UTF8)
-    for line in reader(s3o['Body']):
-        columns = line.rstrip().split(separator, 1)
-        if len(columns) > 0:
-            key = columns[0].strip()
-            value = None if len(columns) < 2 else columns[1].strip()
-            dictionary[key] = value
+    dictionary = dict(row_lib.iter_property_items(s3o['Body'], separator=separator))
     logger.info('s3_object_to_dictionary return')
     return dictionary
 
 
-def s3_object_to_csv(s3_bucket, s3_key):
+def s3_object_to_csv(s3_bucket, s3_key, empty_as_none=False, batch_size=None):
     """
-    Get s3 object `s3_key' in `s3_bucket` as csv.
+    Return a generator of the records (dictionaries) of csv s3 object
+    `s3_key` in `s3_bucket`, or of lists of up to `batch_size` records. The
+    object is streamed and its body closed once the generator is exhausted
+    or closed. If `empty_as_none` is True empty values are returned as None.
     """
     logger.info(f's3_object_to_csv start: s3_bucket={s3_bucket} s3_key={s3_key}')
-    s3_client = boto3.client('s3')
+    s3_client = client_lib.get_client('s3')
     s3o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    reader = codecs.getreader(ENCODING_UTF8)
-    csv_data = csv.DictReader(reader(s3o['Body']))
     logger.info('s3_object_to_csv return')
-    return csv_data
+    return row_lib.iter_csv_rows(s3o['Body'], empty_as_none=empty_as_none, batch_size=batch_size)
 
 
 def get_s3_object_presigned_url(bucket, key, expiry):
@@ -262,7 +1063,7 @@ def get_s3_object_presigned_url(bucket, key, expiry):
     logger.info(
         f'get_s3_object_presigned_url start: bucket={bucket} '
         f'key={key} expiry={expiry}')
-    s3c = boto3.client('s3')
+    s3c = client_lib.get_client('s3')
     logger.info(f'get_s3_object_presigned_url return')
     return s3c.generate_presigned_url(
         'get_object',
@@ -276,7 +1077,7 @@ def get_object(bucket, key):
     Return S3 object `key` from `bucket`, or raise error with object context.
     """
     logger.info(f'get_object bucket={bucket} key={key}')
-    s3c = boto3.client('s3')
+    s3c = client_lib.get_client('s3')
 
     try:
         logger.info(f'get_object return')
@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+"""
+Writes documents to OpenSearch with the `_bulk` API. Documents are sent in
+batches flushed by document count and by request size; each item's result
+is checked and only the items that failed with a retryable status (e.g.
+429 when the cluster is busy) are sent again.
+
+Requests go through a `WriteClient`, shared across warm invocations, which
+adapts the number of requests in flight to the cluster's capacity (additive
+increase, multiplicative decrease on 429/5xx), retries with exponential
+backoff and full jitter (honouring `Retry-After`), stops sending for a
+while once requests keep failing (circuit breaker), and records latency
+histograms. `BulkWriter` does its own retries of both whole requests and
+items, so each of its requests is sent once by the client.
+"""
+import concurrent.futures
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+import requests
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BULK_MAX_DOCUMENTS = int(os.getenv('AYR_OPENSEARCH_BULK_MAX_DOCUMENTS', default=500))
+BULK_MAX_BYTES = int(os.getenv('AYR_OPENSEARCH_BULK_MAX_BYTES', default=5 * 1024 * 1024))
+BULK_MAX_RETRIES = int(os.getenv('AYR_OPENSEARCH_BULK_MAX_RETRIES', default=5))
+MAX_CONCURRENCY = int(os.getenv('AYR_OPENSEARCH_MAX_CONCURRENCY', default=8))
+INITIAL_CONCURRENCY = int(os.getenv('AYR_OPENSEARCH_INITIAL_CONCURRENCY', default=2))
+REQUEST_MAX_RETRIES = int(os.getenv('AYR_OPENSEARCH_REQUEST_MAX_RETRIES', default=5))
+REQUEST_TIMEOUT_SECONDS = float(os.getenv('AYR_OPENSEARCH_REQUEST_TIMEOUT_SECONDS', default=60))
+BACKOFF_BASE_SECONDS = float(os.getenv('AYR_OPENSEARCH_BACKOFF_BASE_SECONDS', default=0.5))
+BACKOFF_MAX_SECONDS = float(os.getenv('AYR_OPENSEARCH_BACKOFF_MAX_SECONDS', default=30))
+BREAKER_FAILURES = int(os.getenv('AYR_OPENSEARCH_BREAKER_FAILURES', default=5))
+BREAKER_RESET_SECONDS = float(os.getenv('AYR_OPENSEARCH_BREAKER_RESET_SECONDS', default=30))
+RETRYABLE_STATUSES = frozenset([429, 502, 503, 504])
+# 429 is backpressure from a working cluster, so only these count towards
+# opening the circuit
+BREAKER_STATUSES = frozenset([502, 503, 504])
+CONTENT_TYPE_NDJSON = 'application/x-ndjson'
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+OUTCOME_OK = 'ok'
+OUTCOME_OVERLOADED = 'overloaded'
+OUTCOME_ERROR = 'error'
+
+# Kept across warm invocations for connection reuse and learnt concurrency
+_session = None
+_write_client = None
+_lock = threading.Lock()
+
+
+class OpenSearchBulkError(Exception):
+    """
+    Used to indicate an OpenSearch bulk write specific error condition.
+    """
+
+
+class OpenSearchCircuitOpenError(Exception):
+    """
+    Used to indicate requests are not being sent because OpenSearch requests
+    have been failing.
+    """
+
+
+def get_session() -> requests.Session:
+    """
+    Return the process wide `requests.Session`, so connections to OpenSearch
+    are reused; it keeps up to `MAX_CONCURRENCY` connections per host.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENCY)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_write_client():
+    """
+    Return the process wide `WriteClient`, created on first use.
+    """
+    global _write_client
+    session = get_session()
+    with _lock:
+        if _write_client is None:
+            _write_client = WriteClient(session=session)
+        return _write_client
+
+
+def parse_retry_after(value: str, now: float = None):
+    """
+    Return the seconds to wait given a `Retry-After` header value (seconds
+    or an HTTP date), or `None` if `value` is empty or not understood.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at - (time.time() if now is None else now))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on concurrent requests: each request completed without
+    overload adds `1 / limit` (so the limit grows by one per window of
+    requests), and an overload multiplies it by `decrease_factor`. Only one
+    decrease is made per congestion event: overloads of requests started
+    before the last decrease are ignored.
+    """
+
+    def __init__(self, initial: int = INITIAL_CONCURRENCY, minimum: int = 1, maximum: int = MAX_CONCURRENCY,
+                 decrease_factor: float = 0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> int:
+        """
+        Wait for a free slot; return a token to pass to `release`.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._generation
+
+    def release(self, token: int, overloaded: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                if token == self._generation:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._generation += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed requests (each
+    counted once, after its own retries), failing requests
+    at once for `reset_seconds`; then lets one trial request through, which
+    closes it again on success or reopens it on failure.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        :raises OpenSearchCircuitOpenError: If requests are not to be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self._opened_at + self.reset_seconds - self.clock()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                return
+            raise OpenSearchCircuitOpenError(
+                f'OpenSearch circuit {self.state} after {self.failures} failure(s); '
+                f'retry in {max(remaining, 0):.1f}s')
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f'Opening OpenSearch circuit after {self.failures} failure(s)')
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+
+class LatencyHistogram:
+    """
+    Counts of request latencies in `LATENCY_BUCKETS_MS` buckets (plus one for
+    anything slower).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        milliseconds = seconds * 1000
+        index = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if milliseconds <= bound), len(LATENCY_BUCKETS_MS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += milliseconds
+
+    def percentile(self, fraction: float):
+        """
+        Return the upper bound (ms) of the bucket holding the `fraction`
+        percentile (`None` if empty or beyond the last bucket).
+        """
+        with self._lock:
+            target = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= target:
+                    return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+    def summary(self) -> dict:
+        labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 1) if self.count else None,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'buckets': {label: count for label, count in zip(labels, self.counts) if count}
+        }
+
+
+class WriteClient:
+    """
+    Sends OpenSearch write requests with adaptive concurrency, retries and a
+    circuit breaker. Thread safe; share one client between writers so they
+    share what has been learnt about the cluster's capacity.
+
+    :param session: Optional `requests.Session`; defaults to `get_session()`
+    :param max_concurrency: Largest number of requests in flight
+    :param initial_concurrency: Starting number of requests in flight
+    :param max_retries: Retries of a request failing with a retryable status
+    or connection error
+    :param backoff_base_seconds: Largest delay before the first retry; doubled
+    for each further retry (the delay is random up to this: full jitter)
+    :param backoff_max_seconds: Largest delay, including from `Retry-After`
+    :param timeout_seconds: Request timeout
+    :param breaker: Optional `CircuitBreaker`
+    :param sleep: Optional sleep function (for tests)
+    :param clock: Optional function returning seconds (for tests)
+    :param rng: Optional `random.Random` (for tests)
+    """
+
+    def __init__(self, session: requests.Session = None, max_concurrency: int = MAX_CONCURRENCY,
+                 initial_concurrency: int = INITIAL_CONCURRENCY, max_retries: int = REQUEST_MAX_RETRIES,
+                 backoff_base_seconds: float = BACKOFF_BASE_SECONDS, backoff_max_seconds: float = BACKOFF_MAX_SECONDS,
+                 timeout_seconds: float = REQUEST_TIMEOUT_SECONDS, breaker: CircuitBreaker = None,
+                 sleep=time.sleep, clock=time.monotonic, rng: random.Random = None):
+        self.session = session or get_session()
+        self.max_concurrency = max_concurrency
+        self.limiter = AdaptiveLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.timeout_seconds = timeout_seconds
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.latency = {outcome: LatencyHistogram() for outcome in (OUTCOME_OK, OUTCOME_OVERLOADED, OUTCOME_ERROR)}
+        self._stats = {'requests': 0, 'retries': 0, 'overloads': 0}
+        self._lock = threading.Lock()
+
+    def get_retry_delay(self, attempt: int, retry_after: float = None) -> float:
+        """
+        Return the delay before retry `attempt` (0 for the first retry):
+        random up to the exponential backoff, but no less than `retry_after`;
+        at most `backoff_max_seconds`.
+        """
+        delay = self.rng.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.backoff_max_seconds)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def post(self, url: str, data: bytes, headers: dict = None, auth=None, verify: bool = True,
+             overloaded=None, max_retries: int = None) -> requests.Response:
+        """
+        POST `data` to `url`, retrying responses with a retryable status and
+        connection errors. Returns the last response, which may still have a
+        retryable status once retries are used up. The circuit breaker sees
+        the request's final outcome only.
+
+        :param overloaded: Optional function of a response returning whether
+        it shows the cluster overloaded other than by its status (e.g. bulk
+        items rejected with 429); such responses are not retried but reduce
+        the concurrency
+        :param max_retries: Retries for this request; defaults to the
+        client's
+        :raises OpenSearchCircuitOpenError: If the circuit breaker is open
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        self.breaker.before_request()
+        for attempt in range(max_retries + 1):
+            token = self.limiter.acquire()
+            start = self.clock()
+            response = error = None
+            try:
+                try:
+                    response = self.session.post(
+                        url, data=data, headers=headers, auth=auth, verify=verify, timeout=self.timeout_seconds)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                failed = response is None or response.status_code in RETRYABLE_STATUSES
+                is_overloaded = failed or bool(overloaded and overloaded(response))
+            except Exception:
+                # Any other error (e.g. a broken response body) ends the
+                # request; free its slot and settle a half open circuit
+                self.limiter.release(token)
+                self.breaker.record_failure()
+                raise
+            elapsed = self.clock() - start
+            self.limiter.release(token, overloaded=is_overloaded)
+            self._count('requests')
+            if is_overloaded:
+                self._count('overloads')
+            self.latency[
+                OUTCOME_ERROR if response is None else OUTCOME_OVERLOADED if is_overloaded else OUTCOME_OK
+            ].record(elapsed)
+
+            if not failed:
+                self.breaker.record_success()
+                return response
+            if attempt == max_retries:
+                if response is None or response.status_code in BREAKER_STATUSES:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if error is not None:
+                    raise error
+                return response
+            retry_after = None if response is None else parse_retry_after(response.headers.get('Retry-After'))
+            delay = self.get_retry_delay(attempt, retry_after)
+            logger.warning(
+                f'OpenSearch request failed ({error or response.status_code}); retry {attempt + 1} in {delay:.2f}s')
+            self._count('retries')
+            self.sleep(delay)
+
+    def get_stats(self) -> dict:
+        """
+        Return request counts, the current concurrency limit, the circuit
+        breaker state and latency histograms by outcome.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['concurrency_limit'] = round(self.limiter.limit, 2)
+        stats['circuit'] = self.breaker.state
+        stats['latency'] = {outcome: histogram.summary() for outcome, histogram in self.latency.items()}
+        return stats
+
+
+class BulkWriter:
+    """
+    Buffers documents and indexes them with `_bulk` requests to
+    `{url}{index}/_bulk`; an existing document with the same id is replaced,
+    as with `PUT {index}/_doc/{id}`. Batches are sent concurrently, as many
+    at a time as the `WriteClient` allows. Use as a context manager, or call
+    `close` after the last `add`, to send the final batch and raise if any
+    document could not be indexed.
+
+    :param url: OpenSearch base URL, ending in `/`
+    :param index: Index name
+    :param auth: `requests` auth (e.g. (user, password))
+    :param verify: Whether to verify the server's SSL certificate
+    :param max_documents: Largest number of documents per request
+    :param max_bytes: Largest request body; a single larger document is
+    sent on its own
+    :param max_retries: Times a failed request, or its failed items, are
+    retried (with the client's backoff, waiting at least any `Retry-After`)
+    :param client: Optional `WriteClient`; defaults to `get_write_client()`
+    """
+
+    def __init__(self, url: str, index: str, auth=None, verify: bool = True,
+                 max_documents: int = BULK_MAX_DOCUMENTS, max_bytes: int = BULK_MAX_BYTES,
+                 max_retries: int = BULK_MAX_RETRIES, client: WriteClient = None):
+        if max_documents < 1:
+            raise ValueError(f'max_documents must be at least 1; got {max_documents}')
+        self.bulk_url = f'{url}{index}/_bulk'
+        self.auth = auth
+        self.verify = verify
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.client = client or get_write_client()
+        self.errors = []
+        self.stats = {'documents': 0, 'requests': 0, 'retried_items': 0, 'failed_items': 0}
+        self._batch = []  # [(document id, action and document lines)]
+        self._batch_bytes = 0
+        self._executor = None
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+    def add(self, document_id: str, document):
+        """
+        Queue `document` (a dict, or a JSON string) to be indexed with id
+        `document_id`; sends the current batch first if the document would
+        take it over either limit.
+        """
+        if not isinstance(document, str):
+            document = json.dumps(document)
+        action = json.dumps({'index': {'_id': document_id}})
+        item = f'{action}\n{document}\n'.encode()
+        if self._batch and (
+                len(self._batch) >= self.max_documents or self._batch_bytes + len(item) > self.max_bytes):
+            self.flush()
+        self._batch.append((document_id, item))
+        self._batch_bytes += len(item)
+        self.stats['documents'] += 1
+
+    def _add_stat(self, name: str, count: int):
+        with self._lock:
+            self.stats[name] += count
+
+    def _add_error(self, document_id: str, status, error):
+        with self._lock:
+            self.errors.append({'_id': document_id, 'status': status, 'error': error})
+            self.stats['failed_items'] += 1
+
+    def _post(self, items: list) -> tuple:
+        """
+        Send one `_bulk` request; return the items to retry and the seconds
+        the cluster asked to wait (or `None`).
+        """
+        parsed = {}
+
+        def overloaded(response):
+            # Items rejected with 429 (full write queues) mean the cluster is busy
+            if response.status_code != 200:
+                return False
+            parsed['json'] = response.json()
+            return bool(parsed['json'].get('errors')) and any(
+                next(iter(result.values())).get('status') == 429 for result in parsed['json']['items'])
+
+        try:
+            response = self.client.post(
+                self.bulk_url, data=b''.join(item for _, item in items), auth=self.auth, verify=self.verify,
+                headers={'Content-Type': CONTENT_TYPE_NDJSON}, overloaded=overloaded, max_retries=0)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(f'Bulk request of {len(items)} item(s) failed: {e}')
+            return items, None
+        self._add_stat('requests', 1)
+        if response.status_code in RETRYABLE_STATUSES:
+            logger.warning(f'Bulk request of {len(items)} item(s) failed with status {response.status_code}')
+            return items, parse_retry_after(response.headers.get('Retry-After'))
+        response.raise_for_status()
+        response_json = parsed['json'] if 'json' in parsed else response.json()
+        if not response_json.get('errors'):
+            return [], None
+
+        results = response_json['items']
+        if len(results) != len(items):
+            raise OpenSearchBulkError(f'Bulk response has {len(results)} item(s) for {len(items)} sent')
+        retry = []
+        for item, result in zip(items, results):
+            result = next(iter(result.values()))
+            status = result.get('status', 0)
+            if status < 300:
+                continue
+            if status in RETRYABLE_STATUSES:
+                retry.append(item)
+            else:
+                self._add_error(item[0], status, result.get('error'))
+        return retry, None
+
+    def _send(self, items: list):
+        """
+        Send a batch, retrying the request, or the items in it, that fail with
+        a retryable status; items that still fail are recorded in `errors`.
+        """
+        retry_after = None
+        for attempt in range(self.max_retries + 1):
+            if not items:
+                return
+            if attempt:
+                self._add_stat('retried_items', len(items))
+                self.client.sleep(self.client.get_retry_delay(attempt - 1, retry_after))
+            items, retry_after = self._post(items)
+        for document_id, _ in items:
+            self._add_error(document_id, None, 'retries exhausted')
+
+    def _check_futures(self, wait_all: bool = False):
+        if wait_all:
+            concurrent.futures.wait(self._futures)
+        done = [future for future in self._futures if future.done()]
+        self._futures = [future for future in self._futures if not future.done()]
+        for future in done:
+            future.result()  # raise any error from the batch
+
+    def flush(self):
+        """
+        Send the current batch; on a separate thread unless the client
+        allows only one request at a time. Waits first if as many batches
+        as the client's largest concurrency are already being sent.
+        """
+        items = self._batch
+        self._batch = []
+        self._batch_bytes = 0
+        if not items:
+            return
+        if self.client.max_concurrency <= 1:
+            self._send(items)
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.client.max_concurrency)
+        self._check_futures()
+        if len(self._futures) >= self.client.max_concurrency:
+            concurrent.futures.wait(self._futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            self._check_futures()
+        self._futures.append(self._executor.submit(self._send, items))
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def close(self):
+        """
+        Send the final batch and wait for all batches to be sent.
+
+        :raises OpenSearchBulkError: If any document was not indexed
+        """
+        try:
+            self.flush()
+            self._check_futures(wait_all=True)
+        finally:
+            self._shutdown()
+        logger.info(f'Bulk write to {self.bulk_url}: {self.stats}')
+        if self.errors:
+            raise OpenSearchBulkError(
+                f'{len(self.errors)} document(s) not indexed; first errors: {self.errors[:5]}')
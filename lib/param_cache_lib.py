@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Parameter Store cache shared by the lambdas. Values are kept per process
+(so across warm Lambda invocations) for a per-key TTL; after the TTL the
+stale value is still returned, for up to `stale_seconds`, while it is
+refreshed on a background thread. A Lambda's threads are frozen between
+invocations, so a refresh still outstanding a whole TTL later is done again
+by the caller instead. Cold starts can fetch several parameters
+in batched `get_parameters` calls with `prefetch`; the process wide cache
+prefetches the comma separated names in env var AYR_PARAM_CACHE_PREFETCH
+when it is created.
+"""
+import logging
+import os
+import threading
+import time
+import client_lib
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PARAM_CACHE_TTL_SECONDS = int(os.getenv('AYR_PARAM_CACHE_TTL_SECONDS', default=300))
+PARAM_CACHE_STALE_SECONDS = int(os.getenv('AYR_PARAM_CACHE_STALE_SECONDS', default=3600))
+PARAM_CACHE_PREFETCH = [
+    name.strip() for name in os.getenv('AYR_PARAM_CACHE_PREFETCH', default='').split(',') if name.strip()]
+GET_PARAMETERS_MAX_NAMES = 10  # Parameter Store limit per get_parameters call
+KEY_VALUE = 'Value'
+KEY_VERSION = 'Version'
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+class ParamCacheError(Exception):
+    """
+    Used to indicate a parameter cache specific error condition.
+    """
+
+
+class _Entry:
+    __slots__ = ('parameter', 'expires', 'ttl_seconds', 'refreshing', 'refresh_started')
+
+    def __init__(self, parameter: dict, expires: float, ttl_seconds: float):
+        self.parameter = parameter
+        self.expires = expires
+        self.ttl_seconds = ttl_seconds
+        self.refreshing = False
+        self.refresh_started = None
+
+
+class ParamCache:
+    """
+    Thread safe cache of Parameter Store parameters, keyed by name and
+    whether the value is decrypted.
+
+    :param ttl_seconds: Default time a fetched value is used unchecked
+    :param stale_seconds: Time after the TTL a value is still returned while
+    it is refreshed in the background; after that callers wait for a fetch
+    :param ssm_client: Optional boto3 ssm client; defaults to the shared
+    `client_lib` client
+    :param clock: Optional function returning seconds (for tests)
+    :param background: Refresh stale values on a background thread; if
+    `False` (or if a background refresh has been outstanding for the TTL)
+    they are refreshed before being returned
+    """
+
+    def __init__(self, ttl_seconds: float = PARAM_CACHE_TTL_SECONDS,
+                 stale_seconds: float = PARAM_CACHE_STALE_SECONDS, ssm_client=None,
+                 clock=time.monotonic, background: bool = True):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.clock = clock
+        self.background = background
+        self._ssm_client = ssm_client
+        self._entries = {}
+        self._fetch_locks = {}
+        self._refresh_threads = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0, 'batch_requests': 0}
+
+    @property
+    def ssm_client(self):
+        if self._ssm_client is None:
+            self._ssm_client = client_lib.get_client('ssm')
+        return self._ssm_client
+
+    def _fetch(self, name: str, decrypt: bool) -> dict:
+        parameter = self.ssm_client.get_parameter(Name=name, WithDecryption=decrypt)['Parameter']
+        return {KEY_VALUE: parameter[KEY_VALUE], KEY_VERSION: parameter.get(KEY_VERSION)}
+
+    def _store(self, key: tuple, parameter: dict, ttl_seconds: float):
+        with self._lock:
+            self._entries[key] = _Entry(parameter, self.clock() + ttl_seconds, ttl_seconds)
+
+    def _refresh(self, key: tuple, entry: _Entry):
+        """
+        Fetch `key` again and return it, replacing `entry` unless that has
+        since been invalidated or replaced (e.g. by a later refresh); return
+        `None` if the fetch fails.
+        """
+        try:
+            parameter = self._fetch(*key)
+        except Exception as e:
+            # Keep serving the stale value until it expires completely
+            logger.warning(f'Refresh of parameter "{key[0]}" failed: {e}')
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+                entry.refreshing = False
+            return None
+        with self._lock:
+            self._stats['refreshes'] += 1
+            if self._entries.get(key) is entry:
+                self._entries[key] = _Entry(parameter, self.clock() + entry.ttl_seconds, entry.ttl_seconds)
+        return parameter
+
+    def get_parameter(self, name: str, decrypt: bool = True, ttl_seconds: float = None) -> dict:
+        """
+        Return {'Value': ..., 'Version': ...} for parameter `name`.
+
+        :param name: Parameter name
+        :param decrypt: Whether to decrypt a SecureString value
+        :param ttl_seconds: TTL for this parameter; defaults to the cache's
+        """
+        key = (name, decrypt)
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        refresh = None
+        with self._lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.expires:
+                self._stats['hits'] += 1
+                return entry.parameter
+            if entry is not None and now < entry.expires + self.stale_seconds:
+                self._stats['stale_hits'] += 1
+                if entry.refreshing and now < entry.refresh_started + entry.ttl_seconds:
+                    return entry.parameter
+                # A refresh outstanding for a whole TTL is taken to be stuck
+                # (its thread frozen with the Lambda), so it is done here
+                synchronous = entry.refreshing or not self.background
+                entry.refreshing = True
+                entry.refresh_started = now
+                if not synchronous:
+                    thread = threading.Thread(target=self._refresh, args=(key, entry), daemon=True)
+                    self._refresh_threads = [t for t in self._refresh_threads if t.is_alive()] + [thread]
+                    thread.start()
+                    return entry.parameter
+                refresh = entry
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        if refresh is not None:
+            parameter = self._refresh(key, refresh)
+            return refresh.parameter if parameter is None else parameter
+
+        # One fetch per key; concurrent callers wait for it
+        with fetch_lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() < entry.expires:
+                with self._lock:
+                    self._stats['hits'] += 1
+                return entry.parameter
+            logger.info(f'Fetching parameter "{name}"')
+            parameter = self._fetch(name, decrypt)
+            self._store(key, parameter, ttl_seconds)
+            with self._lock:
+                self._stats['misses'] += 1
+            return parameter
+
+    def get_value(self, name: str, decrypt: bool = True, ttl_seconds: float = None) -> str:
+        """
+        Return the value of parameter `name`; see `get_parameter`.
+        """
+        return self.get_parameter(name, decrypt=decrypt, ttl_seconds=ttl_seconds)[KEY_VALUE]
+
+    def prefetch(self, names: list, decrypt: bool = True, ttl_seconds: float = None):
+        """
+        Fetch the parameters in `names` that are not cached (or have expired)
+        with as few `get_parameters` calls as possible; e.g. on a cold start.
+
+        :raises ParamCacheError: If any of `names` does not exist
+        """
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            now = self.clock()
+            missing = [
+                name for name in dict.fromkeys(names)
+                if (name, decrypt) not in self._entries or now >= self._entries[(name, decrypt)].expires]
+        invalid = []
+        for index in range(0, len(missing), GET_PARAMETERS_MAX_NAMES):
+            response = self.ssm_client.get_parameters(
+                Names=missing[index:index + GET_PARAMETERS_MAX_NAMES], WithDecryption=decrypt)
+            with self._lock:
+                self._stats['batch_requests'] += 1
+                self._stats['misses'] += len(response['Parameters'])
+            for parameter in response['Parameters']:
+                self._store(
+                    (parameter['Name'], decrypt),
+                    {KEY_VALUE: parameter[KEY_VALUE], KEY_VERSION: parameter.get(KEY_VERSION)}, ttl_seconds)
+            invalid.extend(response.get('InvalidParameters', []))
+        if invalid:
+            raise ParamCacheError(f'Parameter(s) not found: {invalid}')
+
+    def invalidate(self, name: str = None):
+        """
+        Drop `name` (or, if `None`, every parameter) from the cache.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if name is None or key[0] == name:
+                    del self._entries[key]
+
+    def wait_for_refreshes(self, timeout: float = None):
+        """
+        Wait for background refreshes in progress to finish (e.g. in tests).
+        """
+        with self._lock:
+            threads = list(self._refresh_threads)
+        for thread in threads:
+            thread.join(timeout)
+
+    def get_stats(self) -> dict:
+        """
+        Return counts of hits (fresh and stale), misses, background refreshes
+        and batched fetches.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+def get_cache() -> ParamCache:
+    """
+    Return the process wide `ParamCache`, created on first use (when the
+    parameters in `PARAM_CACHE_PREFETCH` are fetched).
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ParamCache()
+            if PARAM_CACHE_PREFETCH:
+                try:
+                    _default_cache.prefetch(PARAM_CACHE_PREFETCH)
+                except ParamCacheError as e:
+                    logger.warning(f'Prefetch failed: {e}')
+        return _default_cache
+
+
+def get_parameter(name: str, decrypt: bool = True, ttl_seconds: float = None) -> dict:
+    return get_cache().get_parameter(name, decrypt=decrypt, ttl_seconds=ttl_seconds)
+
+
+def get_value(name: str, decrypt: bool = True, ttl_seconds: float = None) -> str:
+    return get_cache().get_value(name, decrypt=decrypt, ttl_seconds=ttl_seconds)
+
+
+def prefetch(names: list, decrypt: bool = True, ttl_seconds: float = None):
+    get_cache().prefetch(names, decrypt=decrypt, ttl_seconds=ttl_seconds)
+
+
+def get_stats() -> dict:
+    return get_cache().get_stats()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Bag department to AYR role mapping for the role assigner. The JSON mapping
+list is compiled once into a dictionary of departments (plus any ordered
+pattern rules) and, when loaded from Parameter Store (through
+`param_cache_lib`), compiled again only when the parameter's version changes.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import param_cache_lib
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ROLE_MAP_TTL_SECONDS = int(os.getenv('AYR_ROLE_MAP_TTL_SECONDS', default=300))
+KEY_BAG_DEPARTMENT = 'bag_department'
+KEY_BAG_DEPARTMENT_PATTERN = 'bag_department_pattern'
+KEY_AYR_ROLE = 'ayr_role'
+
+
+class RoleMapError(Exception):
+    """
+    Used to indicate a role map specific error condition.
+    """
+
+
+class RoleMap:
+    """
+    Compiled role map. Each entry of `role_map_list` maps either a
+    `bag_department` (compared after stripping surrounding whitespace) or a
+    `bag_department_pattern` (a regular expression that must match the
+    whole department) to an `ayr_role`:
+
+        [
+            {"bag_department": "Testing A", "ayr_role": "department_a_role"},
+            {"bag_department_pattern": "Testing [BC]", "ayr_role": "department_bc_role"}
+        ]
+
+    Departments are looked up first; patterns are then tried in list order.
+    Where a department is listed more than once the first entry is used.
+
+    :param role_map_list: List of mapping entries
+    :param version: Optional version of the source (e.g. parameter version)
+    """
+    __slots__ = ('departments', 'patterns', 'version')
+
+    def __init__(self, role_map_list: list, version=None):
+        self.departments = {}
+        self.patterns = []
+        self.version = version
+        for index, entry in enumerate(role_map_list):
+            if KEY_AYR_ROLE not in entry:
+                raise RoleMapError(f'Role map entry {index} has no "{KEY_AYR_ROLE}"')
+            role = str(entry[KEY_AYR_ROLE]).strip()
+            if KEY_BAG_DEPARTMENT in entry:
+                self.departments.setdefault(str(entry[KEY_BAG_DEPARTMENT]).strip(), role)
+            elif KEY_BAG_DEPARTMENT_PATTERN in entry:
+                try:
+                    self.patterns.append((re.compile(entry[KEY_BAG_DEPARTMENT_PATTERN]), role))
+                except re.error as e:
+                    raise RoleMapError(f'Invalid pattern in role map entry {index}: {e}')
+            else:
+                raise RoleMapError(
+                    f'Role map entry {index} has neither "{KEY_BAG_DEPARTMENT}" nor "{KEY_BAG_DEPARTMENT_PATTERN}"')
+
+    @classmethod
+    def from_json(cls, text: str, version=None):
+        return cls(json.loads(text), version=version)
+
+    def get_role(self, department: str):
+        """
+        Return the AYR role for `department`, or `None` if it is not mapped.
+        """
+        department = str(department).strip()
+        role = self.departments.get(department)
+        if role is not None:
+            return role
+        for pattern, role in self.patterns:
+            if pattern.fullmatch(department):
+                return role
+        return None
+
+
+class RoleMapCache:
+    """
+    Thread safe cache of the `RoleMap` in Parameter Store parameter
+    `param_store_key`. The parameter is read through a `ParamCache`, so
+    within `ttl_seconds` no calls are made and after that it is refreshed in
+    the background; the role map is only compiled again when the parameter's
+    version has changed.
+
+    :param param_store_key: Parameter name
+    :param ttl_seconds: TTL of the parameter in the cache
+    :param param_cache: Optional `ParamCache`; defaults to the process wide
+    cache
+    """
+
+    def __init__(self, param_store_key: str, ttl_seconds: float = ROLE_MAP_TTL_SECONDS,
+                 param_cache: param_cache_lib.ParamCache = None):
+        self.param_store_key = param_store_key
+        self.ttl_seconds = ttl_seconds
+        self.param_cache = param_cache or param_cache_lib.get_cache()
+        self.stats = {'hits': 0, 'loads': 0}
+        self._role_map = None
+        self._lock = threading.Lock()
+
+    def get(self) -> RoleMap:
+        parameter = self.param_cache.get_parameter(self.param_store_key, ttl_seconds=self.ttl_seconds)
+        version = parameter[param_cache_lib.KEY_VERSION]
+        with self._lock:
+            if self._role_map is not None and self._role_map.version == version:
+                self.stats['hits'] += 1
+                return self._role_map
+            self.stats['loads'] += 1
+            self._role_map = RoleMap.from_json(parameter[param_cache_lib.KEY_VALUE], version=version)
+            logger.info(
+                f'Loaded role map "{self.param_store_key}" version {version}: '
+                f'{len(self._role_map.departments)} department(s), {len(self._role_map.patterns)} pattern(s)')
+            return self._role_map
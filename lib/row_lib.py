@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Streaming row iterators for the text files in a bag (CSV, property and
+checksum files). Bodies (e.g. an s3 `StreamingBody`) are read and decoded
+incrementally, so only the current chunk and row are held in memory, and are
+closed as soon as iteration finishes or the generator is closed.
+"""
+import codecs
+import csv
+import re
+
+ENCODING_UTF8 = 'utf-8'
+ROW_READ_SIZE = 64 * 1024
+PROPERTY_SEPARATOR = ':'
+LINE_END_PATTERN = re.compile(r'\r\n|\r|\n')
+BYTE_LINE_END_PATTERN = re.compile(rb'\r\n|\r|\n')
+MANIFEST_PATH_ESCAPE_PATTERN = re.compile('%(0D|0A|25)', re.IGNORECASE)
+
+
+def iter_text_lines(body, encoding: str = ENCODING_UTF8, read_size: int = ROW_READ_SIZE):
+    """
+    Yield the lines of `body` (anything with a `read(size)` method returning
+    bytes) decoded as `encoding`, with their line endings (`\\n`, `\\r\\n` or
+    `\\r`). `body` is closed when the generator finishes or is closed.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    try:
+        while True:
+            data = body.read(read_size)
+            final = not data
+            pending += decoder.decode(data, final=final)
+            start = 0
+            for match in LINE_END_PATTERN.finditer(pending):
+                if match.group() == '\r' and match.end() == len(pending) and not final:
+                    break  # may be the first half of '\r\n'
+                yield pending[start:match.end()]
+                start = match.end()
+            pending = pending[start:]
+            if final:
+                if pending:
+                    yield pending
+                return
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+def iter_byte_lines(body, read_size: int = ROW_READ_SIZE):
+    """
+    As `iter_text_lines`, but yield each line undecoded, as bytes. Line ends
+    never occur inside a UTF-8 multi-byte character, so reading may start at
+    any byte offset.
+    """
+    pending = b''
+    try:
+        while True:
+            data = body.read(read_size)
+            final = not data
+            pending += data
+            start = 0
+            for match in BYTE_LINE_END_PATTERN.finditer(pending):
+                if match.group() == b'\r' and match.end() == len(pending) and not final:
+                    break  # may be the first half of '\r\n'
+                yield pending[start:match.end()]
+                start = match.end()
+            pending = pending[start:]
+            if final:
+                if pending:
+                    yield pending
+                return
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+def batched(rows, batch_size: int = None):
+    """
+    Return `rows` unchanged if `batch_size` is `None`, otherwise yield lists
+    of up to `batch_size` rows.
+    """
+    if batch_size is None:
+        return rows
+    if batch_size < 1:
+        raise ValueError(f'batch_size must be at least 1; got {batch_size}')
+    return _iter_batches(rows, batch_size)
+
+
+def _iter_batches(rows, batch_size):
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        close = getattr(rows, 'close', None)
+        if close is not None:
+            close()
+
+
+def iter_csv_rows(body, empty_as_none: bool = True, batch_size: int = None, encoding: str = ENCODING_UTF8):
+    """
+    Yield each record of CSV `body` as a dictionary keyed by the header row;
+    with `empty_as_none` empty strings become `None` (so null later in
+    OpenSearch JSON). With `batch_size`, yield lists of up to that many
+    records instead.
+    """
+    return batched(_iter_csv_rows(body, empty_as_none, encoding), batch_size)
+
+
+def _iter_csv_rows(body, empty_as_none, encoding):
+    lines = iter_text_lines(body, encoding=encoding)
+    try:
+        yield from iter_csv_lines(lines, empty_as_none)
+    finally:
+        lines.close()
+
+
+def iter_csv_lines(lines, empty_as_none: bool = True):
+    """
+    Yield each record of the CSV text `lines` (the header row first) as a
+    dictionary; see `iter_csv_rows`.
+    """
+    for row in csv.DictReader(lines):
+        if empty_as_none:
+            for key, value in row.items():
+                if value == '':
+                    row[key] = None
+        yield row
+
+
+def iter_property_items(body, separator: str = PROPERTY_SEPARATOR, batch_size: int = None,
+                        encoding: str = ENCODING_UTF8):
+    """
+    Yield (key, value) for each non-blank line of a property file such as
+    `bag-info.txt`, split on the left-most `separator`; value is `None` if a
+    line has no separator. With `batch_size`, yield lists of pairs.
+    """
+    return batched(_iter_property_items(body, separator, encoding), batch_size)
+
+
+def _iter_property_items(body, separator, encoding):
+    lines = iter_text_lines(body, encoding=encoding)
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            key, found, value = line.strip().partition(separator)
+            yield key.strip(), value.strip() if found else None
+    finally:
+        lines.close()
+
+
+def iter_checksum_entries(body, batch_size: int = None, encoding: str = ENCODING_UTF8):
+    """
+    Yield `{'object': ..., 'checksum': ...}` for each non-blank line of a
+    checksum (manifest) file. With `batch_size`, yield lists of entries.
+    """
+    return batched(_iter_checksum_entries(body, encoding), batch_size)
+
+
+def _iter_checksum_entries(body, encoding):
+    lines = iter_text_lines(body, encoding=encoding)
+    try:
+        yield from iter_checksum_lines(lines)
+    finally:
+        lines.close()
+
+
+def iter_checksum_lines(lines):
+    """
+    Yield the entry for each non-blank line of checksum file text `lines`;
+    see `iter_checksum_entries`.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        line_items = line.strip().replace('\t', ' ').split(' ', 1)
+        yield {
+            'object': line_items[1].strip(),
+            'checksum': line_items[0].strip()
+        }
+
+
+def decode_manifest_path(path: str) -> str:
+    """
+    Undo the percent-encoding of a manifest file path; BagIt encodes only CR
+    (`%0D`), LF (`%0A`) and `%` (`%25`), so any other `%XX` is literal.
+    """
+    return MANIFEST_PATH_ESCAPE_PATTERN.sub(lambda match: chr(int(match.group(1), 16)), path)
@@ -1,11 +1,53 @@
-import boto3
-import csv
-import io
+import array
+import codecs
+import collections
+import datetime
+import concurrent.futures
+import client_lib
+import row_lib
+import transfer_lib
 """
 Classes to support reading unpacked bag file content from s3 (with a view to
 sending it to OpenSearch).
 """
 
+READ_MAX_WORKERS = 8
+READ_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+BAG_SUB_FILES = 'bag_sub_files'
+TEXT_FILE_SUFFIXES = ['.txt', '.csv']
+# Sub-file content budgets; text beyond them is truncated (or, with
+# SUB_FILE_OVERFLOW_REFERENCE, left in s3 for readers to fetch by 'object')
+SUB_FILE_MAX_BYTES = 32 * 1024
+SUB_FILES_MAX_BYTES = 128 * 1024
+SUB_FILE_OVERFLOW_TRUNCATE = 'truncate'
+SUB_FILE_OVERFLOW_REFERENCE = 'reference'
+SUB_FILE_DECODE_ERRORS = 'replace'
+# Bag CSV columns held as codes into a list of distinct values
+CATEGORICAL_COLUMNS = {
+    'FileType', 'RightsCopyright', 'LegalStatus', 'HeldBy', 'Language', 'FoiExemptionCode',
+    'Extension', 'PUID', 'FFID-Software', 'FFID-SoftwareVersion', 'FFID-BinarySignatureFileVersion',
+    'FFID-ContainerSignatureFileVersion', 'AV-Software', 'AV-SoftwareVersion'
+}
+PATH_COLUMNS = {'Filepath', 'OriginalFilePath'}
+SIZE_COLUMNS = {'Filesize'}
+DATE_COLUMNS = {'LastModified'}
+NULL_INT = -(2 ** 63)  # missing value in integer (size and date) columns
+INT64_MAX = 2 ** 63 - 1
+EPOCH = datetime.datetime(1970, 1, 1)
+FILEPATH_COLUMN = 'Filepath'
+FILE_TYPE_COLUMN = 'FileType'
+FILE_TYPE_FOLDER = 'Folder'
+
+
+def normalise_filepath(path: str) -> str:
+    """
+    Return bag file `path` in the form used to join the manifest and bag
+    CSVs: '/' separators, no leading './' or '/', no repeated or trailing '/'.
+    Manifest paths should be percent-decoded first (see `BagFileIndex`).
+    """
+    parts = [p for p in path.strip().replace('\\', '/').split('/') if p and p != '.']
+    return '/'.join(parts)
+
 
 class BagError(Exception):
     """
@@ -13,13 +55,377 @@ class BagError(Exception):
     """
 
 
+class BagCsvTable:
+    """
+    Columnar form of a bag CSV (`file-metadata.csv`, `file-ffid.csv`,
+    `file-av.csv`): one column per CSV field instead of one dictionary per
+    row. Values in `CATEGORICAL_COLUMNS` are stored as `array('I')` codes
+    into a list of distinct values, `PATH_COLUMNS` as folder codes plus base
+    names (which other columns in the row, e.g. `FileName`, share rather
+    than copy), `SIZE_COLUMNS` as `array('q')` integers
+    and `DATE_COLUMNS` as `array('q')` microseconds since the epoch (naive
+    times, as written by TDR); missing values are `NULL_INT`. A size or date
+    column holding any value that would not convert back to exactly the
+    same string, or does not fit in 64 bits, is kept as strings instead.
+    Other columns are lists of strings. Empty values are `None`. Values of
+    fields beyond the header (`csv.DictReader` puts them under key `None`)
+    are dropped.
+
+    Rows are available with `to_rows`/`iter_rows`; `value_counts`, `where`
+    and `total` work on the columns directly.
+    """
+    __slots__ = ('field_names', 'row_count', 'columns', 'categories', 'kinds', 'path_names')
+
+    KIND_STR = 'str'
+    KIND_CATEGORY = 'category'
+    KIND_PATH = 'path'
+    KIND_SIZE = 'size'
+    KIND_DATE = 'date'
+
+    def __init__(self, field_names: list):
+        self.field_names = [name for name in field_names if name is not None]
+        self.row_count = 0
+        self.kinds = {}
+        self.columns = {}
+        self.categories = {}  # column -> (list of values, {value: code})
+        self.path_names = {}  # path column -> list of base names
+        for name in self.field_names:
+            if name in PATH_COLUMNS:
+                # Folder codes in `columns`, folders in `categories`
+                self.kinds[name] = self.KIND_PATH
+                self.columns[name] = array.array('I')
+                self.categories[name] = ([None], {None: 0})
+                self.path_names[name] = []
+            elif name in CATEGORICAL_COLUMNS:
+                self.kinds[name] = self.KIND_CATEGORY
+                self.columns[name] = array.array('I')
+                self.categories[name] = ([None], {None: 0})
+            elif name in SIZE_COLUMNS:
+                self.kinds[name] = self.KIND_SIZE
+                self.columns[name] = array.array('q')
+            elif name in DATE_COLUMNS:
+                self.kinds[name] = self.KIND_DATE
+                self.columns[name] = array.array('q')
+            else:
+                self.kinds[name] = self.KIND_STR
+                self.columns[name] = []
+
+    @classmethod
+    def from_rows(cls, rows, field_names: list = None):
+        """
+        Build a table from an iterable of row dictionaries (such as
+        `row_lib.iter_csv_rows`); field names default to the first row's keys.
+        """
+        table = None
+        for row in rows:
+            if table is None:
+                table = cls(field_names or list(row))
+            table.append(row)
+        return table if table is not None else cls(field_names or [])
+
+    def append(self, row: dict):
+        row_names = {}  # base names stored for this row, to share
+        for name in self.field_names:
+            value = row.get(name)
+            if value == '':
+                value = None
+            kind = self.kinds[name]
+            if kind == self.KIND_PATH:
+                folder, base_name = None, value
+                if value is not None and '/' in value:
+                    folder, _, base_name = value.rpartition('/')
+                    base_name = row_names.setdefault(base_name, base_name)
+                elif value is not None:
+                    base_name = row_names.setdefault(value, value)
+                values, codes = self.categories[name]
+                code = codes.get(folder)
+                if code is None:
+                    code = codes[folder] = len(values)
+                    values.append(folder)
+                self.columns[name].append(code)
+                self.path_names[name].append(base_name)
+            elif kind == self.KIND_CATEGORY:
+                values, codes = self.categories[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(values)
+                    values.append(value)
+                self.columns[name].append(code)
+            elif kind == self.KIND_STR:
+                self.columns[name].append(value if value is None else row_names.get(value, value))
+            else:
+                number = self._parse(kind, value)
+                if number is None:
+                    self._to_str_column(name)
+                    self.columns[name].append(value)
+                else:
+                    self.columns[name].append(number)
+        self.row_count += 1
+
+    @staticmethod
+    def _parse(kind, value):
+        """
+        Return `value` as an int for a size/date column, `NULL_INT` for None,
+        or None if it does not round trip exactly.
+        """
+        if value is None:
+            return NULL_INT
+        if kind == BagCsvTable.KIND_SIZE:
+            if value.isascii() and value.isdigit() and str(int(value)) == value and int(value) <= INT64_MAX:
+                return int(value)
+            return None
+        try:
+            parsed = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if parsed.tzinfo is not None or parsed.isoformat() != value:
+            return None
+        delta = parsed - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    def _format(self, name, value, index=None):
+        kind = self.kinds[name]
+        if kind == self.KIND_PATH:
+            folder = self.categories[name][0][value]
+            base_name = self.path_names[name][index]
+            return base_name if folder is None else f'{folder}/{base_name}'
+        if kind == self.KIND_CATEGORY:
+            return self.categories[name][0][value]
+        if kind == self.KIND_STR:
+            return value
+        if value == NULL_INT:
+            return None
+        if kind == self.KIND_SIZE:
+            return value
+        return (EPOCH + datetime.timedelta(microseconds=value)).isoformat()
+
+    def _to_str_column(self, name):
+        print(f'BagCsvTable: column "{name}" kept as strings')
+        values = [self._format(name, v) for v in self.columns[name]]
+        self.kinds[name] = self.KIND_STR
+        self.columns[name] = [v if v is None else str(v) for v in values]
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    def column(self, name: str) -> list:
+        """
+        Return the decoded values of column `name` (sizes as int, dates as
+        ISO 8601 strings).
+        """
+        return [self._format(name, v, i) for i, v in enumerate(self.columns[name])]
+
+    def iter_rows(self, typed: bool = False):
+        """
+        Yield each row as a dictionary. Unless `typed` is True sizes are
+        returned as strings, exactly as read from the CSV.
+        """
+        columns = [(name, self.columns[name]) for name in self.field_names]
+        for index in range(self.row_count):
+            row = {}
+            for name, column in columns:
+                value = self._format(name, column[index], index)
+                if not typed and self.kinds[name] == self.KIND_SIZE and value is not None:
+                    value = str(value)
+                row[name] = value
+            yield row
+
+    def to_rows(self, typed: bool = False) -> list:
+        """
+        Return the rows as a list of dictionaries, as `get_csv_file_as_list`.
+        """
+        return list(self.iter_rows(typed=typed))
+
+    def value_counts(self, name: str) -> dict:
+        """
+        Return {value: number of rows} for column `name`.
+        """
+        if self.kinds[name] == self.KIND_CATEGORY:
+            values = self.categories[name][0]
+            return {values[code]: count for code, count in collections.Counter(self.columns[name]).items()}
+        return dict(collections.Counter(self.column(name)))
+
+    def where(self, name: str, value) -> list:
+        """
+        Return the indexes of rows where column `name` equals `value`.
+        """
+        if self.kinds[name] == self.KIND_CATEGORY:
+            code = self.categories[name][1].get(value)
+            if code is None:
+                return []
+            return [i for i, c in enumerate(self.columns[name]) if c == code]
+        return [i for i, v in enumerate(self.column(name)) if v == value]
+
+    def total(self, name: str) -> int:
+        """
+        Return the sum of size column `name`, ignoring missing values.
+        """
+        if self.kinds[name] != self.KIND_SIZE:
+            raise BagError(f'Column "{name}" is not a size column')
+        return sum(v for v in self.columns[name] if v != NULL_INT)
+
+
+class BagFileRecord:
+    """
+    Everything the bag says about one file: its manifest checksum and its
+    `file-metadata.csv`, `file-ffid.csv` and `file-av.csv` rows (`None`
+    where a source has no entry).
+    """
+    __slots__ = ('filepath', 'checksum', 'metadata', 'ffid', 'av')
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.checksum = None
+        self.metadata = None
+        self.ffid = None
+        self.av = None
+
+    def as_dict(self) -> dict:
+        return {
+            'Filepath': self.filepath,
+            'checksum': self.checksum,
+            'metadata': self.metadata,
+            'ffid': self.ffid,
+            'av': self.av
+        }
+
+
+class BagFileIndex:
+    """
+    Hash index of a bag's files keyed by normalised `Filepath`, joining
+    `manifest-sha256.txt`, `file-metadata.csv`, `file-ffid.csv` and
+    `file-av.csv` in one pass over each. Look up a file with `get` (or
+    `index[filepath]`), iterate with `iter_records`, and check consistency
+    with `orphans`.
+
+    :param manifest: Manifest entries (`{'object': ..., 'checksum': ...}`)
+    :param metadata: `file-metadata.csv` rows (list of dicts or BagCsvTable)
+    :param ffid: `file-ffid.csv` rows
+    :param av: `file-av.csv` rows
+    """
+    __slots__ = ('records', 'duplicates', 'sources')
+
+    SOURCE_MANIFEST = 'manifest'
+    SOURCE_METADATA = 'metadata'
+    SOURCE_FFID = 'ffid'
+    SOURCE_AV = 'av'
+
+    def __init__(self, manifest=None, metadata=None, ffid=None, av=None):
+        self.records = {}  # normalised Filepath -> BagFileRecord, in first-seen order
+        self.duplicates = {}  # source -> [Filepath, ...] seen more than once
+        self.sources = []  # sources supplied
+        if manifest is not None:
+            self.sources.append(self.SOURCE_MANIFEST)
+            for entry in manifest:
+                self._record(self.SOURCE_MANIFEST, row_lib.decode_manifest_path(entry['object'])).checksum = entry['checksum']
+        for source, rows in [(self.SOURCE_METADATA, metadata), (self.SOURCE_FFID, ffid), (self.SOURCE_AV, av)]:
+            if rows is None:
+                continue
+            self.sources.append(source)
+            if isinstance(rows, BagCsvTable):
+                rows = rows.iter_rows()
+            for row in rows:
+                filepath = row.get(FILEPATH_COLUMN)
+                if filepath:
+                    setattr(self._record(source, filepath), source, row)
+
+    @classmethod
+    def from_bag_data(cls, bag_data: dict):
+        """
+        Build the index from `S3BagReader.read_all` output (or the indexer's
+        OpenSearch `bag_data`).
+        """
+        return cls(
+            manifest=bag_data.get(BagFileMapper.BAG_MANIFEST_SHA256),
+            metadata=bag_data.get(BagFileMapper.BAG_FILE_METADATA),
+            ffid=bag_data.get(BagFileMapper.BAG_FILE_FFID_CSV),
+            av=bag_data.get(BagFileMapper.BAG_FILE_AV))
+
+    def _record(self, source, filepath) -> BagFileRecord:
+        key = normalise_filepath(filepath)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = BagFileRecord(key)
+        elif self._has(record, source):
+            self.duplicates.setdefault(source, []).append(key)
+        return record
+
+    def _has(self, record, source) -> bool:
+        if source == self.SOURCE_MANIFEST:
+            return record.checksum is not None
+        return getattr(record, source) is not None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, filepath) -> bool:
+        return normalise_filepath(filepath) in self.records
+
+    def __getitem__(self, filepath) -> BagFileRecord:
+        return self.records[normalise_filepath(filepath)]
+
+    def get(self, filepath, default=None):
+        """
+        Return the `BagFileRecord` for `filepath` (normalised), or `default`.
+        """
+        return self.records.get(normalise_filepath(filepath), default)
+
+    def iter_records(self, source: str = None):
+        """
+        Yield every `BagFileRecord`, or only those with an entry in `source`
+        (e.g. `BagFileIndex.SOURCE_MANIFEST`).
+        """
+        for record in self.records.values():
+            if source is None or self._has(record, source):
+                yield record
+
+    @staticmethod
+    def _is_folder(record) -> bool:
+        return record.metadata is not None and record.metadata.get(FILE_TYPE_COLUMN) == FILE_TYPE_FOLDER
+
+    def orphans(self) -> dict:
+        """
+        Return files present in one source but not another:
+
+            {
+                'metadata': {
+                    'not_in_manifest': [...],  # excluding folders
+                    'missing': [...]  # manifest files with no metadata row
+                },
+                'ffid': {...},
+                'av': {...}
+            }
+
+        Only sources that were supplied are compared.
+        """
+        report = {}
+        if self.SOURCE_MANIFEST not in self.sources:
+            return report
+        for source in self.sources:
+            if source == self.SOURCE_MANIFEST:
+                continue
+            not_in_manifest = []
+            missing = []
+            for record in self.records.values():
+                in_source = self._has(record, source)
+                in_manifest = record.checksum is not None
+                if in_source and not in_manifest and not self._is_folder(record):
+                    not_in_manifest.append(record.filepath)
+                elif in_manifest and not in_source:
+                    missing.append(record.filepath)
+            report[source] = {'not_in_manifest': not_in_manifest, 'missing': missing}
+        return report
+
+
 class BagFileMapper:
     """
     Assign each file name from an arbitrary file list to a property. Top-level
-    bag file names (such as `bag-info.txt`) go to respective class-level
-    `str` properties. Bag file names in sub folders go to a list.
+    bag file names (such as `bag-info.txt`) go to respective `str`
+    properties. Bag file names in sub folders are kept in a compact table
+    (each folder name stored once, plus the file's base name) and can be
+    iterated with `iter_bag_sub_files`.
 
-    On error raises BagReaderError.
+    On error raises BagError.
     """
     BAG_BAG_INFO = 'bag-info.txt'
     BAG_BAGIT = 'bagit.txt'
@@ -29,66 +435,108 @@ class BagFileMapper:
     BAG_MANIFEST_SHA256 = 'manifest-sha256.txt'
     BAG_TAGMANIFEST_SHA256 = 'tagmanifest-sha256.txt'
 
-    # Explicitly declare properties set by __init__ method
-    bag_sub_file_list = None
-    bag_info_txt = None
-    bagit_txt = None
-    file_av_csv = None
-    file_ffid_csv = None
-    file_metadata_csv = None
-    manifest_sha_256_txt = None
-    tagmanifest_sha_256_txt = None
+    # Root file name -> property holding its full path
+    ROOT_FILE_PROPERTIES = {
+        BAG_BAG_INFO: 'bag_info_txt',
+        BAG_BAGIT: 'bagit_txt',
+        BAG_FILE_AV: 'file_av_csv',
+        BAG_FILE_FFID_CSV: 'file_ffid_csv',
+        BAG_FILE_METADATA: 'file_metadata_csv',
+        BAG_MANIFEST_SHA256: 'manifest_sha_256_txt',
+        BAG_TAGMANIFEST_SHA256: 'tagmanifest_sha_256_txt'
+    }
+
+    __slots__ = (
+        'path_prefix',
+        'bag_info_txt',
+        'bagit_txt',
+        'file_av_csv',
+        'file_ffid_csv',
+        'file_metadata_csv',
+        'manifest_sha_256_txt',
+        'tagmanifest_sha_256_txt',
+        '_sub_file_folders',
+        '_sub_file_names',
+        '_unprefixed_sub_files'
+    )
 
     def __init__(
             self,
-            file_list: list,
+            file_list,
             path_prefix: str = '',
             only_expected_root_files: bool = False
     ):
         """
         Map list of bag files to respective class properties.
 
-        :param file_list: List of bag file paths
+        :param file_list: List (or any iterable) of bag file paths
         :param path_prefix: Optional path prefix to bag root
         :param only_expected_root_files: Default False value permits skipping
         of unexpected files exist in bag root; set True to raise error instead
         """
-        print(f'__init__: file_list={file_list}')
         print(f'__init__: path_prefix={path_prefix}')
-        self.bag_sub_file_list = []
+        self.path_prefix = path_prefix
+        for property_name in self.ROOT_FILE_PROPERTIES.values():
+            setattr(self, property_name, None)
+        # Parallel lists: folder (relative to path_prefix, shared by all of
+        # its files) and base name of each sub file, in input order
+        self._sub_file_folders = []
+        self._sub_file_names = []
+        self._unprefixed_sub_files = set()  # indexes of paths not under path_prefix
+        folders = {}
+        root_properties = self.ROOT_FILE_PROPERTIES
+        file_count = 0
 
         for bag_file_full_path in file_list:
-            print(f'__init__: bag_file_full_path={bag_file_full_path}')
-            bag_file = str(bag_file_full_path).removeprefix(path_prefix)
-            if bag_file == self.BAG_BAG_INFO:
-                self.bag_info_txt = bag_file_full_path
-            if bag_file == self.BAG_BAGIT:
-                self.bagit_txt = bag_file_full_path
-            if bag_file == self.BAG_FILE_AV:
-                self.file_av_csv = bag_file_full_path
-            if bag_file == self.BAG_FILE_FFID_CSV:
-                self.file_ffid_csv = bag_file_full_path
-            if bag_file == self.BAG_FILE_METADATA:
-                self.file_metadata_csv = bag_file_full_path
-            if bag_file == self.BAG_MANIFEST_SHA256:
-                self.manifest_sha_256_txt = bag_file_full_path
-            if bag_file == self.BAG_TAGMANIFEST_SHA256:
-                self.tagmanifest_sha_256_txt = bag_file_full_path
+            file_count += 1
+            bag_file_full_path = str(bag_file_full_path)
+            bag_file = bag_file_full_path.removeprefix(path_prefix)
+            property_name = root_properties.get(bag_file)
+            if property_name is not None:
+                setattr(self, property_name, bag_file_full_path)
             elif '/' in bag_file:
-                self.bag_sub_file_list.append(bag_file_full_path)
-            else:
-                if only_expected_root_files:
-                    raise BagError(
-                        f'unexpected file in bag root: {bag_file_full_path}'
-                    )
+                if len(bag_file) == len(bag_file_full_path) and path_prefix:
+                    self._unprefixed_sub_files.add(len(self._sub_file_names))
+                folder, _, name = bag_file.rpartition('/')
+                self._sub_file_folders.append(folders.setdefault(folder, folder))
+                self._sub_file_names.append(name)
+            elif only_expected_root_files:
+                raise BagError(
+                    f'unexpected file in bag root: {bag_file_full_path}'
+                )
 
         if self.bag_info_txt is None:
             raise BagError(f'No input file for "{self.BAG_BAG_INFO}"')
 
-        print(f'BagFileMapper: self.bag_sub_file_list={self.bag_sub_file_list}')
+        print(
+            f'BagFileMapper: {file_count} file(s), {len(self._sub_file_names)} sub file(s) '
+            f'in {len(folders)} folder(s)')
+
+    def iter_bag_sub_files(self):
+        """
+        Yield the full path of each bag file in a sub folder, in input order.
+        """
+        prefix = self.path_prefix
+        unprefixed = self._unprefixed_sub_files
+        for index, (folder, name) in enumerate(zip(self._sub_file_folders, self._sub_file_names)):
+            yield f'{folder}/{name}' if index in unprefixed else f'{prefix}{folder}/{name}'
+
+    @property
+    def bag_sub_file_count(self) -> int:
+        return len(self._sub_file_names)
+
+    @property
+    def bag_sub_file_list(self) -> list:
+        """
+        List of the full paths of bag files in sub folders; prefer
+        `iter_bag_sub_files` for large bags.
+        """
+        return list(self.iter_bag_sub_files())
 
 
 class S3BagReader(BagFileMapper):
+    __slots__ = ('s3_bucket', 'only_expected_root_files', 's3_api')
+
     def __init__(
             self,
             s3_bucket: str,
@@ -105,19 +553,21 @@ class S3BagReader(BagFileMapper):
         :param path_prefix: Optional path prefix to bag root
         :param only_expected_root_files: Default False value permits skipping
         of unexpected files exist in bag root; set True to raise error instead
-        :param s3_api: Optionally pass an existing boto3.client('s3') instance
+        :param s3_api: Optionally pass an existing boto3.client('s3') instance;
+        defaults to the shared `client_lib` client
         """
-        super().__init__(file_list=file_list, path_prefix=path_prefix)
+        super().__init__(
+            file_list=file_list,
+            path_prefix=path_prefix,
+            only_expected_root_files=only_expected_root_files)
         self.s3_bucket = s3_bucket
         self.only_expected_root_files = only_expected_root_files
         if s3_api:
             print(f'Using externally provided s3_api instance')
             self.s3_api = s3_api
         else:
-            print(f'Creating internal s3_api instance')
-            self.s3_api = boto3.client('s3')
-
-        print(f'S3BagReader: self.bag_sub_file_list={self.bag_sub_file_list}')
+            print(f'Using shared s3_api instance')
+            self.s3_api = client_lib.get_client('s3')
 
     @staticmethod
     def get_property_file_as_dict(s3_object) -> dict:
@@ -126,12 +576,7 @@ class S3BagReader(BagFileMapper):
         :param s3_object: S3 API object instance (AWS boto3 s3 API get_object)
         :return: Dictionary of property file key/value pairs
         """
-        output = {}
-        lines = s3_object['Body'].read().decode('utf-8').splitlines()
-        for line in lines:
-            line_items = line.strip().split(':', 1)
-            output[line_items[0].strip()] = line_items[1].strip()
-        return output
+        return dict(row_lib.iter_property_items(s3_object['Body']))
 
     @staticmethod
     def get_checksum_file_as_list(s3_object) -> list:
@@ -140,16 +585,7 @@ class S3BagReader(BagFileMapper):
         :param s3_object: S3 API object instance (AWS boto3 s3 API get_object)
         :return: List of checksum file entries pairs (file -> checksum)
         """
-        output = []
-        lines = s3_object['Body'].read().decode('utf-8').splitlines()
-        for line in lines:
-            line_items = line.strip().replace('\t', ' ').split(' ', 1)
-            line_dict = {
-                'object': line_items[1].strip(),
-                'checksum': line_items[0].strip()
-            }
-            output.append(line_dict)
-        return output
+        return list(row_lib.iter_checksum_entries(s3_object['Body']))
 
     @staticmethod
     def get_csv_file_as_list(s3_object) -> list:
@@ -158,17 +594,40 @@ class S3BagReader(BagFileMapper):
         :param s3_object: S3 API object instance (AWS boto3 s3 API get_object)
         :return: List of dictionaries of csv file records
         """
-        output = []
-        lines = s3_object['Body'].read().decode('utf-8').splitlines()
-        csv_reader = csv.DictReader(lines)
-        for line in csv_reader:
-            # Set empty strings to None (so null later in OpenSearch JSON)
-            for k, v in line.items():
-                if v == '':
-                    line[k] = None
+        # Empty strings are set to None (so null later in OpenSearch JSON)
+        return list(row_lib.iter_csv_rows(s3_object['Body']))
+
+    @staticmethod
+    def get_csv_file_as_table(s3_object) -> BagCsvTable:
+        """
+        Return columnar representation of a csv file.
+        :param s3_object: S3 API object instance (AWS boto3 s3 API get_object)
+        :return: BagCsvTable of csv file records
+        """
+        return BagCsvTable.from_rows(row_lib.iter_csv_rows(s3_object['Body']))
 
-            output.append(line)
-        return output
+    def get_file_index(self) -> BagFileIndex:
+        """
+        Read the payload manifest and bag CSVs and return them joined by
+        `Filepath` (see `BagFileIndex`).
+        """
+        data = {}
+        data.update(self.get_manifest_sha256_as_dict())
+        data.update(self.get_file_metadata_csv_as_dict())
+        data.update(self.get_file_ffid_csv_as_dict())
+        data.update(self.get_file_av_csv_as_dict())
+        return BagFileIndex.from_bag_data(data)
+
+    def iter_csv_file(self, key: str, batch_size: int = None):
+        """
+        Stream the records of csv file `key` without reading the whole file
+        into memory (see `row_lib.iter_csv_rows`).
+        :param key: s3 key of the csv file; e.g. `self.file_metadata_csv`
+        :param batch_size: Optionally yield lists of this many records
+        :return: Generator of dictionaries (or lists of dictionaries)
+        """
+        s3_object = self.s3_api.get_object(Bucket=self.s3_bucket, Key=key)
+        return row_lib.iter_csv_rows(s3_object['Body'], batch_size=batch_size)
 
     def get_bag_info_txt_as_dict(self) -> dict:
         s3_object = self.s3_api.get_object(Bucket=self.s3_bucket, Key=self.bag_info_txt)
@@ -231,42 +690,215 @@ class S3BagReader(BagFileMapper):
             self.BAG_TAGMANIFEST_SHA256: data
         }
 
-    def get_sub_files_dict(self) -> dict:
+    def iter_text_sub_files(self):
+        """
+        Yield the full path of each sub-file with a `TEXT_FILE_SUFFIXES`
+        suffix, in input order; the files whose content is indexed.
+        """
+        return (f for f in self.iter_bag_sub_files() if f[-4:] in TEXT_FILE_SUFFIXES)
+
+    def get_sub_file_head(self, key: str, max_bytes: int) -> tuple:
+        """
+        Return (up to the first `max_bytes` + 1 bytes, total size in bytes)
+        of s3 object `key`, using a ranged GET so that large files are never
+        downloaded in full. The extra byte shows whether the file was cut.
+        """
+        try:
+            s3_object = self.s3_api.get_object(Bucket=self.s3_bucket, Key=key, Range=f'bytes=0-{max_bytes}')
+        except Exception as e:
+            # s3 rejects any range on an empty object
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'InvalidRange':
+                return b'', 0
+            raise
+        body = s3_object['Body']
+        try:
+            data = body.read(max_bytes + 1)
+        finally:
+            body.close()
+        content_range = s3_object.get('ContentRange')
+        size = int(content_range.rpartition('/')[2]) if content_range else s3_object.get('ContentLength', len(data))
+        return data, size
+
+    @staticmethod
+    def make_sub_file_entry(key, data, size, limit, overflow, errors) -> tuple:
+        """
+        Return (sub-file entry, bytes of budget used) for the first bytes
+        `data` of a file of `size` bytes allowed `limit` bytes of content.
+        """
+        if limit <= 0:
+            return {'object': key, 'data': None, 'size': None, 'truncated': True}, 0
+        truncated = size > limit
+        if truncated and overflow == SUB_FILE_OVERFLOW_REFERENCE:
+            return {'object': key, 'data': None, 'size': size, 'truncated': True}, 0
+        data = data[:limit]
+        # Not final when truncated, so a character cut at the limit is dropped
+        decoder = codecs.getincrementaldecoder(row_lib.ENCODING_UTF8)(errors=errors)
+        text = decoder.decode(data, final=not truncated)
+        return {'object': key, 'data': text, 'size': size, 'truncated': truncated}, len(data)
+
+    def _iter_sub_file_entries(self, executor, sub_files, window, max_file_bytes, max_total_bytes, overflow, errors):
+        """
+        Yield the entry for each of `sub_files` in order, fetching up to
+        `window` ahead on `executor`. Budgets are applied in list order, so
+        the output does not depend on `window`; once `max_total_bytes` is
+        spent the remaining files are not read at all.
+        """
+        if overflow not in (SUB_FILE_OVERFLOW_TRUNCATE, SUB_FILE_OVERFLOW_REFERENCE):
+            raise BagError(f'Unknown sub-file overflow policy "{overflow}"')
+        remaining = max_total_bytes
+        keys = iter(sub_files)
+        pending = collections.deque()
+        try:
+            while True:
+                while remaining > 0 and len(pending) < window:
+                    key = next(keys, None)
+                    if key is None:
+                        break
+                    pending.append((key, executor.submit(self.get_sub_file_head, key, max_file_bytes)))
+                if not pending:
+                    break
+                key, future = pending.popleft()
+                data, size = future.result()
+                entry, used = self.make_sub_file_entry(
+                    key, data, size, min(max_file_bytes, remaining), overflow, errors)
+                remaining -= used
+                yield entry
+        finally:
+            for _, future in pending:
+                future.cancel()
+        for key in keys:
+            yield {'object': key, 'data': None, 'size': None, 'truncated': True}
+
+    def get_sub_files_dict(
+            self,
+            max_file_bytes: int = SUB_FILE_MAX_BYTES,
+            max_total_bytes: int = SUB_FILES_MAX_BYTES,
+            overflow: str = SUB_FILE_OVERFLOW_TRUNCATE,
+            errors: str = SUB_FILE_DECODE_ERRORS
+    ) -> dict:
         """
         Returns sub-file content as:
             {
                 'bag_sub_files': [
                     {
                         'object': '',
-                        'data': ''
+                        'data': '',
+                        'size': 0,  # bytes; None if the file was not read
+                        'truncated': False
                     }
                 ]
             }
-        """
-        text_files = ['.txt', '.csv']
-        file_list = []
-        print(f'self.bag_sub_file_list:\n{self.bag_sub_file_list}')
-        for sub_file in self.bag_sub_file_list:
-            if str(sub_file)[-4:] in text_files:
-                print(f'Loading text file: {sub_file}')
-                reader = io.BytesIO()
-                self.s3_api.download_fileobj(
-                    Bucket=self.s3_bucket,
-                    Key=sub_file,
-                    Fileobj=reader
-                )
 
-                file_list.append(
-                    {
-                        'object': sub_file,
-                        'data': reader.getvalue().decode()
-                    }
-                )
-            else:
-                print(f'Skipping file "{sub_file}"; not in "{text_files}"')
+        Only the first `max_file_bytes` of each file are read (ranged GET)
+        and no more than `max_total_bytes` in total, in file list order, so
+        the output size and read cost are bounded however large the files.
+        Over-budget content is cut on a character boundary and flagged
+        `truncated`; with `overflow=SUB_FILE_OVERFLOW_REFERENCE` it is left
+        out (`data` is `None`) for readers to fetch from s3 by `object`.
 
-        data = {
-            'bag_sub_files': file_list
+        :param max_file_bytes: Per-file content budget (bytes)
+        :param max_total_bytes: Per-bag content budget (bytes)
+        :param overflow: SUB_FILE_OVERFLOW_TRUNCATE or
+        SUB_FILE_OVERFLOW_REFERENCE
+        :param errors: Decoding error policy (e.g. 'replace', 'strict')
+        """
+        sub_files = list(self.iter_text_sub_files())
+        print(f'get_sub_files_dict: {self.bag_sub_file_count} sub file(s), {len(sub_files)} text file(s)')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            file_list = list(self._iter_sub_file_entries(
+                executor, sub_files, 1, max_file_bytes, max_total_bytes, overflow, errors))
+        self._print_sub_file_summary(file_list)
+        return {
+            BAG_SUB_FILES: file_list
         }
 
+    @staticmethod
+    def _print_sub_file_summary(file_list):
+        truncated = sum(1 for entry in file_list if entry['truncated'])
+        total = sum(len(entry['data']) for entry in file_list if entry['data'])
+        print(f'sub files: {len(file_list)} text file(s), {truncated} truncated, {total} character(s)')
+
+    @staticmethod
+    def get_text_file_as_str(s3_object) -> str:
+        """
+        Return the content of a text file.
+        :param s3_object: S3 API object instance (AWS boto3 s3 API get_object)
+        :return: Decoded file content
+        """
+        return s3_object['Body'].read().decode()
+
+    def read_all(
+            self,
+            max_workers: int = READ_MAX_WORKERS,
+            max_in_flight_bytes: int = READ_MAX_IN_FLIGHT_BYTES,
+            columnar: bool = False,
+            max_file_bytes: int = SUB_FILE_MAX_BYTES,
+            max_total_bytes: int = SUB_FILES_MAX_BYTES,
+            overflow: str = SUB_FILE_OVERFLOW_TRUNCATE,
+            errors: str = SUB_FILE_DECODE_ERRORS
+    ) -> dict:
+        """
+        Return the combined output of the `get_..._as_dict` methods and
+        `get_sub_files_dict`, with the same keys in the same order, fetching
+        the files concurrently so the time taken tracks the slowest file
+        rather than the sum of all of them.
+
+        :param max_workers: Number of concurrent s3 reads
+        :param max_in_flight_bytes: Cap on file data being read and parsed at
+        any one time (a single larger file is still read on its own)
+        :param columnar: Return the csv files as `BagCsvTable` objects rather
+        than lists of dictionaries
+        :param max_file_bytes: See `get_sub_files_dict`
+        :param max_total_bytes: See `get_sub_files_dict`
+        :param overflow: See `get_sub_files_dict`
+        :param errors: See `get_sub_files_dict`
+        :return: Dictionary of bag file content
+        """
+        # (output key, s3 key, parser) in output order; optional csv files
+        # that are absent are left out, as by their getters
+        tag_files = [
+            (self.BAG_BAG_INFO, self.bag_info_txt, self.get_property_file_as_dict),
+            (self.BAG_BAGIT, self.bagit_txt, self.get_property_file_as_dict),
+            (self.BAG_FILE_AV, self.file_av_csv, self.get_csv_file_as_list),
+            (self.BAG_FILE_FFID_CSV, self.file_ffid_csv, self.get_csv_file_as_list),
+            (self.BAG_FILE_METADATA, self.file_metadata_csv, self.get_csv_file_as_list),
+            (self.BAG_MANIFEST_SHA256, self.manifest_sha_256_txt, self.get_checksum_file_as_list),
+            (self.BAG_TAGMANIFEST_SHA256, self.tagmanifest_sha_256_txt, self.get_checksum_file_as_list)
+        ]
+        optional = (self.BAG_FILE_AV, self.BAG_FILE_FFID_CSV, self.BAG_FILE_METADATA)
+        if columnar:
+            tag_files = [
+                (name, key, self.get_csv_file_as_table if name in optional else parse)
+                for name, key, parse in tag_files]
+        tag_files = [t for t in tag_files if t[1] or t[0] not in optional]
+        sub_files = list(self.iter_text_sub_files())
+        print(f'read_all: {len(tag_files)} tag file(s), {len(sub_files)} sub-file(s), max_workers={max_workers}')
+
+        budget = transfer_lib.ByteBudget(max_in_flight_bytes)
+
+        def fetch(key, parse):
+            s3_object = self.s3_api.get_object(Bucket=self.s3_bucket, Key=key)
+            size = s3_object.get('ContentLength', 0)
+            budget.acquire(size)
+            try:
+                return parse(s3_object)
+            finally:
+                budget.release(size)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tag_futures = [(name, executor.submit(fetch, key, parse)) for name, key, parse in tag_files]
+            try:
+                # Sub-file reads are capped at max_file_bytes each, so they
+                # bypass the byte budget and are windowed to max_workers
+                sub_file_entries = list(self._iter_sub_file_entries(
+                    executor, sub_files, max_workers, max_file_bytes, max_total_bytes, overflow, errors))
+                data = {name: future.result() for name, future in tag_futures}
+                data[BAG_SUB_FILES] = sub_file_entries
+            except Exception:
+                for _, future in tag_futures:
+                    future.cancel()
+                raise
+
+        self._print_sub_file_summary(data[BAG_SUB_FILES])
+        print(f'read_all: budget high water mark {budget.high_water_mark} bytes')
         return data
@@ -0,0 +1,173 @@
+import io
+import tarfile
+import client_lib
+import s3_bag_reader
+import tar_lib
+import transfer_lib
+"""
+Read a bag straight from its (optionally compressed) tar in s3, in a single
+streaming pass and without unpacking it, giving the same output as
+`S3BagReader` reading the unpacked files.
+"""
+
+
+class _CapturedObjects:
+    """
+    Stands in for the s3 client `get_object` calls made by `S3BagReader`,
+    serving the content captured from the tar: in full for tag files, the
+    first bytes for text sub-files.
+    """
+
+    def __init__(self):
+        self.objects = {}  # s3 key -> (captured bytes, size)
+        self.bytes_captured = 0
+
+    def add(self, key: str, data: bytes, size: int):
+        self.objects[key] = (data, size)
+        self.bytes_captured += len(data)
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise s3_bag_reader.BagError(f'"{Key}" was not read from the tar')
+        data, size = self.objects[Key]
+        if Range is None:
+            if len(data) < size:
+                raise s3_bag_reader.BagError(f'Only the first {len(data)} bytes of "{Key}" were read from the tar')
+            return {'Body': io.BytesIO(data), 'ContentLength': size}
+        first, last = (int(n) for n in Range.removeprefix('bytes=').split('-'))
+        part = data[first:last + 1]
+        return {
+            'Body': io.BytesIO(part),
+            'ContentLength': len(part),
+            'ContentRange': f'bytes {first}-{first + len(part) - 1}/{size}'
+        }
+
+
+class TarBagReader(s3_bag_reader.S3BagReader):
+    __slots__ = ('tar_object_name', 'sub_file_budget', 'decompression')
+
+    def __init__(
+            self,
+            s3_bucket: str,
+            object_name: str,
+            output_prefix: str = '',
+            only_expected_root_files: bool = False,
+            max_file_bytes: int = s3_bag_reader.SUB_FILE_MAX_BYTES,
+            max_total_bytes: int = s3_bag_reader.SUB_FILES_MAX_BYTES,
+            overflow: str = s3_bag_reader.SUB_FILE_OVERFLOW_TRUNCATE,
+            decompression_backend: str = None,
+            s3_api=None
+    ):
+        """
+        Provides the `S3BagReader` methods for a bag tar in s3. The tar is
+        read once, here: tag files are kept in full and text sub-files up to
+        the sub-file budgets (see `S3BagReader.get_sub_files_dict`), which
+        `get_sub_files_dict` and `read_all` then use by default. Files are
+        named as the unpacker would write them under `output_prefix`, so the
+        output matches indexing the unpacked bag. The bag root is the folder
+        holding `bagit.txt` and must be the top level or one folder down.
+
+        :param s3_bucket: Name of s3 bucket holding the tar
+        :param object_name: The tar's object name
+        :param output_prefix: Prefix for file names; e.g. `<object_name>/`
+        :param only_expected_root_files: See `BagFileMapper`
+        :param max_file_bytes: Per-file sub-file content budget (bytes)
+        :param max_total_bytes: Per-bag sub-file content budget (bytes)
+        :param overflow: SUB_FILE_OVERFLOW_TRUNCATE or
+        SUB_FILE_OVERFLOW_REFERENCE
+        :param decompression_backend: Optional `tar_lib` backend name
+        :param s3_api: Optionally pass an existing boto3.client('s3') instance;
+        defaults to the shared `client_lib` client
+        """
+        s3_api = s3_api or client_lib.get_client('s3')
+        self.tar_object_name = object_name
+        self.sub_file_budget = (max_file_bytes, max_total_bytes, overflow)
+        captured, file_list, bag_root, self.decompression = self._scan_tar(
+            s3_api, s3_bucket, object_name, output_prefix, max_file_bytes, max_total_bytes, overflow,
+            decompression_backend)
+        super().__init__(
+            s3_bucket=s3_bucket,
+            file_list=file_list,
+            path_prefix=output_prefix + bag_root,
+            only_expected_root_files=only_expected_root_files,
+            s3_api=captured)
+
+    @staticmethod
+    def _scan_tar(s3_api, s3_bucket, object_name, output_prefix, max_file_bytes, max_total_bytes, overflow,
+                  decompression_backend) -> tuple:
+        """
+        Read the tar once; return (captured content, file list, bag root,
+        decompression used).
+        """
+        captured = _CapturedObjects()
+        file_list = []
+        bag_root = None
+        # Mirrors the budget accounting of `S3BagReader._iter_sub_file_entries`
+        # for files certainly in a sub folder; files that may instead be in
+        # the bag root are read without counting, so enough is always read
+        remaining = max_total_bytes
+        s3_object = s3_api.get_object(Bucket=s3_bucket, Key=object_name)
+        reader = transfer_lib.ReadAheadReader(s3_object['Body'])
+        try:
+            stream, compression, backend = tar_lib.open_tar_stream(reader, decompression_backend)
+            print(f'_scan_tar: {object_name} is {compression}; backend {backend}')
+            with tarfile.open(fileobj=stream, mode='r|') as tar_content:
+                for item in tar_content:
+                    if not item.isfile():
+                        continue
+                    name = tar_lib.get_output_object_name(item.name)
+                    key = output_prefix + name
+                    file_list.append(key)
+                    folder, _, base_name = name.rpartition('/')
+                    depth = name.count('/')
+                    if base_name in s3_bag_reader.BagFileMapper.ROOT_FILE_PROPERTIES and depth <= 1:
+                        if base_name == s3_bag_reader.BagFileMapper.BAG_BAGIT:
+                            bag_root = folder + '/' if folder else ''
+                        captured.add(key, tar_content.extractfile(item).read(), item.size)
+                    elif base_name[-4:] in s3_bag_reader.TEXT_FILE_SUFFIXES and depth >= 1:
+                        limit = max_file_bytes if depth == 1 else min(max_file_bytes, remaining)
+                        if limit <= 0:
+                            captured.add(key, b'', item.size)
+                            continue
+                        captured.add(key, tar_content.extractfile(item).read(max_file_bytes + 1), item.size)
+                        if depth > 1 and not (item.size > limit
+                                              and overflow == s3_bag_reader.SUB_FILE_OVERFLOW_REFERENCE):
+                            remaining -= min(item.size, limit)
+        finally:
+            reader.close()
+        if bag_root is None:
+            raise s3_bag_reader.BagError(f'No "{s3_bag_reader.BagFileMapper.BAG_BAGIT}" in {object_name}')
+        print(
+            f'_scan_tar: {len(file_list)} file(s), bag root "{bag_root}", '
+            f'{captured.bytes_captured} bytes kept')
+        return captured, file_list, bag_root, {'compression': compression, 'backend': backend}
+
+    def get_sub_files_dict(self, max_file_bytes: int = None, max_total_bytes: int = None, overflow: str = None,
+                           errors: str = s3_bag_reader.SUB_FILE_DECODE_ERRORS) -> dict:
+        """
+        As `S3BagReader.get_sub_files_dict`; budgets default to (and must not
+        exceed) those the tar was read with.
+        """
+        return super().get_sub_files_dict(*self._sub_file_budget(max_file_bytes, max_total_bytes, overflow), errors)
+
+    def read_all(self, max_workers: int = s3_bag_reader.READ_MAX_WORKERS,
+                 max_in_flight_bytes: int = s3_bag_reader.READ_MAX_IN_FLIGHT_BYTES, columnar: bool = False,
+                 max_file_bytes: int = None, max_total_bytes: int = None, overflow: str = None,
+                 errors: str = s3_bag_reader.SUB_FILE_DECODE_ERRORS) -> dict:
+        """
+        As `S3BagReader.read_all`; budgets default to (and must not exceed)
+        those the tar was read with.
+        """
+        max_file_bytes, max_total_bytes, overflow = self._sub_file_budget(max_file_bytes, max_total_bytes, overflow)
+        return super().read_all(
+            max_workers, max_in_flight_bytes, columnar, max_file_bytes, max_total_bytes, overflow, errors)
+
+    def _sub_file_budget(self, max_file_bytes, max_total_bytes, overflow) -> tuple:
+        budget = tuple(
+            default if value is None else value
+            for value, default in zip((max_file_bytes, max_total_bytes, overflow), self.sub_file_budget))
+        max_file_bytes, max_total_bytes, overflow = self.sub_file_budget
+        if budget[0] > max_file_bytes or budget[1] > max_total_bytes or budget[2] != overflow:
+            raise s3_bag_reader.BagError(
+                f'Sub-file budget {budget} exceeds {self.sub_file_budget} used to read the tar')
+        return budget
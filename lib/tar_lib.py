@@ -1,8 +1,37 @@
 #!/usr/bin/env python3
 import logging
-import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
 import tarfile  # https://docs.python.org/3/library/tarfile.html
 import io
+import bisect
+import base64
+import zlib
+import json
+import time
+import hashlib
+import collections
+import resource
+import gzip
+import bz2
+import lzma
+import threading
+import concurrent.futures
+import botocore.exceptions
+import client_lib
+import transfer_lib
+
+# Optional faster decompression backends; stdlib is used when not installed
+try:
+    from isal import igzip as isal_igzip  # https://pypi.org/project/isal/
+except ImportError:
+    isal_igzip = None
+try:
+    from zlib_ng import gzip_ng  # https://pypi.org/project/zlib-ng/
+except ImportError:
+    gzip_ng = None
+try:
+    import zstandard  # https://pypi.org/project/zstandard/
+except ImportError:
+    zstandard = None
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -17,28 +46,228 @@ KEY_BUCKET_IN = 'input-bucket'
 KEY_OBJECT_IN = 'input-object'
 KEY_BUCKET_OUT = 'output-bucket'
 KEY_FILES = 'extracted-tar-files'
+KEY_MEMORY_REPORT = 'memory-report'
+KEY_COMPLETE = 'complete'
+KEY_CHECKPOINT = 'checkpoint'
+KEY_FIXITY_REPORT = 'fixity-report'
+KEY_TAR_INDEX = 'tar-index'
+KEY_DECOMPRESSION = 'decompression'
+
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # s3 multipart min=5MB, except "last" part
+STREAM_BUFFER_SIZE = 8 * 1024 * 1024  # also the multipart part size
+UPLOAD_MAX_WORKERS = 8
+UPLOAD_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+CHECKPOINT_SUFFIX = '.unpack-checkpoint.json'
+CHECKPOINT_INTERVAL_SECONDS = 60
+RESUME_HEAD_CHECK_MAX_MISSES = 16
+METADATA_SOURCE_ETAG = 'ayr-source-etag'
+METADATA_SOURCE_MEMBER = 'ayr-source-member'
+TAR_INDEX_SUFFIX = '.ayr-index.json'
+TAR_INDEX_VERSION = 1
+TAR_INDEX_SPAN = 4 * 1024 * 1024  # uncompressed bytes between access points
+TAR_INDEX_LOOKAHEAD = 512 * 1024  # compressed bytes kept ahead of the block walk
+TAR_INDEX_READ_SIZE = 256 * 1024
+TAR_INDEX_MAX_EMPTY_BLOCKS = 3  # consecutive empty deflate blocks followed when walking
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b'ustar'
+COMPRESSION_SNIFF_SIZE = tarfile.BLOCKSIZE
+DECOMPRESS_READ_SIZE = 1024 * 1024
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+
+def get_output_object_name(member_name, output_prefix=''):
+    """
+    Return the s3 object name for tar member `member_name`.
+    """
+    # No .removeprefix method in Python 3.8; check with if instead
+    output_object_name = member_name[2:] if member_name.startswith('./') else member_name
+    return output_prefix + output_object_name
+
+
+def get_memory_high_water_mark() -> int:
+    """
+    Return the peak resident set size of this process so far, in bytes.
+    """
+    # ru_maxrss is reported in KiB on Linux (the Lambda platform)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def detect_compression(header: bytes):
+    """
+    Return the compression of a tar from its first bytes: 'gz', 'bz2', 'xz',
+    'zst' or 'tar' (uncompressed); `None` if not recognised.
+    """
+    if header.startswith(GZIP_MAGIC):
+        return 'gz'
+    if header.startswith(BZIP2_MAGIC):
+        return 'bz2'
+    if header.startswith(XZ_MAGIC):
+        return 'xz'
+    if header.startswith(ZSTD_MAGIC):
+        return 'zst'
+    if header[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+        return 'tar'
+    if len(header) >= tarfile.BLOCKSIZE and not any(header[:tarfile.BLOCKSIZE]):
+        return 'tar'  # empty archive
+    if len(header) >= tarfile.BLOCKSIZE:
+        try:
+            # Pre-POSIX (v7) headers have no magic but do have a checksum
+            tarfile.TarInfo.frombuf(header[:tarfile.BLOCKSIZE], 'utf-8', 'surrogateescape')
+            return 'tar'
+        except tarfile.HeaderError:
+            pass
+    return None
+
+
+# Decompression backends by compression, fastest first; each maps a name to
+# a function opening a decompressed file-like object over a file-like object
+DECOMPRESSION_BACKENDS = {
+    'gz': {
+        'isal': (lambda fileobj: isal_igzip.IGzipFile(fileobj=fileobj, mode='rb')) if isal_igzip else None,
+        'zlib-ng': (lambda fileobj: gzip_ng.GzipNGFile(fileobj=fileobj, mode='rb')) if gzip_ng else None,
+        'zlib': lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode='rb')
+    },
+    'bz2': {
+        'bz2': lambda fileobj: bz2.BZ2File(fileobj, mode='rb')
+    },
+    'xz': {
+        'lzma': lambda fileobj: lzma.LZMAFile(fileobj, mode='rb')
+    },
+    'zst': {
+        'zstandard': (
+            lambda fileobj: zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+        ) if zstandard else None
+    },
+    'tar': {
+        'none': lambda fileobj: fileobj
+    }
+}
+
+
+def get_decompression_backends(compression) -> list:
+    """
+    Return the names of the installed backends for `compression`, fastest
+    first.
+    """
+    return [name for name, opener in DECOMPRESSION_BACKENDS.get(compression, {}).items() if opener]
+
+
+def open_decompressed_stream(fileobj, compression, backend=None):
+    """
+    Return (file-like object of decompressed data, backend name) for
+    `fileobj` holding data compressed with `compression` (see
+    `detect_compression`). Unless `backend` names one, the fastest installed
+    backend is used. Decompression of compressed input runs on a background
+    thread, overlapping with the caller's processing of the output.
+    """
+    backends = get_decompression_backends(compression)
+    if not backends:
+        raise tarfile.CompressionError(f'No decompression backend available for "{compression}"')
+    if backend is None:
+        backend = backends[0]
+    elif backend not in backends:
+        raise tarfile.CompressionError(
+            f'Decompression backend "{backend}" not available for "{compression}"; '
+            f'available: {backends}')
+    stream = DECOMPRESSION_BACKENDS[compression][backend](fileobj)
+    if compression != 'tar':
+        stream = transfer_lib.ReadAheadReader(stream, chunk_size=DECOMPRESS_READ_SIZE)
+    return stream, backend
+
+
+class _PrefixedStream:
+    """
+    Read-only file-like object returning `prefix` and then the rest of `raw`;
+    used to put back bytes read to detect compression.
+    """
+
+    def __init__(self, prefix: bytes, raw):
+        self._prefix = prefix
+        self._raw = raw
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._raw.read(size)
+        if 0 <= size <= len(self._prefix):
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+        data, self._prefix = self._prefix, b''
+        return data + self._raw.read(-1 if size < 0 else size - len(data))
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+
+def open_tar_stream(fileobj, backend=None) -> tuple:
+    """
+    Detect the compression of the tar in `fileobj` from its first bytes and
+    return (file-like object of uncompressed tar data, compression, backend
+    name); see `open_decompressed_stream`.
+    """
+    header = fileobj.read(COMPRESSION_SNIFF_SIZE)
+    compression = detect_compression(header)
+    if compression is None:
+        raise tarfile.ReadError('Unrecognised archive format')
+    stream, backend = open_decompressed_stream(_PrefixedStream(header, fileobj), compression, backend)
+    return stream, compression, backend
 
 
 def untar_s3_object(
         input_bucket_name,
         object_name,
         output_prefix='',
-        output_bucket_name=None
+        output_bucket_name=None,
+        streaming=False,
+        buffer_size=STREAM_BUFFER_SIZE,
+        max_workers=UPLOAD_MAX_WORKERS,
+        max_in_flight_bytes=UPLOAD_MAX_IN_FLIGHT_BYTES,
+        fixity_checker=None
 ):
     """
     Perform an untar operation on the specified s3 `object_name` in
     `input_bucket_name`. Output is to `input_bucket_name` unless
     `output_bucket_name` is provided. Output object names from the tar can be
     prefixed with `output_prefix`.
+
+    With `streaming` set the tar is processed in constant memory by
+    `untar_s3_object_streaming` (see there for `buffer_size`, `max_workers`,
+    `max_in_flight_bytes` and `fixity_checker`); otherwise the
+    whole tar is read into memory first.
     """
     logger.info(
         f'untar_s3_object start: input_bucket_name={input_bucket_name} '
         f'object_name={object_name} '
         f'output_prefix={output_prefix} '
-        f'output_bucket_name={output_bucket_name}')
+        f'output_bucket_name={output_bucket_name} '
+        f'streaming={streaming}')
+
+    if streaming:
+        result = untar_s3_object_streaming(
+            input_bucket_name=input_bucket_name,
+            object_name=object_name,
+            output_prefix=output_prefix,
+            output_bucket_name=output_bucket_name,
+            buffer_size=buffer_size,
+            max_workers=max_workers,
+            max_in_flight_bytes=max_in_flight_bytes,
+            fixity_checker=fixity_checker)
+        logger.info('untar_s3_object return')
+        return result[KEY_FILES]
 
     output_bucket_name = input_bucket_name if output_bucket_name is None else output_bucket_name
-    s3_client = boto3.client('s3')
+    s3_client = client_lib.get_client('s3')
     s3_input_object = s3_client.get_object(Bucket=input_bucket_name, Key=object_name)
     tar_stream = io.BytesIO(s3_input_object['Body'].read())
     extracted_object_names = []
@@ -47,9 +276,7 @@ def untar_s3_object(
         for item in tar_content:
             logger.info(f'item.isdir()={item.isdir()} item.isFile()={item.isfile()} item.name={item.name} item={item}')
             if item.isfile():
-                # No .removeprefix method in Python 3.8; check with if instead
-                output_object_name = item.name[2:] if item.name.startswith('./') else item.name
-                output_object_name = output_prefix + output_object_name
+                output_object_name = get_output_object_name(item.name, output_prefix)
                 logger.info(f'output_object_name={output_object_name}')
                 item_stream = tar_content.extractfile(item).read()
                 s3_client.upload_fileobj(
@@ -61,3 +288,1191 @@ def untar_s3_object(
 
     logger.info('untar_s3_object return')
     return extracted_object_names
+
+
+def get_checkpoint_object_name(object_name) -> str:
+    """
+    Return the s3 object name used to checkpoint a streaming untar of
+    `object_name`; stored alongside the tar in the input bucket.
+    """
+    return object_name + CHECKPOINT_SUFFIX
+
+
+def load_checkpoint(s3_client, bucket_name, checkpoint_object_name):
+    """
+    Return the checkpoint dict stored at `checkpoint_object_name`, or `None`
+    if there is no checkpoint.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=checkpoint_object_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise e
+    return json.loads(response['Body'].read())
+
+
+def untar_s3_object_streaming(
+        input_bucket_name,
+        object_name,
+        output_prefix='',
+        output_bucket_name=None,
+        buffer_size=STREAM_BUFFER_SIZE,
+        max_workers=UPLOAD_MAX_WORKERS,
+        max_in_flight_bytes=UPLOAD_MAX_IN_FLIGHT_BYTES,
+        should_stop=None,
+        checkpoint_interval=CHECKPOINT_INTERVAL_SECONDS,
+        fixity_checker=None,
+        build_index=False,
+        index_span=TAR_INDEX_SPAN,
+        decompression_backend=None,
+        s3_client=None
+) -> dict:
+    """
+    Untar s3 `object_name` in `input_bucket_name` without holding the tar, or
+    any whole member, in memory. The s3 body is read through `tarfile` stream
+    mode and each member is written to s3 in chunks of at most `buffer_size`
+    bytes; members larger than `buffer_size` are sent as multipart uploads
+    with `buffer_size` parts.
+
+    The work runs as a pipeline of three stages joined by bounded queues:
+    a read-ahead thread fetching the s3 body, the tar decompress/parse stage
+    which buffers member data, and a pool of `max_workers` upload workers.
+    At most `max_in_flight_bytes` of member data is buffered for upload at
+    any time, so peak memory is bounded by that and `buffer_size`, not by the
+    size of the bag. Output names are recorded in tar order regardless of
+    upload completion order.
+
+    Progress is checkpointed to s3 (see `get_checkpoint_object_name`) every
+    `checkpoint_interval` seconds, when `should_stop()` returns `True` and if
+    an error occurs. A later call for the same tar resumes from the
+    checkpoint: members it records are not uploaded again, and members just
+    after it that already exist in s3 from the same tar (matching size and
+    ETag or source metadata) are skipped. Plain (uncompressed) tars are
+    resumed with a ranged GET from the checkpointed tar offset; compressed
+    tars are decompressed from the start but skipped members are not
+    uploaded. The checkpoint is deleted once the untar completes.
+
+    If a `fixity_checker` (e.g. `fixity_lib.BagFixityChecker`) is given, each
+    member's data is passed to it as it streams through, so members are
+    hashed without being read again; its state is saved in checkpoints and
+    its `report()` is returned once the untar completes.
+
+    With `build_index` set, a sidecar index of the tar (see
+    `TarIndexBuilder` and `TarIndexReader`) is built from the same read and
+    stored next to it, so members can later be fetched without unpacking.
+    A run resumed from a checkpoint does not read the whole tar, so once it
+    completes the index is built with `build_tar_index` (a second read),
+    unless `should_stop` already reports time running out.
+
+    Output naming is as for `untar_s3_object`. Returns:
+
+        {
+            'extracted-tar-files': [...],  # in tar order
+            'memory-report': {...},
+            'complete': True,  # False if stopped early by `should_stop`
+            'checkpoint': {...},  # None if complete
+            'fixity-report': {...},  # only with a fixity_checker, once complete
+            'tar-index': '...',  # only with build_index; index object name or None
+            'decompression': {'compression': 'gz', 'backend': 'isal'}
+        }
+
+    :param buffer_size: Read buffer and multipart part size in bytes; must be
+    at least the s3 multipart minimum (5 MiB)
+    :param max_workers: Number of concurrent upload workers; 1 uploads each
+    chunk inline before the next is read
+    :param max_in_flight_bytes: Cap on member data buffered awaiting upload
+    :param should_stop: Optional callable polled between members and parts;
+    when it returns `True` in-flight uploads are drained, progress is
+    checkpointed and the function returns with `complete` set to `False`;
+    if no member after the checkpoint was completed by then,
+    `TarUnpackStalledError` is raised instead, as resuming would not progress
+    :param checkpoint_interval: Seconds between periodic checkpoints
+    :param fixity_checker: Optional object with `start_member(name, size)`,
+    `update(data)`, `finish_member()`, `report()`, `to_dict()` and
+    `load_dict(state)` methods; member names passed are without
+    `output_prefix`
+    :param build_index: Store a sidecar index of the tar; see above
+    :param index_span: Uncompressed bytes between index access points
+    :param decompression_backend: Optional name of the backend to use (see
+    `get_decompression_backends`); by default the fastest installed
+    :param s3_client: Optionally pass an existing boto3.client('s3') instance
+    """
+    logger.info(
+        f'untar_s3_object_streaming start: input_bucket_name={input_bucket_name} '
+        f'object_name={object_name} '
+        f'output_prefix={output_prefix} '
+        f'output_bucket_name={output_bucket_name} '
+        f'buffer_size={buffer_size} '
+        f'max_workers={max_workers} '
+        f'max_in_flight_bytes={max_in_flight_bytes}')
+
+    if buffer_size < S3_MIN_PART_SIZE:
+        raise ValueError(
+            f'buffer_size {buffer_size} is below the s3 multipart minimum of '
+            f'{S3_MIN_PART_SIZE}')
+
+    output_bucket_name = input_bucket_name if output_bucket_name is None else output_bucket_name
+    if not s3_client:
+        s3_client = client_lib.get_client(
+            's3', max_pool_connections=max(max_workers, client_lib.CLIENT_MAX_POOL_CONNECTIONS))
+
+    checkpoint_object_name = get_checkpoint_object_name(object_name)
+    checkpoint = load_checkpoint(s3_client, input_bucket_name, checkpoint_object_name)
+    head = s3_client.head_object(Bucket=input_bucket_name, Key=object_name)
+    if checkpoint is not None and (
+            checkpoint.get('source_etag') != head['ETag']
+            or checkpoint.get('output_bucket') != output_bucket_name
+            or checkpoint.get('output_prefix') != output_prefix):
+        logger.warning(f'Ignoring stale checkpoint {checkpoint_object_name}')
+        checkpoint = None
+
+    unpacker = _TarStreamUnpacker(
+        s3_client=s3_client,
+        output_bucket_name=output_bucket_name,
+        output_prefix=output_prefix,
+        buffer_size=buffer_size,
+        max_workers=max_workers,
+        max_in_flight_bytes=max_in_flight_bytes,
+        source_etag=head['ETag'],
+        checkpoint=checkpoint,
+        should_stop=should_stop,
+        fixity_checker=fixity_checker,
+        index_span=index_span if build_index else None,
+        decompression_backend=decompression_backend)
+
+    get_args = {'Bucket': input_bucket_name, 'Key': object_name, 'IfMatch': head['ETag']}
+    if unpacker.resume_offset:
+        logger.info(f'Resuming plain tar from offset {unpacker.resume_offset}')
+        get_args['Range'] = f'bytes={unpacker.resume_offset}-'
+    s3_input_object = s3_client.get_object(**get_args)
+
+    def save_checkpoint(state):
+        s3_client.put_object(
+            Bucket=input_bucket_name,
+            Key=checkpoint_object_name,
+            Body=json.dumps(state).encode(),
+            ContentType='application/json')
+        logger.info(
+            f'Saved checkpoint {checkpoint_object_name}: member_index={state["member_index"]} '
+            f'tar_offset={state["tar_offset"]}')
+
+    result = unpacker.run(s3_input_object['Body'], save_checkpoint, checkpoint_interval)
+    if build_index and result[KEY_COMPLETE]:
+        result[KEY_TAR_INDEX] = None
+        if unpacker.tar_index is not None:
+            result[KEY_TAR_INDEX] = save_tar_index(
+                s3_client, input_bucket_name, object_name, unpacker.tar_index)
+        elif checkpoint is not None:
+            if should_stop and should_stop():
+                logger.warning(f'No time left to build the tar index of resumed {object_name}')
+            else:
+                result[KEY_TAR_INDEX] = build_tar_index(
+                    input_bucket_name, object_name, span=index_span, s3_client=s3_client)
+    if result[KEY_COMPLETE] and checkpoint is not None:
+        s3_client.delete_object(Bucket=input_bucket_name, Key=checkpoint_object_name)
+    logger.info(f'untar_s3_object_streaming return: complete={result[KEY_COMPLETE]}')
+    return result
+
+
+class _UnpackStopped(Exception):
+    """
+    Raised internally to unwind the tar reader when `should_stop` fires.
+    """
+
+
+class TarUnpackStalledError(Exception):
+    """
+    Raised when `should_stop` fires before any member after the checkpoint
+    was completed, so resuming again would repeat the same work.
+    """
+
+
+class _MultipartMemberUpload:
+    """
+    A multipart upload of one tar member whose parts are sent by pipeline
+    workers in any order; completed by whichever thread finishes last.
+    """
+
+    def __init__(self, s3_client, bucket, key, metadata):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key, Metadata=metadata)['UploadId']
+        self.parts = {}
+        self.parts_enqueued = 0
+        self.all_enqueued = False
+        self.completed = False
+        self._lock = threading.Lock()
+
+    def add_part(self) -> int:
+        self.parts_enqueued += 1
+        return self.parts_enqueued
+
+    def upload_part(self, part_number, data):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data)
+        with self._lock:
+            self.parts[part_number] = response['ETag']
+            ready = self.all_enqueued and len(self.parts) == self.parts_enqueued
+        if ready:
+            self._complete()
+
+    def finish(self):
+        with self._lock:
+            self.all_enqueued = True
+            ready = len(self.parts) == self.parts_enqueued
+        if ready:
+            self._complete()
+
+    def _complete(self):
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': n, 'ETag': self.parts[n]} for n in sorted(self.parts)]})
+        self.completed = True
+
+    def abort(self):
+        if not self.completed:
+            logger.info(f'Aborting multipart upload of {self.key}')
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class _TarStreamUnpacker:
+    """
+    State for one streaming untar; see `untar_s3_object_streaming`.
+
+    Members are tracked in tar order with a count of their outstanding
+    uploads; the checkpoint covers the longest prefix of members whose
+    uploads have all finished.
+    """
+
+    def __init__(
+            self,
+            s3_client,
+            output_bucket_name,
+            output_prefix,
+            buffer_size,
+            max_workers,
+            max_in_flight_bytes,
+            source_etag,
+            checkpoint=None,
+            should_stop=None,
+            fixity_checker=None,
+            index_span=None,
+            decompression_backend=None):
+        self.s3_client = s3_client
+        self.output_bucket_name = output_bucket_name
+        self.output_prefix = output_prefix
+        self.buffer_size = buffer_size
+        self.max_workers = max_workers
+        self.source_etag = source_etag
+        self.should_stop = should_stop
+        self.fixity_checker = fixity_checker
+        self.index_span = index_span
+        self.decompression_backend = decompression_backend
+        self.decompression = None
+        self.index_builder = None
+        self.index_members = []
+        self.tar_index = None
+        self.budget = transfer_lib.ByteBudget(max(max_in_flight_bytes, buffer_size))
+        self.memory_report = {
+            'buffer_size': buffer_size,
+            'max_workers': max_workers,
+            'max_in_flight_bytes': self.budget.max_bytes,
+            'buffer_high_water_mark_bytes': 0,
+            'largest_member_bytes': 0,
+            'members': 0,
+            'member_bytes': 0,
+            'multipart_members': 0,
+            'members_skipped': 0,
+            'process_max_rss_bytes_start': get_memory_high_water_mark()
+        }
+        self._executor = None
+        self._error = None
+        self._multipart_uploads = []
+        self._lock = threading.Lock()
+        self._pending_members = collections.deque()
+        self._head_check_misses = 0
+
+        checkpoint = checkpoint or {}
+        self.start_index = checkpoint.get('member_index', 0)
+        self.completed_index = self.start_index
+        self.completed_offset = checkpoint.get('tar_offset', 0)
+        self.start_offset = self.completed_offset
+        self.extracted_object_names = list(checkpoint.get('extracted_object_names', []))
+        self.resume_offset = self.completed_offset if checkpoint.get('compression') == 'tar' else 0
+        self.compression = checkpoint.get('compression')
+        if fixity_checker is not None and 'fixity' in checkpoint:
+            fixity_checker.load_dict(checkpoint['fixity'])
+
+    def run(self, body, save_checkpoint, checkpoint_interval) -> dict:
+        reader = transfer_lib.ReadAheadReader(body)
+        try:
+            source = self._open_tar_stream(reader)
+        except Exception as e:
+            reader.close()
+            raise e
+        self._last_checkpoint_time = time.monotonic()
+        self._save_checkpoint = save_checkpoint
+        self._checkpoint_interval = checkpoint_interval
+        complete = True
+        try:
+            try:
+                if self.max_workers > 1:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                        self._executor = executor
+                        self._read_tar(source)
+                else:
+                    self._read_tar(source)
+            except _UnpackStopped:
+                complete = False
+            self._raise_if_failed()
+            if complete and self.index_builder is not None:
+                self.index_builder.finish()
+                self.tar_index = self.index_builder.get_index(self.index_members, self.source_etag)
+        except Exception as e:
+            logger.error(f'untar_s3_object_streaming failed: {e}')
+            self._abort_multipart_uploads()
+            try:
+                self._checkpoint()
+            except Exception as checkpoint_error:
+                logger.error(f'Unable to save checkpoint: {checkpoint_error}')
+            raise e
+        finally:
+            reader.close()
+            if source is not reader and hasattr(source, 'close'):
+                source.close()
+
+        checkpoint = None
+        if not complete:
+            self._abort_multipart_uploads()
+            checkpoint = self._checkpoint()
+            if (checkpoint['member_index'], checkpoint['tar_offset']) == (self.start_index, self.start_offset):
+                raise TarUnpackStalledError(
+                    f'Stopped without completing a member after member_index={self.start_index} '
+                    f'tar_offset={self.start_offset} (e.g. the skip to it, or member {self.start_index}, '
+                    f'takes longer than one run); resuming would not progress')
+
+        self.memory_report['in_flight_high_water_mark_bytes'] = self.budget.high_water_mark
+        self.memory_report['process_max_rss_bytes'] = get_memory_high_water_mark()
+        logger.info(f'untar_s3_object_streaming memory_report={self.memory_report}')
+        result = {
+            KEY_FILES: self.extracted_object_names,
+            KEY_MEMORY_REPORT: self.memory_report,
+            KEY_COMPLETE: complete,
+            KEY_CHECKPOINT: checkpoint
+        }
+        if complete and self.fixity_checker is not None:
+            result[KEY_FIXITY_REPORT] = self.fixity_checker.report()
+        result[KEY_DECOMPRESSION] = self.decompression
+        return result
+
+    def _open_tar_stream(self, reader):
+        """
+        Detect the tar's compression and return a stream of uncompressed tar
+        data, through a `TarIndexBuilder` if an index is to be built.
+        """
+        if self.resume_offset:
+            # Ranged read of a plain tar from a member header
+            compression, stream = 'tar', reader
+        else:
+            header = reader.read(COMPRESSION_SNIFF_SIZE)
+            compression = detect_compression(header)
+            stream = _PrefixedStream(header, reader)
+        if compression is None:
+            raise tarfile.ReadError('Unrecognised archive format')
+        self.compression = compression
+
+        if self.index_span is not None and self.start_index > 0:
+            logger.info('Not building tar index for a resumed unpack')
+        elif self.index_span is not None and compression in ('gz', 'tar'):
+            self.index_builder = TarIndexBuilder(stream, span=self.index_span)
+            self.decompression = {'compression': compression, 'backend': 'zlib' if compression == 'gz' else 'none'}
+            return self.index_builder
+        elif self.index_span is not None:
+            logger.info(f'Not building tar index; {compression} is not indexable')
+
+        stream, backend = open_decompressed_stream(stream, compression, self.decompression_backend)
+        self.decompression = {'compression': compression, 'backend': backend}
+        logger.info(f'Decompressing {compression} tar with backend {backend}')
+        return stream
+
+    def _read_tar(self, reader):
+        base_offset = self.resume_offset
+        index = self.start_index if self.resume_offset else 0
+        with tarfile.open(fileobj=reader, mode='r|') as tar_content:
+            for item in tar_content:
+                member_offset = base_offset + item.offset
+                member_end = base_offset + item.offset_data + \
+                    -(-item.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                if index < self.start_index:
+                    # Skipping a compressed tar up to the checkpoint can take a
+                    # while, so stop (with no progress) rather than time out
+                    if self.should_stop and self.should_stop():
+                        raise _UnpackStopped()
+                    index += 1
+                    continue
+                self._raise_if_failed()
+                self._checkpoint_if_due()
+                if self.should_stop and self.should_stop():
+                    raise _UnpackStopped()
+                logger.info(f'item.isdir()={item.isdir()} item.isFile()={item.isfile()} item.name={item.name} item={item}')
+                if not item.isfile():
+                    self._member_started(index, member_offset, member_end, None)
+                    self._member_task_done(index)
+                    index += 1
+                    continue
+                output_object_name = get_output_object_name(item.name, self.output_prefix)
+                logger.info(f'output_object_name={output_object_name} size={item.size}')
+                if self.index_builder is not None:
+                    self.index_members.append([get_output_object_name(item.name), item.offset_data, item.size])
+                self._member_started(index, member_offset, member_end, output_object_name)
+                if self.fixity_checker is not None:
+                    self.fixity_checker.start_member(get_output_object_name(item.name), item.size)
+                self._unpack_member(index, tar_content.extractfile(item), item, output_object_name)
+                if self.fixity_checker is not None:
+                    self.fixity_checker.finish_member()
+                self._member_task_done(index)
+                self.memory_report['members'] += 1
+                self.memory_report['member_bytes'] += item.size
+                self.memory_report['largest_member_bytes'] = max(
+                    self.memory_report['largest_member_bytes'], item.size)
+                index += 1
+
+    def _unpack_member(self, index, item_stream, item, output_object_name):
+        size = item.size
+        metadata = {METADATA_SOURCE_ETAG: self.source_etag.strip('"'), METADATA_SOURCE_MEMBER: str(index)}
+        if size <= self.buffer_size:
+            self.budget.acquire(size)
+            try:
+                data = self._read(item_stream, size)
+                if self._exists_in_output(output_object_name, size, index, data):
+                    self.memory_report['members_skipped'] += 1
+                    self.budget.release(size)
+                    return
+            except Exception as e:
+                self.budget.release(size)
+                raise e
+            self._submit(
+                index,
+                lambda: self.s3_client.put_object(
+                    Bucket=self.output_bucket_name, Key=output_object_name, Body=data, Metadata=metadata),
+                len(data))
+            return
+
+        if self._exists_in_output(output_object_name, size, index):
+            self.memory_report['members_skipped'] += 1
+            if self.fixity_checker is not None:
+                # Data is decompressed regardless; pass it through for hashing
+                remaining = size
+                while remaining > 0:
+                    remaining -= len(self._read(item_stream, min(self.buffer_size, remaining)))
+            return
+        upload = _MultipartMemberUpload(self.s3_client, self.output_bucket_name, output_object_name, metadata)
+        self._multipart_uploads.append(upload)
+        self.memory_report['multipart_members'] += 1
+        remaining = size
+        while remaining > 0:
+            self._raise_if_failed()
+            if self.should_stop and self.should_stop():
+                raise _UnpackStopped()
+            chunk_size = min(self.buffer_size, remaining)
+            self.budget.acquire(chunk_size)
+            try:
+                chunk = self._read(item_stream, chunk_size)
+            except Exception as e:
+                self.budget.release(chunk_size)
+                raise e
+            remaining -= chunk_size
+            part_number = upload.add_part()
+            self._submit(
+                index,
+                lambda n=part_number, c=chunk: upload.upload_part(n, c),
+                chunk_size)
+        upload.finish()
+
+    def _exists_in_output(self, output_object_name, size, index, data=None) -> bool:
+        """
+        When resuming, return `True` if `output_object_name` already holds
+        this member from a previous run. Only members just after the
+        checkpoint are checked; checking stops after a run of misses.
+        """
+        if self.start_index == 0 or self._head_check_misses >= RESUME_HEAD_CHECK_MAX_MISSES:
+            return False
+        try:
+            head = self.s3_client.head_object(Bucket=self.output_bucket_name, Key=output_object_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise e
+            head = None
+        if head is not None and head['ContentLength'] == size:
+            metadata = head.get('Metadata', {})
+            if metadata.get(METADATA_SOURCE_ETAG) == self.source_etag.strip('"') \
+                    and metadata.get(METADATA_SOURCE_MEMBER) == str(index):
+                return True
+            if data is not None and head['ETag'].strip('"') == hashlib.md5(data).hexdigest():
+                return True
+        self._head_check_misses += 1
+        return False
+
+    def _read(self, item_stream, size) -> bytes:
+        data = item_stream.read(size)
+        if len(data) != size:
+            raise tarfile.ReadError(f'Unexpected end of tar data; read {len(data)} of {size} bytes')
+        if self.fixity_checker is not None:
+            self.fixity_checker.update(data)
+        self.memory_report['buffer_high_water_mark_bytes'] = max(
+            self.memory_report['buffer_high_water_mark_bytes'], size)
+        return data
+
+    def _member_started(self, index, offset, end_offset, output_object_name):
+        with self._lock:
+            # pending starts at 1 for the producer itself; see _member_task_done
+            self._pending_members.append({
+                'index': index,
+                'offset': offset,
+                'end_offset': end_offset,
+                'name': output_object_name,
+                'pending': 1
+            })
+
+    def _member_task_started(self, index):
+        with self._lock:
+            for member in reversed(self._pending_members):
+                if member['index'] == index:
+                    member['pending'] += 1
+                    return
+
+    def _member_task_done(self, index):
+        with self._lock:
+            for member in self._pending_members:
+                if member['index'] == index:
+                    member['pending'] -= 1
+                    break
+            while self._pending_members and self._pending_members[0]['pending'] == 0:
+                member = self._pending_members.popleft()
+                self.completed_index = member['index'] + 1
+                self.completed_offset = member['end_offset']
+                if member['name'] is not None:
+                    # Add extracted object's name to output summary
+                    self.extracted_object_names.append(member['name'])
+
+    def _checkpoint(self) -> dict:
+        with self._lock:
+            state = {
+                'source_etag': self.source_etag,
+                'output_bucket': self.output_bucket_name,
+                'output_prefix': self.output_prefix,
+                'compression': self.compression,
+                'member_index': self.completed_index,
+                'tar_offset': self.completed_offset,
+                'extracted_object_names': list(self.extracted_object_names)
+            }
+        if self.fixity_checker is not None:
+            state['fixity'] = self.fixity_checker.to_dict()
+        self._save_checkpoint(state)
+        self._last_checkpoint_time = time.monotonic()
+        return state
+
+    def _checkpoint_if_due(self):
+        if time.monotonic() - self._last_checkpoint_time >= self._checkpoint_interval:
+            self._checkpoint()
+
+    def _submit(self, index, upload, size):
+        """
+        Run `upload` on the worker pool (or inline); `size` bytes of budget,
+        already acquired by the caller, are released once it finishes.
+        """
+        self._member_task_started(index)
+        if self._executor is None:
+            self._run_upload(index, upload, size)
+            self._raise_if_failed()
+        else:
+            self._executor.submit(self._run_upload, index, upload, size)
+
+    def _run_upload(self, index, upload, size):
+        try:
+            if self._error is None:
+                upload()
+                self._member_task_done(index)
+        except Exception as e:
+            logger.error(f'Upload failed: {e}')
+            if self._error is None:
+                self._error = e
+        finally:
+            self.budget.release(size)
+
+    def _abort_multipart_uploads(self):
+        for upload in self._multipart_uploads:
+            try:
+                upload.abort()
+            except Exception as e:
+                logger.error(f'Unable to abort multipart upload of {upload.key}: {e}')
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+
+class TarIndexError(Exception):
+    """
+    Used to indicate a tar index specific error condition.
+    """
+
+
+def get_tar_index_object_name(object_name) -> str:
+    """
+    Return the s3 object name of the sidecar index for tar `object_name`;
+    stored alongside the tar.
+    """
+    return object_name + TAR_INDEX_SUFFIX
+
+
+def _parse_gzip_header(data, position):
+    """
+    Return the offset just past the gzip member header starting at
+    `position` in `data`, or `None` if `data` ends before the header does.
+    """
+    if len(data) - position < 10:
+        return None
+    if data[position:position + 2] != GZIP_MAGIC or data[position + 2] != 8:
+        raise TarIndexError(f'Invalid gzip header at offset {position}')
+    flags = data[position + 3]
+    position += 10
+    if flags & 0x04:  # FEXTRA
+        if len(data) - position < 2:
+            return None
+        position += 2 + int.from_bytes(data[position:position + 2], 'little')
+    for flag in (0x08, 0x10):  # FNAME, FCOMMENT; zero terminated
+        if flags & flag:
+            end = data.find(b'\0', position)
+            if end < 0:
+                return None
+            position = end + 1
+    if flags & 0x02:  # FHCRC
+        position += 2
+    return position if position <= len(data) else None
+
+
+class TarIndexBuilder:
+    """
+    File-like wrapper over a tar byte stream (e.g. the s3 body of a bag) that
+    returns the uncompressed tar data, so it can be read with `tarfile` mode
+    'r|*', while recording what `TarIndexReader` needs to fetch members later
+    without reading the whole tar.
+
+    For gzip input the deflate stream is decompressed as usual, and in
+    parallel its block boundaries are walked so that zran-style access
+    points (compressed offset, uncompressed offset, preceding 32 KiB window,
+    zlib compressed) can be recorded every `span` uncompressed bytes. Python's zlib does not
+    report block boundaries, so each block is decoded from its (possibly
+    unaligned) start bit with its BFINAL bit forced on: zlib then stops at
+    the block's end, which pins the next block's start to one of 8 bit
+    positions; each candidate is tried and the one whose output matches the
+    true decompressed data is taken. Access points are only placed at
+    byte-aligned block starts, so readers need no bit shifting. If a
+    boundary cannot be determined uniquely indexing is abandoned (`error`
+    is set) but decompression carries on.
+
+    Plain tars need no access points; other compressions are passed through
+    unindexed (`compression` is `None`).
+    """
+
+    _OK = 'ok'
+    _MORE = 'more'
+    _FAIL = 'fail'
+    _DECODE_LIMITS = (4 * 1024, 64 * 1024, 1024 * 1024, None)
+
+    def __init__(self, raw, span: int = TAR_INDEX_SPAN, read_size: int = TAR_INDEX_READ_SIZE):
+        self.raw = raw
+        self.span = span
+        self.read_size = read_size
+        self.compression = None
+        self.compressed_size = 0
+        self.access_points = []
+        self.error = None
+        self._sniffed = False
+        self._raw_eof = False
+        self._out = bytearray()  # uncompressed data from offset self._out_base
+        self._out_base = 0
+        self._read_position = 0
+        self._inflater = None
+        self._inflate_done = False
+        self._fed = 0
+        self._gzip_tail = b''
+        self._member_ends = collections.deque()
+        self._compressed = bytearray()  # compressed data from offset self._compressed_base
+        self._compressed_base = 0
+        self._walk_state = None
+        self._bit = 0
+        self._bit_exact = True
+        self._walk_out = 0
+        self._member_out = 0
+        self._last_access_point_out = None
+        self._decoded = None
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._raw_eof and (size < 0 or self._out_base + len(self._out) - self._read_position < size):
+            self._fill()
+        start = self._read_position - self._out_base
+        end = len(self._out) if size < 0 else start + size
+        data = bytes(self._out[start:end])
+        self._read_position += len(data)
+        self._trim()
+        return data
+
+    def finish(self):
+        """
+        Read (and index) any remaining input after the consumer has finished
+        with the tar data.
+        """
+        while not self._raw_eof:
+            self._fill()
+            self._read_position = self._out_base + len(self._out)
+            self._trim()
+        if self.compression == 'gz' and self._walk_state not in ('done', 'abandoned'):
+            self._abandon(f'walk ended in state {self._walk_state}')
+
+    def _fill(self):
+        chunk = self.raw.read(self.read_size)
+        if not self._sniffed:
+            self._sniffed = True
+            compression = detect_compression(chunk)
+            if compression in ('gz', 'tar'):
+                self.compression = compression
+            if compression == 'gz':
+                self._walk_state = 'header'
+        if not chunk:
+            self._raw_eof = True
+            if self.compression == 'gz':
+                if self._inflater is not None and not self._inflate_done:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                self._walk()
+            return
+        self.compressed_size += len(chunk)
+        if self.compression != 'gz':
+            self._out += chunk
+            return
+        if self._walk_state not in ('done', 'abandoned'):
+            self._compressed += chunk
+        self._inflate(chunk)
+        self._walk()
+
+    def _inflate(self, data):
+        self._fed += len(data)
+        data = self._gzip_tail + data
+        self._gzip_tail = b''
+        while data and not self._inflate_done:
+            if self._inflater is None:
+                if len(data) < 2:
+                    self._gzip_tail = data
+                    return
+                if not data.startswith(GZIP_MAGIC):
+                    # Trailing padding after the last gzip member; ignored
+                    self._inflate_done = True
+                    return
+                self._inflater = zlib.decompressobj(31)
+            self._out += self._inflater.decompress(data)
+            if self._inflater.eof:
+                data = self._inflater.unused_data
+                self._member_ends.append(self._fed - len(data))
+                self._inflater = None
+            else:
+                data = b''
+
+    def _trim(self):
+        keep_from = self._read_position
+        if self._walk_state not in (None, 'done', 'abandoned'):
+            keep_from = min(keep_from, self._walk_out - DEFLATE_WINDOW_SIZE)
+        drop = keep_from - self._out_base
+        if drop > len(self._out) // 2 and drop > self.read_size:
+            del self._out[:drop]
+            self._out_base += drop
+
+    def _abandon(self, reason):
+        logger.warning(f'Unable to index tar; {reason}')
+        self.error = reason
+        self._walk_state = 'abandoned'
+        self._compressed = bytearray()
+
+    def _walk(self):
+        try:
+            while self._walk_state not in ('done', 'abandoned') and self._walk_step():
+                pass
+        except TarIndexError as e:
+            self._abandon(str(e))
+        if self._walk_state not in ('done', 'abandoned'):
+            drop = self._bit // 8 - self._compressed_base
+            if drop > self.read_size:
+                del self._compressed[:drop]
+                self._compressed_base += drop
+
+    def _window(self, out_position) -> bytes:
+        start = max(out_position - DEFLATE_WINDOW_SIZE, self._member_out)
+        return bytes(self._out[start - self._out_base:out_position - self._out_base])
+
+    def _walk_step(self) -> bool:
+        """
+        Advance the walk by a gzip header or one deflate block; return
+        `False` if more input is needed first.
+        """
+        position = self._bit // 8 - self._compressed_base
+        if self._walk_state == 'header':
+            if len(self._compressed) - position < 2 and self._raw_eof:
+                self._walk_state = 'done'
+                return False
+            if len(self._compressed) - position >= 2 and \
+                    self._compressed[position:position + 2] != GZIP_MAGIC:
+                self._walk_state = 'done'
+                return False
+            end = _parse_gzip_header(self._compressed, position)
+            if end is None:
+                if self._raw_eof:
+                    raise TarIndexError('Truncated gzip header')
+                return False
+            self._bit = (self._compressed_base + end) * 8
+            self._member_out = self._walk_out
+            self._walk_state = 'blocks'
+            return True
+
+        if not self._raw_eof and len(self._compressed) - position < TAR_INDEX_LOOKAHEAD:
+            return False
+        window = self._window(self._walk_out)
+        if self._decoded is not None and self._decoded[0] == self._bit:
+            status, block = self._decoded[1]
+        else:
+            status, block = self._try_block(self._bit, window, self._walk_out)
+        if status == self._MORE:
+            return False
+        if status == self._FAIL:
+            raise TarIndexError(f'Invalid deflate block at bit {self._bit}')
+        final, out_length, next_bits = block
+
+        if self._bit % 8 == 0 and self._bit_exact and (
+                self._last_access_point_out is None
+                or self._walk_out == self._member_out
+                or self._walk_out - self._last_access_point_out >= self.span):
+            # Windows are kept compressed; a raw 32 KiB per span adds up
+            self.access_points.append([self._bit // 8, self._walk_out, zlib.compress(window)])
+            self._last_access_point_out = self._walk_out
+
+        next_out = self._walk_out + out_length
+        if final:
+            if not self._member_ends:
+                if self._raw_eof:
+                    raise TarIndexError('Gzip member end not found')
+                self._decoded = (self._bit, (status, block))
+                return False
+            self._bit = self._member_ends.popleft() * 8
+            self._bit_exact = True
+            self._walk_out = next_out
+            self._decoded = None
+            self._walk_state = 'header'
+            return True
+
+        valid = self._select_blocks(next_bits, self._window(next_out), next_out)
+        if valid is None:
+            self._decoded = (self._bit, (status, block))
+            return False
+        if len({outcome for _, _, outcome in valid}) != 1:
+            raise TarIndexError(
+                f'{len(valid)} candidate block boundaries after bit {self._bit}')
+        # Candidates with the same outcome arise from e.g. a stored block
+        # header found at several positions within its padding byte, or a
+        # phantom empty block before it; decoding is the same from any of
+        # them, but the true start is unknown so no access point is placed
+        # there. Non-empty candidates are preferred.
+        next_bit, result, _ = max(valid, key=lambda candidate: candidate[1][1][1] > 0)
+        final, length, bits = result[1]
+        if len({candidate[1][1][0] for candidate in valid if candidate[1][1][1] > 0}) > 1:
+            # Whether the block is the last in its gzip member is settled by
+            # where that member ends
+            trailer_end = -(-bits[0] // 8) + 8
+            if self._fed < trailer_end and not self._raw_eof:
+                self._decoded = (self._bit, (status, block))
+                return False
+            result = (self._OK, (trailer_end in self._member_ends, length, bits))
+        self._bit = next_bit
+        self._bit_exact = len(valid) == 1
+        self._decoded = (self._bit, result)
+        self._walk_out = next_out
+        return True
+
+    def _select_blocks(self, bits, window, out_position, depth=0):
+        """
+        Return [(bit, result, outcome)] for the candidate block starts in
+        `bits` that decode to the true data, or `None` if more input is
+        needed to tell. `outcome` is the (output length, next block starts)
+        of the first non-empty block reached. A candidate decoding to an
+        empty block matches trivially, so it only counts if a block that
+        follows it also checks out.
+        """
+        results = [(bit, self._try_block(bit, window, out_position)) for bit in bits]
+        if any(result[0] == self._MORE for _, result in results):
+            return None
+        valid = []
+        for bit, result in results:
+            if result[0] != self._OK:
+                continue
+            final, length, next_bits = result[1]
+            outcome = (length, tuple(next_bits))
+            if length == 0 and final:
+                # Must be followed by the gzip trailer
+                if self._fed < -(-next_bits[-1] // 8) + 8 and not self._raw_eof:
+                    return None
+                if not any(-(-b // 8) + 8 in self._member_ends for b in next_bits):
+                    continue
+                outcome = ('end',)
+            elif length == 0:
+                if depth >= TAR_INDEX_MAX_EMPTY_BLOCKS:
+                    continue
+                following = self._select_blocks(next_bits, window, out_position, depth + 1)
+                if following is None:
+                    return None
+                outcomes = {following_outcome for _, _, following_outcome in following}
+                if not outcomes:
+                    continue
+                outcome = outcomes.pop() if len(outcomes) == 1 else ('ambiguous', bit)
+            valid.append((bit, result, outcome))
+        return valid
+
+    def _try_block(self, bit, window, out_position):
+        """
+        Decode the deflate block starting at absolute `bit` and check its
+        output against the true data at `out_position`. Returns
+        (status, (final, output length, possible next block start bits)).
+        """
+        position = bit // 8 - self._compressed_base
+        available = len(self._compressed) - position
+        if available < 3:
+            return (self._FAIL if self._raw_eof else self._MORE), None
+        header = (self._compressed[position] | self._compressed[position + 1] << 8) >> (bit % 8)
+        final = header & 1
+        block_type = (header >> 1) & 3
+        if block_type == 3:
+            return self._FAIL, None
+        if block_type == 0:
+            return self._try_stored_block(bit, final, out_position)
+
+        for limit in self._DECODE_LIMITS:
+            status, out_length, used_bytes, valid_bits = self._inflate_forced(
+                bit, window, out_position, limit)
+            if status != self._MORE or limit is None or limit >= available:
+                break
+        if status != self._OK:
+            return status, None
+        # The block ended somewhere in the last byte zlib consumed
+        next_bits = [bit + end for end in range(8 * (used_bytes - 1) + 1, 8 * used_bytes + 1)
+                     if end <= valid_bits]
+        return self._OK, (final, out_length, next_bits)
+
+    def _try_stored_block(self, bit, final, out_position):
+        position = -(-(bit + 3) // 8) - self._compressed_base
+        if len(self._compressed) - position < 4:
+            return (self._FAIL if self._raw_eof else self._MORE), None
+        length = int.from_bytes(self._compressed[position:position + 2], 'little')
+        if length ^ 0xFFFF != int.from_bytes(self._compressed[position + 2:position + 4], 'little'):
+            return self._FAIL, None
+        data = self._compressed[position + 4:position + 4 + length]
+        expected = self._out[out_position - self._out_base:out_position - self._out_base + len(data)]
+        if data[:len(expected)] != expected:
+            return self._FAIL, None
+        if len(data) < length or len(expected) < length:
+            return (self._FAIL if self._raw_eof else self._MORE), None
+        next_bit = (self._compressed_base + position + 4 + length) * 8
+        return self._OK, (final, length, [next_bit])
+
+    def _inflate_forced(self, bit, window, out_position, limit):
+        """
+        Raw-inflate up to `limit` compressed bytes from absolute `bit` with
+        the BFINAL bit forced on. Returns
+        (status, output length, bytes consumed, valid input bits).
+        """
+        position = bit // 8 - self._compressed_base
+        chunk = self._compressed[position:] if limit is None else self._compressed[position:position + limit]
+        shift = bit % 8
+        if shift:
+            # Drop the last byte, whose top bits would otherwise be zero fill
+            chunk = bytearray((int.from_bytes(chunk, 'little') >> shift).to_bytes(len(chunk), 'little'))[:-1]
+        else:
+            chunk = bytearray(chunk)
+        if not chunk:
+            return (self._FAIL if self._raw_eof else self._MORE), 0, 0, 0
+        valid_bits = len(chunk) * 8
+        chunk[0] |= 1
+        input_complete = self._raw_eof and (limit is None or position + limit >= len(self._compressed))
+        out_start = out_position - self._out_base
+        true_length = len(self._out) - out_start
+        inflater = zlib.decompressobj(-15, zdict=window) if window else zlib.decompressobj(-15)
+        try:
+            out = inflater.decompress(bytes(chunk), true_length + 1)
+        except zlib.error:
+            return self._FAIL, 0, 0, 0
+        if out != self._out[out_start:out_start + len(out)]:
+            return self._FAIL, 0, 0, 0
+        if inflater.eof:
+            used_bytes = len(chunk) - len(inflater.unused_data)
+            return self._OK, len(out), used_bytes, valid_bits
+        if len(out) > true_length and self._inflate_done:
+            return self._FAIL, 0, 0, 0
+        return (self._FAIL if input_complete else self._MORE), 0, 0, 0
+
+    def get_index(self, members: list, source_etag: str = None):
+        """
+        Return the index as a JSON serialisable dict, or `None` if the input
+        could not be indexed.
+
+        :param members: List of [member name, data offset, size] in tar order
+        :param source_etag: ETag of the indexed s3 object
+        """
+        if self.compression is None or self.error is not None:
+            return None
+        return {
+            'version': TAR_INDEX_VERSION,
+            'source_etag': source_etag,
+            'compression': self.compression,
+            'compressed_size': self.compressed_size,
+            'span': self.span,
+            'members': members,
+            'access_points': [
+                [offset, out, base64.b64encode(window).decode()]
+                for offset, out, window in self.access_points]
+        }
+
+
+def save_tar_index(s3_client, bucket_name, object_name, index) -> str:
+    """
+    Store `index` (from `TarIndexBuilder.get_index`) next to `object_name`
+    and return the index object name.
+    """
+    index_object_name = get_tar_index_object_name(object_name)
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=index_object_name,
+        Body=json.dumps(index).encode(),
+        ContentType='application/json')
+    logger.info(
+        f'Saved tar index {index_object_name}: members={len(index["members"])} '
+        f'access_points={len(index["access_points"])}')
+    return index_object_name
+
+
+def build_tar_index(bucket_name, object_name, span=TAR_INDEX_SPAN, s3_client=None):
+    """
+    Read tar `object_name` once and store its sidecar index (see
+    `TarIndexBuilder`); for tars that were unpacked without
+    `build_index`. Returns the index object name, or `None` if the tar could
+    not be indexed.
+    """
+    logger.info(f'build_tar_index start: bucket_name={bucket_name} object_name={object_name}')
+    s3_client = s3_client or client_lib.get_client('s3')
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+    reader = transfer_lib.ReadAheadReader(s3_object['Body'])
+    try:
+        header = reader.read(COMPRESSION_SNIFF_SIZE)
+        compression = detect_compression(header)
+        if compression not in ('gz', 'tar'):
+            logger.info(f'Not building tar index; {compression} is not indexable')
+            return None
+        builder = TarIndexBuilder(_PrefixedStream(header, reader), span=span)
+        members = []
+        with tarfile.open(fileobj=builder, mode='r|') as tar_content:
+            for item in tar_content:
+                if item.isfile():
+                    members.append([get_output_object_name(item.name), item.offset_data, item.size])
+        builder.finish()
+    finally:
+        reader.close()
+    index = builder.get_index(members, s3_object['ETag'])
+    if index is None:
+        return None
+    return save_tar_index(s3_client, bucket_name, object_name, index)
+
+
+class TarIndexReader:
+    """
+    Fetch individual members of a tar in s3 using its sidecar index: one
+    ranged GET from the nearest access point, then a decompress bounded by
+    the index span plus the member size.
+
+    :param bucket_name: Bucket holding the tar and its index
+    :param object_name: The tar's object name
+    :param index: Optional index dict; loaded from s3 if omitted
+    :param s3_client: Optionally pass an existing boto3.client('s3') instance
+    """
+
+    def __init__(self, bucket_name, object_name, index=None, s3_client=None):
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.s3_client = s3_client or client_lib.get_client('s3')
+        if index is None:
+            response = self.s3_client.get_object(
+                Bucket=bucket_name, Key=get_tar_index_object_name(object_name))
+            index = json.loads(response['Body'].read())
+        if index.get('version') != TAR_INDEX_VERSION:
+            raise TarIndexError(f'Unsupported tar index version {index.get("version")}')
+        self.index = index
+        self.members = {name: (offset, size) for name, offset, size in index['members']}
+        self._access_point_outs = [out for _, out, _ in index['access_points']]
+
+    def member_names(self) -> list:
+        return [name for name, _, _ in self.index['members']]
+
+    def read_member(self, member_name) -> bytes:
+        """
+        Return the content of tar member `member_name` (named as in the
+        unpacked output, without any output prefix).
+        """
+        if member_name not in self.members:
+            raise TarIndexError(f'Member "{member_name}" not in index of {self.object_name}')
+        offset, size = self.members[member_name]
+        if size == 0:
+            return b''
+        if self.index['compression'] == 'tar':
+            return self._get_range(offset, offset + size - 1)
+
+        access_points = self.index['access_points']
+        first = bisect.bisect_right(self._access_point_outs, offset) - 1
+        last = bisect.bisect_left(self._access_point_outs, offset + size)
+        start_offset, start_out, window = access_points[first]
+        end = access_points[last][0] - 1 if last < len(access_points) else None
+        data = self._get_range(start_offset, end)
+        window = zlib.decompress(base64.b64decode(window))
+        return _inflate_range(data, window, offset - start_out, size)
+
+    def _get_range(self, start, end) -> bytes:
+        byte_range = f'bytes={start}-' if end is None else f'bytes={start}-{end}'
+        args = {'Bucket': self.bucket_name, 'Key': self.object_name, 'Range': byte_range}
+        if self.index.get('source_etag'):
+            args['IfMatch'] = self.index['source_etag']
+        return self.s3_client.get_object(**args)['Body'].read()
+
+
+def _inflate_range(data, window, skip, size) -> bytes:
+    """
+    Raw-inflate `data` (starting at a byte-aligned deflate block) until
+    `skip` + `size` bytes are produced and return the last `size` of them;
+    gzip member boundaries within `data` are stepped over.
+    """
+    inflater = zlib.decompressobj(-15, zdict=window) if window else zlib.decompressobj(-15)
+    needed = skip + size
+    out = bytearray()
+    while True:
+        out += inflater.decompress(data, needed - len(out))
+        if len(out) >= needed:
+            return bytes(out[skip:needed])
+        if inflater.eof:
+            data = inflater.unused_data[8:]  # CRC32 and ISIZE
+            header_end = _parse_gzip_header(data, 0)
+            if header_end is None:
+                raise TarIndexError('Tar data ended before member end')
+            data = data[header_end:]
+            inflater = zlib.decompressobj(-15)
+        else:
+            data = inflater.unconsumed_tail
+            if not data:
+                raise TarIndexError('Tar data ended before member end')
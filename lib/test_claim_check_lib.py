@@ -0,0 +1,66 @@
+import gzip
+import io
+import unittest
+import claim_check_lib
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+        self.puts += 1
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+class TestClaimCheckLib(unittest.TestCase):
+    def setUp(self):
+        claim_check_lib._known_references.clear()
+        self.s3 = FakeS3Client()
+        self.event = {
+            'bag_name': 'bag.tar.gz',
+            'unpack_complete': True,
+            'unpacked_files': [f'ayr-in/bag.tar.gz/bag/data/file-{i}.txt' for i in range(200)],
+            'fixity_report': {'valid': True}
+        }
+
+    def test_small_event_inline(self):
+        self.assertIs(claim_check_lib.check_in(self.event, ['unpacked_files'], 'b', s3_client=self.s3), self.event)
+        self.assertEqual(self.s3.puts, 0)
+
+    def test_round_trip(self):
+        event = claim_check_lib.check_in(
+            self.event, ['unpacked_files', 'fixity_report'], 'b', threshold_bytes=1024, s3_client=self.s3)
+        self.assertTrue(claim_check_lib.is_reference(event['unpacked_files']))
+        # Enough was checked in; the rest stays inline
+        self.assertEqual(event['fixity_report'], {'valid': True})
+        self.assertIs(event['unpack_complete'], True)
+        self.assertEqual(self.s3.puts, 1)
+
+        claim_check_lib._known_references.clear()
+        self.assertEqual(claim_check_lib.resolve(event, s3_client=self.s3), self.event)
+
+        # A resolved value passed on is not written again
+        again = claim_check_lib.check_in(
+            claim_check_lib.resolve(event, s3_client=self.s3), ['unpacked_files'], 'b',
+            threshold_bytes=1024, s3_client=self.s3)
+        self.assertEqual(again, event)
+        self.assertEqual(self.s3.puts, 1)
+
+    def test_no_bucket(self):
+        self.assertIs(claim_check_lib.check_in(self.event, ['unpacked_files'], None, threshold_bytes=1), self.event)
+
+    def test_checksum_mismatch(self):
+        reference = claim_check_lib.put_value([1, 2, 3], 'b', s3_client=self.s3)
+        key = ('b', reference[claim_check_lib.KEY_CLAIM_CHECK]['s3_key'])
+        self.s3.objects[key] = gzip.compress(b'[1,2,4]')
+        with self.assertRaises(claim_check_lib.ClaimCheckError):
+            claim_check_lib.get_value(reference, s3_client=self.s3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import threading
+import unittest
+import client_lib
+
+
+class TestClientLib(unittest.TestCase):
+    def setUp(self):
+        client_lib.reset_clients()
+
+    def tearDown(self):
+        client_lib.reset_clients()
+
+    def test_client_reused(self):
+        client = client_lib.get_client('s3', region_name='eu-west-2')
+        self.assertIs(client_lib.get_client('s3', region_name='eu-west-2'), client)
+        self.assertEqual(client.meta.config.retries['mode'], client_lib.CLIENT_RETRY_MODE)
+        self.assertTrue(client.meta.config.tcp_keepalive)
+        stats = client_lib.get_client_stats()
+        self.assertEqual(stats['clients_created'], 1)
+        self.assertEqual(stats['clients_reused'], 1)
+
+    def test_config_overrides(self):
+        client = client_lib.get_client('s3', region_name='eu-west-2')
+        larger = client_lib.get_client('s3', region_name='eu-west-2', max_pool_connections=100)
+        self.assertIsNot(larger, client)
+        self.assertEqual(larger.meta.config.max_pool_connections, 100)
+        # Overrides matching the defaults share the default client
+        self.assertIs(
+            client_lib.get_client(
+                's3', region_name='eu-west-2',
+                max_pool_connections=client_lib.CLIENT_MAX_POOL_CONNECTIONS),
+            client)
+
+    def test_resource_per_thread(self):
+        resource = client_lib.get_resource('s3', region_name='eu-west-2')
+        self.assertIs(client_lib.get_resource('s3', region_name='eu-west-2'), resource)
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(client_lib.get_resource('s3', region_name='eu-west-2')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], resource)
+        self.assertEqual(client_lib.get_client_stats()['resources_created'], 2)
@@ -0,0 +1,102 @@
+import hashlib
+import unittest
+import fixity_lib
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_bag(payload: dict, manifest_payload: dict = None, oxum: str = None) -> dict:
+    """
+    Return {member name: data} for a bag rooted at "bag/"; the manifest lists
+    `manifest_payload` (default `payload`).
+    """
+    manifest_payload = payload if manifest_payload is None else manifest_payload
+    if oxum is None:
+        oxum = f'{sum(len(d) for d in payload.values())}.{len(payload)}'
+    members = {f'bag/data/{name}': data for name, data in payload.items()}
+    members['bag/bagit.txt'] = b'BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n'
+    members['bag/bag-info.txt'] = f'Source-Organization: Test\nPayload-Oxum: {oxum}\n'.encode()
+    members['bag/manifest-sha256.txt'] = ''.join(
+        f'{sha256(data)}  data/{name}\n' for name, data in manifest_payload.items()).encode()
+    members['bag/tagmanifest-sha256.txt'] = ''.join(
+        f'{sha256(members[f"bag/{name}"])} {name}\n'
+        for name in ('bagit.txt', 'bag-info.txt', 'manifest-sha256.txt')).encode()
+    return members
+
+
+def check(members: dict, order=None, chunk_size=7) -> dict:
+    checker = fixity_lib.BagFixityChecker()
+    for name in order or members:
+        data = members[name]
+        checker.start_member(name, len(data))
+        for i in range(0, len(data), chunk_size):
+            checker.update(data[i:i + chunk_size])
+        checker.finish_member()
+    return checker.report()
+
+
+class TestBagFixityChecker(unittest.TestCase):
+    payload = {'a.txt': b'alpha', 'sub/b%.txt': b'bravo' * 100}
+
+    def test_valid_bag_manifest_last(self):
+        members = make_bag(self.payload)
+        order = sorted(members, key=lambda n: 'manifest' in n)
+        report = check(members, order)
+        self.assertTrue(report['valid'])
+        self.assertEqual(report['files_checked'], 5)
+        self.assertEqual(report['payload_oxum']['bag/']['expected'], report['payload_oxum']['bag/']['actual'])
+
+    def test_missing_extra_mismatched(self):
+        manifest_payload = {'a.txt': b'not alpha', 'gone.txt': b'gone', 'sub/b%.txt': b'bravo' * 100}
+        members = make_bag(dict(self.payload, **{'new.txt': b'new'}), manifest_payload)
+        report = check(members)
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['missing'], ['bag/data/gone.txt'])
+        self.assertEqual(report['extra'], ['bag/data/new.txt'])
+        self.assertEqual(report['mismatched'], ['bag/data/a.txt'])
+
+    def test_literal_percent_escapes(self):
+        # "%20" in a manifest path is literal; only "%25" (and CR/LF) is decoded
+        members = make_bag(
+            {'a%20b.txt': b'alpha', '100%.txt': b'bravo'}, {'a%20b.txt': b'alpha', '100%25.txt': b'bravo'})
+        self.assertTrue(check(members)['valid'])
+
+    def test_payload_oxum_mismatch(self):
+        report = check(make_bag(self.payload, oxum='1.1'))
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['payload_oxum'], {'bag/': {'expected': '1.1', 'actual': '505.2'}})
+
+    def test_payload_oxum_checked_per_root(self):
+        members = make_bag(self.payload, oxum='1.1')
+        members.update({name.replace('bag/', 'other/', 1): data for name, data in make_bag(self.payload).items()})
+        # The mismatched root is not hidden by a later valid one
+        report = check(members)
+        self.assertFalse(report['valid'])
+        self.assertEqual(sorted(report['payload_oxum']), ['bag/', 'other/'])
+        self.assertEqual(report['payload_oxum']['other/'], {'expected': '505.2', 'actual': '505.2'})
+
+    def test_invalid_utf8_reported(self):
+        members = make_bag(self.payload)
+        members['bag/bag-info.txt'] += b'Contact-Name: \xff\n'
+        members['bag/manifest-sha256.txt'] += b'00  data/\xff.txt\n'
+        report = check(members, sorted(members, key=lambda n: 'manifest' in n))
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['missing'], ['bag/data/\ufffd.txt'])
+
+    def test_state_round_trip(self):
+        members = make_bag(self.payload)
+        names = list(members)
+        checker = fixity_lib.BagFixityChecker()
+        for name in names[:3]:
+            checker.start_member(name, len(members[name]))
+            checker.update(members[name])
+            checker.finish_member()
+        resumed = fixity_lib.BagFixityChecker()
+        resumed.load_dict(checker.to_dict())
+        for name in names[3:]:
+            resumed.start_member(name, len(members[name]))
+            resumed.update(members[name])
+            resumed.finish_member()
+        self.assertTrue(resumed.report()['valid'])
@@ -0,0 +1,80 @@
+import json
+import random
+import unittest
+import index_shard_lib
+from s3_bag_reader import S3BagReader
+from test_s3_bag_reader import FakeS3Api
+
+PREFIX = 'ayr-in/bag.tar.gz/bag/'
+
+
+class TestIndexShardLib(unittest.TestCase):
+    prefix = PREFIX
+    objects = {
+        prefix + 'bag-info.txt': b'Source-Organization: Example\n',
+        prefix + 'bagit.txt': b'BagIt-Version: 1.0\n',
+        prefix + 'file-metadata.csv': 'Filepath,Filesize,Title\r\n'.encode() + b''.join(
+            f'data/{i}.txt,{i},"Tïtle, {i}"\r\n'.encode() for i in range(50)),
+        prefix + 'file-av.csv': b'',
+        prefix + 'manifest-sha256.txt': b''.join(f'{i:064x}  data/{i}.txt\n'.encode() for i in range(50)),
+        prefix + 'tagmanifest-sha256.txt': b'cc bag-info.txt\n',
+        **{PREFIX + f'data/{i}.txt': b'x' * (i * 7) for i in range(50)},
+        prefix + 'data/z.pdf': b'%PDF'
+    }
+
+    def get_bag(self):
+        return S3BagReader(
+            s3_bucket='b', file_list=list(self.objects), path_prefix=self.prefix,
+            s3_api=FakeS3Api(self.objects))
+
+    def test_same_as_read_all(self):
+        bag = self.get_bag()
+        expected = bag.read_all(max_file_bytes=100, max_total_bytes=1000)
+        for max_csv_bytes in [7, 100, 1 << 20]:
+            with self.subTest(max_csv_bytes=max_csv_bytes):
+                shards = index_shard_lib.plan_shards(
+                    bag, max_sub_files=3, max_csv_bytes=max_csv_bytes, max_file_bytes=100, max_total_bytes=1000)
+                results = [index_shard_lib.process_shard(bag, shard) for shard in shards]
+                random.Random(max_csv_bytes).shuffle(results)
+                data = index_shard_lib.merge_shard_results(results)
+                self.assertEqual(data, expected)
+                self.assertEqual(list(data), list(expected))
+        self.assertEqual(shards[-1][index_shard_lib.KEY_KIND], index_shard_lib.KIND_SUB_FILES_SPENT)
+
+    def test_run_locally(self):
+        bag = self.get_bag()
+        shards = index_shard_lib.plan_shards(bag, max_csv_bytes=100)
+        expected = bag.read_all()
+        self.assertEqual(index_shard_lib.run_shards_locally(bag, shards, max_workers=4), expected)
+        self.assertEqual(index_shard_lib.run_shards_locally(bag, shards, max_workers=2, processes=True), expected)
+
+    def test_plan_size(self):
+        objects = dict(self.objects)
+        objects.update({PREFIX + f'data/long/folder/name/{i:05}.txt': b'x' for i in range(5000)})
+        bag = S3BagReader(s3_bucket='b', file_list=list(objects), path_prefix=PREFIX, s3_api=FakeS3Api(objects))
+        shards = index_shard_lib.plan_shards(bag)
+        # Shards hold index ranges, not file names
+        self.assertLess(len(json.dumps(shards)), 16 * 1024)
+
+    def test_csv_range_read(self):
+        objects = dict(self.objects)
+        objects[PREFIX + 'file-metadata.csv'] = b'Filepath,Filesize\r\n' + b''.join(
+            f'data/{i}.txt,{i}\r\n'.encode() for i in range(20000))
+        bag = S3BagReader(s3_bucket='b', file_list=list(objects), path_prefix=PREFIX, s3_api=FakeS3Api(objects))
+        shards = index_shard_lib.plan_shards(bag, max_csv_bytes=1000)
+        shard = [shard for shard in shards if shard.get('name') == S3BagReader.BAG_FILE_METADATA][5]
+        result = index_shard_lib.process_shard(bag, shard)
+        rows = result['data'][S3BagReader.BAG_FILE_METADATA]
+        self.assertTrue(all(row['Filepath'] == f"data/{row['Filesize']}.txt" for row in rows))
+        # The range, the line over its end and the header; not the rest of the file
+        self.assertLessEqual(bag.s3_api.bytes_read, 1002 + 2 * index_shard_lib.SHARD_LINE_READ_BYTES)
+
+    def test_missing_shard(self):
+        bag = self.get_bag()
+        results = [index_shard_lib.process_shard(bag, shard) for shard in index_shard_lib.plan_shards(bag)]
+        with self.assertRaises(index_shard_lib.ShardError):
+            index_shard_lib.merge_shard_results(results[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
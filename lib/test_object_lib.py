@@ -0,0 +1,481 @@
+import base64
+import hashlib
+import threading
+import unittest
+import unittest.mock
+import botocore.exceptions
+import botocore.stub
+import client_lib
+import object_lib
+from object_lib import parse_s3_url
+from test_tar_lib import FakeS3Client
+
+
+class TestParseS3Url(unittest.TestCase):
+    def test_virtual_hosted_presigned_url(self):
+        self.assertEqual(
+            parse_s3_url(
+                'https://tre-out.s3.eu-west-2.amazonaws.com/'
+                'consignments/TDR-2022-D6WD.tar.gz?X-Amz-Signature=abc'),
+            ('tre-out', 'consignments/TDR-2022-D6WD.tar.gz'))
+
+    def test_path_style_url(self):
+        self.assertEqual(
+            parse_s3_url('https://s3.eu-west-2.amazonaws.com/tre-out/a%20b.tar.gz'),
+            ('tre-out', 'a b.tar.gz'))
+
+    def test_non_s3_url(self):
+        self.assertIsNone(
+            parse_s3_url('https://github.com/nationalarchives/x.tar.gz?raw=true'))
+        self.assertIsNone(parse_s3_url('https://s3.eu-west-2.amazonaws.com/tre-out'))
+
+
+class TestS3Listing(unittest.TestCase):
+    def setUp(self):
+        client_lib.reset_clients()
+        self.s3 = client_lib.get_client('s3', region_name='eu-west-2')
+        self.stubber = botocore.stub.Stubber(self.s3)
+        self.stubber.activate()
+        self.patch = unittest.mock.patch.object(client_lib, 'get_client', return_value=self.s3)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.stubber.deactivate()
+        client_lib.reset_clients()
+
+    def test_key_exists(self):
+        self.stubber.add_response('head_object', {}, {'Bucket': 'b', 'Key': 'k'})
+        self.stubber.add_client_error('head_object', '404', http_status_code=404)
+        self.assertTrue(object_lib.s3_key_exists('b', 'k'))
+        self.assertFalse(object_lib.s3_key_exists('b', 'missing'))
+
+    def test_object_exists_lists_one_key(self):
+        self.stubber.add_response(
+            'list_objects_v2', {'KeyCount': 1, 'Contents': [{'Key': 'a/b'}]},
+            {'Bucket': 'b', 'Prefix': 'a/', 'MaxKeys': 1})
+        self.assertTrue(object_lib.s3_object_exists('b', 'a/'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_ls_pages(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': 'a/1'}], 'IsTruncated': True, 'NextContinuationToken': 't'},
+            {'Bucket': 'b', 'Prefix': 'a/'})
+        self.stubber.add_response(
+            'list_objects_v2', {'Contents': [{'Key': 'a/2'}], 'IsTruncated': False},
+            {'Bucket': 'b', 'Prefix': 'a/', 'ContinuationToken': 't'})
+        keys = object_lib.s3_ls('b', 'a/')
+        self.assertEqual(next(keys), 'a/1')
+        self.assertEqual(list(keys), ['a/2'])
+
+    def test_max_subfolder_number(self):
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'CommonPrefixes': [
+                {'Prefix': 'alpha/bravo/1/'}, {'Prefix': 'alpha/bravo/10/'},
+                {'Prefix': 'alpha/bravo/9/'}, {'Prefix': 'alpha/bravo/golf/'}]},
+            {'Bucket': 'foo', 'Prefix': 'alpha/bravo/', 'Delimiter': '/'})
+        self.assertEqual(object_lib.get_max_s3_subfolder_number('foo', 'alpha/bravo/'), 10)
+
+
+class TestConditionalWrites(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+
+    def test_string_to_s3_object(self):
+        with unittest.mock.patch.object(client_lib, 'get_client', return_value=self.s3):
+            object_lib.string_to_s3_object('a', 'b', 'k', conditional_write=True)
+            with self.assertRaises(object_lib.ObjectExistsError):
+                object_lib.string_to_s3_object('b', 'b', 'k', conditional_write=True)
+        self.assertEqual(self.s3.objects[('b', 'k')], b'a')
+
+    def test_duplicate_ingest_refused(self):
+        marker = object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3)
+        marker.acquire(source='bag.tar.gz')
+        with self.assertRaises(object_lib.ObjectExistsError):
+            object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3).acquire()
+        marker.complete()
+        with self.assertRaises(object_lib.ObjectExistsError):
+            object_lib.IngestMarker('b', 'bag.tar.gz', lease_seconds=0, s3_client=self.s3).acquire()
+
+    def test_release_allows_retry(self):
+        marker = object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3)
+        marker.acquire()
+        marker.release()
+        object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3).acquire()
+
+    def test_stale_lease_taken_over_once(self):
+        original = object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3)
+        original.acquire()
+        takeover = object_lib.IngestMarker('b', 'bag.tar.gz', lease_seconds=0, s3_client=self.s3)
+        takeover.acquire()
+        # The original holder can no longer complete the marker
+        with self.assertRaises(botocore.exceptions.ClientError):
+            original.complete()
+        takeover.complete()
+
+    def test_complete_retried(self):
+        marker = object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3)
+        marker.acquire()
+        put_object = self.s3.put_object
+        errors = [botocore.exceptions.ClientError(
+            {'Error': {'Code': 'InternalError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}}, 'PutObject')]
+
+        def flaky_put_object(**kwargs):
+            if errors:
+                raise errors.pop()
+            return put_object(**kwargs)
+
+        with unittest.mock.patch.object(self.s3, 'put_object', side_effect=flaky_put_object), \
+                unittest.mock.patch.object(object_lib.transfer_lib.time, 'sleep'):
+            marker.complete()
+        with self.assertRaises(object_lib.ObjectExistsError):
+            object_lib.IngestMarker('b', 'bag.tar.gz', lease_seconds=0, s3_client=self.s3).acquire()
+
+    def test_failed_complete_releases_marker(self):
+        marker = object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3)
+        marker.acquire()
+        with unittest.mock.patch.object(self.s3, 'put_object', side_effect=ValueError('denied')):
+            with self.assertRaises(ValueError):
+                marker.complete()
+        # Not left IN_PROGRESS until the lease expires
+        object_lib.IngestMarker('b', 'bag.tar.gz', s3_client=self.s3).acquire()
+
+
+def server_error(operation):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': 'InternalError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}}, operation)
+
+
+class TestMultipartTransfer(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        patch = unittest.mock.patch.object(object_lib.transfer_lib.time, 'sleep')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_transfer(self, **kwargs):
+        return object_lib.MultipartTransfer(self.s3, 'out', 'bag.tar.gz', max_attempts=3, **kwargs)
+
+    def test_part_retried(self):
+        upload_part = self.s3.upload_part
+        calls = []
+
+        def flaky_upload_part(**kwargs):
+            calls.append(kwargs['PartNumber'])
+            if len(calls) <= 2:
+                raise server_error('UploadPart')
+            return upload_part(**kwargs)
+
+        transfer = self.get_transfer()
+        transfer.initiate()
+        with unittest.mock.patch.object(self.s3, 'upload_part', side_effect=flaky_upload_part):
+            transfer.upload_part(1, b'alpha')
+        self.assertEqual(calls, [1, 1, 1])
+        transfer.upload_part(2, b'bravo')
+        transfer.verify(part_count=2)
+        transfer.complete()
+        self.assertEqual(transfer.state, transfer.STATE_COMPLETED)
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], b'alphabravo')
+
+    def test_part_retries_exhausted(self):
+        transfer = self.get_transfer()
+        transfer.initiate()
+        with unittest.mock.patch.object(
+                self.s3, 'upload_part', side_effect=server_error('UploadPart')) as upload_part:
+            with self.assertRaises(botocore.exceptions.ClientError):
+                transfer.upload_part(1, b'alpha')
+        self.assertEqual(upload_part.call_count, 3)
+        transfer.abort()
+        self.assertEqual(transfer.state, transfer.STATE_ABORTED)
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+
+    def test_missing_part_not_completed(self):
+        transfer = self.get_transfer()
+        transfer.initiate()
+        transfer.upload_part(2, b'bravo')
+        with self.assertRaises(ValueError):
+            transfer.verify(part_count=2)
+        transfer.abort()
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+        with self.assertRaises(object_lib.S3LibError):
+            transfer.complete()
+        self.assertNotIn(('out', 'bag.tar.gz'), self.s3.objects)
+
+    def test_checksum_mismatch_not_completed(self):
+        transfer = self.get_transfer()
+        transfer.initiate()
+        transfer.upload_part(1, b'alpha')
+        with self.assertRaises(ValueError):
+            transfer.verify(hex_digest='aa', expected_checksum='bb', part_count=1)
+        self.assertEqual(transfer.state, transfer.STATE_VERIFYING)
+
+    def test_existing_object_not_replaced(self):
+        self.s3.objects[('out', 'bag.tar.gz')] = b'original'
+        transfer = self.get_transfer(if_none_match=True)
+        transfer.initiate()
+        transfer.upload_part(1, b'alpha')
+        transfer.verify(part_count=1)
+        with self.assertRaises(object_lib.ObjectExistsError):
+            transfer.complete()
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], b'original')
+
+
+class TestServerSideCopy(unittest.TestCase):
+    data = bytes(range(35))
+
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        self.s3.objects[('in', 'bag.tar.gz')] = self.data
+        patches = [
+            unittest.mock.patch.object(client_lib, 'get_client', return_value=self.s3),
+            unittest.mock.patch.object(object_lib.transfer_lib.time, 'sleep'),
+            unittest.mock.patch.object(object_lib, 'COPY_PART_SIZE', 10)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def copy(self, expected_checksum=None, **head):
+        source_head = self.s3.head_object(Bucket='in', Key='bag.tar.gz')
+        source_head.update(Bucket='in', Key='bag.tar.gz', **head)
+        return object_lib._s3_object_to_s3_object_copy(
+            's3://in/bag.tar.gz', source_head, 'out', 'bag.tar.gz',
+            expected_checksum=expected_checksum, max_workers=3)
+
+    def test_part_ranges(self):
+        stats = self.copy(expected_checksum=hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], self.data)
+        # The final part holds the remaining 5 bytes
+        self.assertEqual(
+            sorted(self.s3.copied_ranges),
+            [(1, 'bytes=0-9'), (2, 'bytes=10-19'), (3, 'bytes=20-29'), (4, 'bytes=30-34')])
+        self.assertEqual(stats['mode'], 'server-side-copy')
+
+    def test_exact_multiple_of_part_size(self):
+        self.data = self.data[:30]
+        self.s3.objects[('in', 'bag.tar.gz')] = self.data
+        self.copy()
+        self.assertEqual(sorted(self.s3.copied_ranges)[-1], (3, 'bytes=20-29'))
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], self.data)
+
+    def test_s3_held_checksum(self):
+        checksum = base64.b64encode(hashlib.sha256(self.data).digest()).decode()
+        with unittest.mock.patch.object(self.s3, 'get_object') as get_object:
+            self.copy(expected_checksum=hashlib.sha256(self.data).hexdigest(), ChecksumSHA256=checksum)
+        # Verified without reading the source
+        get_object.assert_not_called()
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], self.data)
+
+    def test_part_error_aborts(self):
+        upload_part_copy = self.s3.upload_part_copy
+
+        def failing_upload_part_copy(**kwargs):
+            if kwargs['PartNumber'] == 3:
+                raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'UploadPartCopy')
+            return upload_part_copy(**kwargs)
+
+        with unittest.mock.patch.object(self.s3, 'upload_part_copy', side_effect=failing_upload_part_copy):
+            with self.assertRaises(botocore.exceptions.ClientError):
+                self.copy()
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+        self.assertNotIn(('out', 'bag.tar.gz'), self.s3.objects)
+
+    def test_transient_part_error_retried(self):
+        upload_part_copy = self.s3.upload_part_copy
+        errors = [server_error('UploadPartCopy')]
+
+        def flaky_upload_part_copy(**kwargs):
+            if kwargs['PartNumber'] == 4 and errors:
+                raise errors.pop()
+            return upload_part_copy(**kwargs)
+
+        with unittest.mock.patch.object(self.s3, 'upload_part_copy', side_effect=flaky_upload_part_copy):
+            self.copy()
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], self.data)
+
+    def test_checksum_mismatch_aborts(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid checksum'):
+            self.copy(expected_checksum=hashlib.sha256(b'other').hexdigest())
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+        self.assertNotIn(('out', 'bag.tar.gz'), self.s3.objects)
+
+    def test_changed_source_aborts(self):
+        # Parts are only copied from the version of the source that was checked
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.copy(ETag='"stale"')
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+        self.assertNotIn(('out', 'bag.tar.gz'), self.s3.objects)
+
+    def test_part_size_within_part_limit(self):
+        mib = 1024 * 1024
+        self.assertEqual(object_lib._get_part_size(100 * mib, 8 * mib), 8 * mib)
+        part_size = object_lib._get_part_size(object_lib.S3_MAX_PARTS * 8 * mib + 1, 8 * mib)
+        self.assertEqual(part_size, 9 * mib)
+
+
+class FakeStreamResponse:
+    """
+    Streamed `requests` response whose body raises `ChunkedEncodingError`
+    after `fail_after` bytes (if set).
+    """
+
+    def __init__(self, status_code, data, headers=None, fail_after=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = ''
+        self.data = data
+        self.headers = headers or {}
+        self.fail_after = fail_after
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        end = len(self.data) if self.fail_after is None else self.fail_after
+        for i in range(0, end, chunk_size):
+            yield self.data[i:min(i + chunk_size, end)]
+        if self.fail_after is not None:
+            raise object_lib.requests.exceptions.ChunkedEncodingError('connection dropped')
+
+    def close(self):
+        self.closed = True
+
+
+class TestResumableUrlReader(unittest.TestCase):
+    data = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.ranges = []
+        patches = [
+            unittest.mock.patch.object(object_lib.transfer_lib.time, 'sleep'),
+            unittest.mock.patch.object(object_lib, 'STREAM_READ_SIZE', 100)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get(self, fail_after):
+        """
+        Return a fake `requests.get` serving `self.data`; response `i` drops
+        the connection after `fail_after[i]` bytes of its body.
+        """
+        fail_after = list(fail_after)
+
+        def get(url, headers, stream):
+            start = int(headers['Range'][len('bytes='):-1]) if 'Range' in headers else 0
+            self.ranges.append(start)
+            body = self.data[start:]
+            if not start:
+                return FakeStreamResponse(200, body, fail_after=fail_after.pop(0) if fail_after else None)
+            content_range = f'bytes {start}-{len(self.data) - 1}/{len(self.data)}'
+            return FakeStreamResponse(
+                206, body, {'Content-Range': content_range}, fail_after.pop(0) if fail_after else None)
+
+        return get
+
+    def read(self, reader, get, chunk_size=300):
+        with unittest.mock.patch.object(object_lib.requests, 'get', side_effect=get):
+            return list(reader.iter_chunks(chunk_size))
+
+    def test_resumed_mid_stream(self):
+        reader = object_lib.ResumableUrlReader('https://source/bag.tar.gz', max_attempts=3)
+        chunks = self.read(reader, self.get([250, 420]))
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 124])
+        # Each resume starts at the last byte received
+        self.assertEqual(self.ranges, [0, 250, 670])
+        self.assertEqual(reader.resume_count, 2)
+        self.assertEqual(reader.offset, len(self.data))
+
+    def test_failures_in_a_row_limited(self):
+        reader = object_lib.ResumableUrlReader('https://source/bag.tar.gz', max_attempts=3)
+        with self.assertRaises(object_lib.requests.exceptions.ChunkedEncodingError):
+            self.read(reader, self.get([100, 0, 0]))
+        self.assertEqual(self.ranges, [0, 100, 100])
+        self.assertEqual(reader.resume_count, 2)
+
+    def test_resume_not_supported(self):
+        def get(url, headers, stream):
+            self.ranges.append(headers.get('Range'))
+            return FakeStreamResponse(200, self.data, fail_after=None if self.ranges[1:] else 10)
+
+        reader = object_lib.ResumableUrlReader('https://source/bag.tar.gz', max_attempts=3)
+        with self.assertRaisesRegex(ValueError, 'Unable to resume'):
+            self.read(reader, get)
+        self.assertEqual(self.ranges, [None, 'bytes=10-'])
+
+
+class FakeRangeResponse:
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self.content = content
+
+
+class TestConcurrentTransfer(unittest.TestCase):
+    data = bytes(range(40))
+
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        self.budgets = []
+        byte_budget = object_lib.transfer_lib.ByteBudget
+        self.patches = [
+            unittest.mock.patch.object(client_lib, 'get_client', return_value=self.s3),
+            unittest.mock.patch.object(
+                object_lib.transfer_lib, 'ByteBudget',
+                side_effect=lambda max_bytes: self.budgets.append(byte_budget(max_bytes)) or self.budgets[-1])]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def copy(self, get, **kwargs):
+        errors = []
+
+        def run():
+            try:
+                with unittest.mock.patch.object(object_lib.requests, 'get', side_effect=get):
+                    object_lib._url_to_s3_object_concurrent(
+                        'https://source/bag.tar.gz', 'out', 'bag.tar.gz', len(self.data),
+                        expected_checksum=hashlib.sha256(self.data).hexdigest(),
+                        max_workers=4, part_size=4, max_in_flight_bytes=12, **kwargs)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'Transfer did not finish')
+        return errors
+
+    def get_range(self, url, headers):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        return FakeRangeResponse(206, self.data[int(start):int(end) + 1])
+
+    def test_copy(self):
+        self.assertEqual(self.copy(self.get_range), [])
+        self.assertEqual(self.s3.objects[('out', 'bag.tar.gz')], self.data)
+        self.assertEqual(self.budgets[0].in_flight, 0)
+
+    def test_failed_part_releases_budget(self):
+        later_parts_hashed = threading.Event()
+        count = [0]
+        lock = threading.Lock()
+
+        def get(url, headers):
+            if headers['Range'].startswith('bytes=0-'):
+                # Fail the first part once the later parts hold the budget
+                # while waiting to be hashed
+                later_parts_hashed.wait(5)
+                raise ValueError('part 1 failed')
+            with lock:
+                count[0] += 1
+                if count[0] == 2:
+                    threading.Timer(0.1, later_parts_hashed.set).start()
+            return self.get_range(url, headers)
+
+        errors = self.copy(get)
+        self.assertEqual([str(e) for e in errors], ['part 1 failed'])
+        self.assertEqual(self.s3.aborted, ['bag.tar.gz'])
+        self.assertNotIn(('out', 'bag.tar.gz'), self.s3.objects)
+        # Parts waiting behind the failed one gave their bytes back
+        self.assertEqual(self.budgets[0].in_flight, 0)
@@ -0,0 +1,218 @@
+import json
+import random
+import threading
+import unittest
+import requests
+import opensearch_lib
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f'HTTP {self.status_code}')
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """
+    Stand-in for `requests.Session.post` to `_bulk`; `statuses` maps a
+    document id to the list of item statuses returned for its attempts
+    (201 once the list is used up).
+    """
+
+    def __init__(self, statuses=None, request_statuses=None):
+        self.statuses = statuses or {}
+        self.request_statuses = list(request_statuses or [])
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data, auth, verify, headers, timeout):
+        lines = data.decode().splitlines()
+        ids = [json.loads(line)['index']['_id'] for line in lines[::2]]
+        with self.lock:
+            self.requests.append(ids)
+            request_status = self.request_statuses.pop(0) if self.request_statuses else None
+        if isinstance(request_status, Exception):
+            raise request_status
+        if request_status is not None:
+            return FakeResponse(request_status, headers={'Retry-After': '7'})
+        items = []
+        for document_id in ids:
+            statuses = self.statuses.get(document_id, [])
+            status = statuses.pop(0) if statuses else 201
+            items.append({'index': {'_id': document_id, 'status': status}})
+        errors = any(item['index']['status'] >= 300 for item in items)
+        return FakeResponse(200, {'errors': errors, 'items': items})
+
+
+BULK_URL = 'https://host/index/_bulk'
+BULK_DATA = b'{"index": {"_id": "0"}}\n{}\n'
+
+
+def get_client(session, **kwargs):
+    sleeps = []
+    client = opensearch_lib.WriteClient(
+        session=session, sleep=sleeps.append, rng=random.Random(1), **{'max_concurrency': 1, **kwargs})
+    client.sleeps = sleeps
+    return client
+
+
+def get_breaker(failure_threshold=3, now=None):
+    now = now or [0]
+    return opensearch_lib.CircuitBreaker(failure_threshold=failure_threshold, reset_seconds=30, clock=lambda: now[0])
+
+
+class TestBulkWriter(unittest.TestCase):
+    def get_writer(self, session, max_concurrency=1, breaker=None, **kwargs):
+        client = get_client(session, max_concurrency=max_concurrency, breaker=breaker)
+        return opensearch_lib.BulkWriter('https://host/', 'index', client=client, **kwargs)
+
+    def test_flush_by_count_and_bytes(self):
+        session = FakeSession()
+        with self.get_writer(session, max_documents=3, max_bytes=200) as writer:
+            for i in range(7):
+                writer.add(str(i), {'n': i})
+            writer.add('big', {'data': 'x' * 500})
+            writer.add('last', {})
+        self.assertEqual(session.requests, [['0', '1', '2'], ['3', '4', '5'], ['6'], ['big'], ['last']])
+        self.assertEqual(writer.stats['documents'], 9)
+
+    def test_retry_failed_items(self):
+        session = FakeSession(statuses={'1': [429, 429], '2': [503]})
+        with self.get_writer(session) as writer:
+            for i in range(4):
+                writer.add(str(i), {})
+        self.assertEqual(session.requests, [['0', '1', '2', '3'], ['1', '2'], ['1']])
+        self.assertEqual(writer.stats['retried_items'], 3)
+
+    def test_retry_request(self):
+        session = FakeSession(request_statuses=[503])
+        with self.get_writer(session) as writer:
+            writer.add('0', {})
+        self.assertEqual(session.requests, [['0'], ['0']])
+        self.assertEqual(writer.client.sleeps, [7])
+
+    def test_backpressure_does_not_open_circuit(self):
+        breaker = get_breaker(failure_threshold=2)
+        session = FakeSession(request_statuses=[429] * 4 + [503])
+        with self.get_writer(session, breaker=breaker, max_retries=5) as writer:
+            writer.add('0', {})
+        # Each attempt is one request, after at least the Retry-After delay
+        self.assertEqual(len(session.requests), 6)
+        self.assertEqual(writer.client.sleeps, [7] * 5)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_errors(self):
+        session = FakeSession(statuses={'1': [400], '2': [429] * 10})
+        writer = self.get_writer(session, max_retries=2)
+        for i in range(3):
+            writer.add(str(i), {})
+        with self.assertRaises(opensearch_lib.OpenSearchBulkError):
+            writer.close()
+        self.assertEqual([error['_id'] for error in writer.errors], ['1', '2'])
+        self.assertEqual(len(session.requests), 3)
+
+    def test_concurrent(self):
+        session = FakeSession(statuses={'5': [429]})
+        with self.get_writer(session, max_concurrency=4, max_documents=2) as writer:
+            for i in range(20):
+                writer.add(str(i), {})
+        self.assertEqual(sorted(int(i) for ids in session.requests for i in ids), sorted(list(range(20)) + [5]))
+        # The item rejected with 429 reduced the concurrency
+        self.assertEqual(writer.client.get_stats()['overloads'], 1)
+
+
+class TestWriteClient(unittest.TestCase):
+    def test_limiter(self):
+        limiter = opensearch_lib.AdaptiveLimiter(initial=4, maximum=8)
+        tokens = [limiter.acquire() for _ in range(4)]
+        # Overloads of requests started before a decrease count once
+        for token in tokens:
+            limiter.release(token, overloaded=True)
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(4):
+            limiter.release(limiter.acquire())
+        self.assertGreater(limiter.limit, 3)
+        for _ in range(100):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 8)
+
+    def test_retry_after_and_backoff(self):
+        client = get_client(None, backoff_base_seconds=1, backoff_max_seconds=10)
+        self.assertTrue(all(0 <= client.get_retry_delay(2) <= 4 for _ in range(100)))
+        self.assertEqual(client.get_retry_delay(0, retry_after=5), 5)
+        self.assertEqual(client.get_retry_delay(0, retry_after=50), 10)
+        self.assertEqual(opensearch_lib.parse_retry_after('3'), 3)
+        self.assertEqual(opensearch_lib.parse_retry_after('Wed, 21 Oct 2015 07:28:10 GMT', now=1445412480), 10)
+        self.assertIsNone(opensearch_lib.parse_retry_after('soon'))
+
+    def test_circuit_breaker(self):
+        now = [0]
+        session = FakeSession(request_statuses=[503] * 4 + [requests.ConnectionError('down')] * 2)
+        breaker = get_breaker(failure_threshold=2, now=now)
+        client = get_client(session, max_retries=1, breaker=breaker)
+        # Failures count once per request, after its retries
+        for _ in range(2):
+            self.assertEqual(client.post(BULK_URL, data=BULK_DATA).status_code, 503)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(opensearch_lib.OpenSearchCircuitOpenError):
+            client.post(BULK_URL, data=BULK_DATA)
+        self.assertEqual(len(session.requests), 4)
+
+        # One trial request after the reset time; its failure reopens
+        now[0] = 31
+        with self.assertRaises(requests.ConnectionError):
+            client.post(BULK_URL, data=BULK_DATA)
+        with self.assertRaises(opensearch_lib.OpenSearchCircuitOpenError):
+            client.post(BULK_URL, data=BULK_DATA)
+        self.assertEqual(len(session.requests), 6)
+        now[0] = 62
+        self.assertEqual(client.post(BULK_URL, data=BULK_DATA).status_code, 200)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        stats = client.get_stats()
+        self.assertEqual((stats['requests'], stats['overloads']), (7, 6))
+        self.assertEqual(stats['latency']['overloaded']['count'], 4)
+
+    def test_half_open_trial_error(self):
+        now = [0]
+        session = FakeSession(request_statuses=[503, requests.exceptions.ChunkedEncodingError('truncated')])
+        breaker = get_breaker(failure_threshold=1, now=now)
+        client = get_client(session, max_retries=0, breaker=breaker)
+        client.post(BULK_URL, data=BULK_DATA)
+        now[0] = 31
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            client.post(BULK_URL, data=BULK_DATA)
+        # The trial's error reopens the circuit rather than leaving it half open
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(client.limiter.in_flight, 0)
+
+    def test_overloaded_error_releases_slot(self):
+        client = get_client(FakeSession())
+
+        def overloaded(response):
+            raise ValueError('bad body')
+
+        with self.assertRaises(ValueError):
+            client.post(BULK_URL, data=BULK_DATA, overloaded=overloaded)
+        self.assertEqual(client.limiter.in_flight, 0)
+        self.assertEqual(client.post(BULK_URL, data=BULK_DATA).status_code, 200)
+
+    def test_histogram(self):
+        histogram = opensearch_lib.LatencyHistogram()
+        for milliseconds in [1, 20, 20, 20, 40000]:
+            histogram.record(milliseconds / 1000)
+        summary = histogram.summary()
+        self.assertEqual(summary['p50_ms'], 25)
+        self.assertIsNone(summary['p99_ms'])
+        self.assertEqual(summary['buckets'], {'<=5ms': 1, '<=25ms': 3, '>30000ms': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import json
+import threading
+import unittest
+import param_cache_lib
+
+
+class FakeSsmClient:
+    """
+    In-memory stand-in for the ssm client calls used by `ParamCache`;
+    non-string values are stored as JSON.
+    """
+
+    def __init__(self, parameters: dict):
+        self.parameters = {}
+        self.calls = []
+        for name, value in parameters.items():
+            self.set(name, value)
+
+    def set(self, name, value):
+        version = self.parameters.get(name, {}).get('Version', 0) + 1
+        value = value if isinstance(value, str) else json.dumps(value)
+        self.parameters[name] = {'Name': name, 'Value': value, 'Version': version}
+
+    def get_parameter(self, Name, WithDecryption):
+        self.calls.append(('get_parameter', Name))
+        return {'Parameter': dict(self.parameters[Name])}
+
+    def get_parameters(self, Names, WithDecryption):
+        self.calls.append(('get_parameters', tuple(Names)))
+        return {
+            'Parameters': [dict(self.parameters[name]) for name in Names if name in self.parameters],
+            'InvalidParameters': [name for name in Names if name not in self.parameters]}
+
+
+class TestParamCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.ssm = FakeSsmClient({f'p{i}': f'v{i}' for i in range(25)})
+
+    def get_cache(self, **kwargs):
+        return param_cache_lib.ParamCache(
+            ttl_seconds=60, stale_seconds=600, ssm_client=self.ssm, clock=lambda: self.now, **kwargs)
+
+    def test_ttl_and_stale(self):
+        cache = self.get_cache(background=False)
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        self.now = 59
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        self.assertEqual(len(self.ssm.calls), 1)
+
+        # Per-key TTL
+        cache.get_value('p1', ttl_seconds=1000)
+        self.ssm.set('p0', 'new')
+        self.ssm.set('p1', 'new')
+        self.now = 100
+        self.assertEqual(cache.get_value('p0'), 'new')
+        self.assertEqual(cache.get_value('p1'), 'v1')
+
+        # Past the stale window the caller waits for a fetch
+        self.now = 10000
+        self.ssm.set('p0', 'newer')
+        self.assertEqual(cache.get_value('p0'), 'newer')
+        self.assertEqual(
+            cache.get_stats(),
+            {'hits': 2, 'stale_hits': 1, 'misses': 3, 'refreshes': 1, 'refresh_errors': 0, 'batch_requests': 0})
+
+    def test_background_refresh(self):
+        cache = self.get_cache()
+        cache.get_value('p0')
+        self.ssm.set('p0', 'new')
+        self.now = 100
+        # Stale value returned at once and refreshed in the background
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        cache.wait_for_refreshes()
+        self.assertEqual(cache.get_value('p0'), 'new')
+
+    def test_refresh_error(self):
+        cache = self.get_cache(background=False)
+        cache.get_value('p0')
+        del self.ssm.parameters['p0']
+        self.now = 100
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        self.assertEqual(cache.get_stats()['refresh_errors'], 1)
+
+    def test_invalidate_during_refresh(self):
+        for background in (False, True):
+            with self.subTest(background=background):
+                self.now = 0
+                cache = self.get_cache(background=background)
+                cache.get_value('p0')
+                get_parameter = self.ssm.get_parameter
+
+                def invalidating_get_parameter(Name, WithDecryption):
+                    cache.invalidate()
+                    return get_parameter(Name, WithDecryption)
+
+                self.now = 100
+                self.ssm.get_parameter = invalidating_get_parameter
+                try:
+                    self.assertEqual(cache.get_value('p0'), 'v0')
+                    cache.wait_for_refreshes()
+                finally:
+                    self.ssm.get_parameter = get_parameter
+                # The refreshed value is not stored over the invalidation
+                self.assertEqual(cache.get_stats()['refreshes'], 1)
+                self.assertEqual(cache.get_stats()['misses'], 1)
+                cache.get_value('p0')
+                self.assertEqual(cache.get_stats()['misses'], 2)
+
+    def test_stuck_refresh(self):
+        cache = self.get_cache()
+        cache.get_value('p0')
+        frozen = threading.Event()
+        get_parameter = self.ssm.get_parameter
+
+        def frozen_get_parameter(Name, WithDecryption):
+            if threading.current_thread() is not threading.main_thread():
+                frozen.wait(5)
+            return get_parameter(Name, WithDecryption)
+
+        self.ssm.get_parameter = frozen_get_parameter
+        self.ssm.set('p0', 'new')
+        self.now = 100
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        self.now = 159
+        self.assertEqual(cache.get_value('p0'), 'v0')
+        # Refreshed by the caller once the background refresh is a TTL old
+        self.now = 160
+        self.assertEqual(cache.get_value('p0'), 'new')
+
+        # The stuck refresh's later result does not replace the newer value
+        self.ssm.set('p0', 'newer')
+        frozen.set()
+        cache.wait_for_refreshes()
+        self.assertEqual(cache.get_value('p0'), 'new')
+        self.assertEqual(cache.get_stats()['refreshes'], 2)
+
+    def test_prefetch(self):
+        cache = self.get_cache()
+        cache.get_value('p3')
+        cache.prefetch([f'p{i}' for i in range(25)])
+        # One get_parameter, then 24 uncached names in batches of up to 10
+        self.assertEqual([len(names) for call, names in self.ssm.calls[1:]], [10, 10, 4])
+        calls = len(self.ssm.calls)
+        self.assertEqual([cache.get_value(f'p{i}') for i in range(25)], [f'v{i}' for i in range(25)])
+        self.assertEqual(len(self.ssm.calls), calls)
+        with self.assertRaises(param_cache_lib.ParamCacheError):
+            cache.prefetch(['p0', 'missing'])
+
+    def test_concurrent_misses(self):
+        cache = self.get_cache()
+        threads = [threading.Thread(target=cache.get_value, args=('p0',)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.ssm.calls, [('get_parameter', 'p0')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import param_cache_lib
+import role_map_lib
+from test_param_cache_lib import FakeSsmClient
+
+
+class TestRoleMap(unittest.TestCase):
+    role_map_list = [
+        {'bag_department': ' Testing A ', 'ayr_role': 'department_a_role '},
+        {'bag_department_pattern': 'Testing [BC]', 'ayr_role': 'department_bc_role'},
+        {'bag_department': 'Testing B', 'ayr_role': 'department_b_role'},
+        {'bag_department': 'Testing A', 'ayr_role': 'ignored_duplicate'}
+    ]
+
+    def test_get_role(self):
+        role_map = role_map_lib.RoleMap(self.role_map_list)
+        self.assertEqual(role_map.get_role('Testing A'), 'department_a_role')
+        # Departments are looked up before patterns
+        self.assertEqual(role_map.get_role('Testing B'), 'department_b_role')
+        self.assertEqual(role_map.get_role('Testing C'), 'department_bc_role')
+        self.assertIsNone(role_map.get_role('Testing CC'))
+
+    def test_invalid(self):
+        for entry in [{'bag_department': 'x'}, {'ayr_role': 'x'}, {'bag_department_pattern': '(', 'ayr_role': 'x'}]:
+            with self.subTest(entry=entry):
+                with self.assertRaises(role_map_lib.RoleMapError):
+                    role_map_lib.RoleMap([entry])
+
+    def test_cache(self):
+        now = [0]
+        ssm = FakeSsmClient({'key': self.role_map_list})
+        param_cache = param_cache_lib.ParamCache(ssm_client=ssm, clock=lambda: now[0], background=False)
+        cache = role_map_lib.RoleMapCache('key', ttl_seconds=60, param_cache=param_cache)
+        role_map = cache.get()
+        now[0] = 59
+        self.assertIs(cache.get(), role_map)
+        self.assertEqual(len(ssm.calls), 1)
+
+        # Refreshed after the TTL; same version, so not compiled again
+        now[0] = 61
+        self.assertIs(cache.get(), role_map)
+        self.assertEqual(len(ssm.calls), 2)
+
+        ssm.set('key', [{'bag_department': 'Testing A', 'ayr_role': 'new_role'}])
+        now[0] = 200
+        self.assertEqual(cache.get().get_role('Testing A'), 'new_role')
+        self.assertEqual(cache.stats, {'hits': 2, 'loads': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
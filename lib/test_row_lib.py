@@ -0,0 +1,64 @@
+import io
+import unittest
+import row_lib
+
+
+class ChunkedBody(io.BytesIO):
+    """
+    Body returning at most `size` bytes per read, to split rows and
+    multi-byte characters across reads.
+    """
+
+    def __init__(self, data, size):
+        super().__init__(data)
+        self.size = size
+
+    def read(self, size=-1):
+        return super().read(min(size, self.size) if size >= 0 else self.size)
+
+
+class TestRowLib(unittest.TestCase):
+    csv_data = 'name,note\r\nfïle-1,"two\r\nlines"\r\nfile-2,\r\n'.encode('utf-8')
+
+    def test_text_lines_across_reads(self):
+        for size in (1, 2, 3, 100):
+            with self.subTest(size=size):
+                lines = list(row_lib.iter_text_lines(ChunkedBody(self.csv_data, size)))
+                self.assertEqual(''.join(lines), self.csv_data.decode('utf-8'))
+                self.assertEqual(len(lines), 4)
+
+    def test_csv_rows(self):
+        body = ChunkedBody(self.csv_data, 3)
+        rows = list(row_lib.iter_csv_rows(body))
+        self.assertEqual(rows, [
+            {'name': 'fïle-1', 'note': 'two\r\nlines'},
+            {'name': 'file-2', 'note': None}])
+        self.assertTrue(body.closed)
+
+    def test_batches_and_early_close(self):
+        data = ('n\n' + ''.join(f'{i}\n' for i in range(5))).encode()
+        self.assertEqual(
+            [[r['n'] for r in batch] for batch in row_lib.iter_csv_rows(io.BytesIO(data), batch_size=2)],
+            [['0', '1'], ['2', '3'], ['4']])
+        body = io.BytesIO(data)
+        batches = row_lib.iter_csv_rows(body, batch_size=2)
+        next(batches)
+        batches.close()
+        self.assertTrue(body.closed)
+
+    def test_property_items(self):
+        body = io.BytesIO(b'Source-Organization: Example: Org\n\nBag-Size\nPayload-Oxum: 12.3')
+        self.assertEqual(
+            dict(row_lib.iter_property_items(body)),
+            {'Source-Organization': 'Example: Org', 'Bag-Size': None, 'Payload-Oxum': '12.3'})
+
+    def test_checksum_entries(self):
+        body = io.BytesIO(b'abc  data/a b.txt\ndef\tdata/c.txt\n')
+        self.assertEqual(list(row_lib.iter_checksum_entries(body)), [
+            {'object': 'data/a b.txt', 'checksum': 'abc'},
+            {'object': 'data/c.txt', 'checksum': 'def'}])
+
+    def test_decode_manifest_path(self):
+        # Only CR, LF and % are percent-encoded in manifests
+        self.assertEqual(row_lib.decode_manifest_path('data/a%20b%25%0d%0Ac.txt'), 'data/a%20b%\r\nc.txt')
+        self.assertEqual(row_lib.decode_manifest_path('data/100%2525.txt'), 'data/100%25.txt')
@@ -1,6 +1,11 @@
+import io
 import unittest
 from s3_bag_reader import BagFileMapper
+from s3_bag_reader import S3BagReader
+from s3_bag_reader import BagCsvTable
+from s3_bag_reader import BagFileIndex
 from s3_bag_reader import BagError
+from s3_bag_reader import SUB_FILE_OVERFLOW_REFERENCE
 
 
 class TestBagFileMapper(unittest.TestCase):
@@ -25,3 +30,245 @@ class TestBagFileMapper(unittest.TestCase):
         except BagError as e:
             if 'No input file for "bag-info.txt"' not in str(e):
                 self.fail('Got error, but not expected message')
+
+
+class FakeS3Api:
+    """
+    In-memory stand-in for the boto3 s3 client calls used by S3BagReader.
+    """
+
+    def __init__(self, objects: dict):
+        self.objects = objects
+        self.bytes_read = 0
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[Key]
+        if Range is None:
+            self.bytes_read += len(data)
+            return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+        if not data:
+            error = Exception('InvalidRange')
+            error.response = {'Error': {'Code': 'InvalidRange'}}
+            raise error
+        first, last = Range.removeprefix('bytes=').split('-')
+        part = data[int(first):int(last) + 1] if last else data[int(first):]
+        self.bytes_read += len(part)
+        return {
+            'Body': io.BytesIO(part), 'ContentLength': len(part),
+            'ContentRange': f'bytes {first}-{int(first) + len(part) - 1}/{len(data)}'}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [
+            {'Key': key, 'Size': len(data)} for key, data in self.objects.items() if key.startswith(Prefix)]}
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        Fileobj.write(self.objects[Key])
+
+
+class TestS3BagReaderReadAll(unittest.TestCase):
+    prefix = 'ayr-in/bag.tar.gz/bag/'
+    objects = {
+        prefix + 'bag-info.txt': b'Source-Organization: Example\nPayload-Oxum: 20.2\n',
+        prefix + 'bagit.txt': b'BagIt-Version: 1.0\n',
+        prefix + 'file-metadata.csv': b'file,size\ndata/a.txt,\ndata/b.csv,10\n',
+        prefix + 'manifest-sha256.txt': b'aa data/a.txt\nbb data/b.csv\n',
+        prefix + 'tagmanifest-sha256.txt': b'cc bag-info.txt\n',
+        prefix + 'data/a.txt': b'a' * 10,
+        prefix + 'data/b.csv': b'x,y\n1,2\n',
+        prefix + 'data/c.pdf': b'%PDF'
+    }
+
+    def test_same_as_sequential(self):
+        bag = S3BagReader(
+            s3_bucket='b', file_list=list(self.objects), path_prefix=self.prefix,
+            s3_api=FakeS3Api(self.objects))
+        expected = {}
+        expected.update(bag.get_bag_info_txt_as_dict())
+        expected.update(bag.get_bagit_txt_as_dict())
+        expected.update(bag.get_file_av_csv_as_dict())
+        expected.update(bag.get_file_ffid_csv_as_dict())
+        expected.update(bag.get_file_metadata_csv_as_dict())
+        expected.update(bag.get_manifest_sha256_as_dict())
+        expected.update(bag.get_tagmanifest_sha256_as_dict())
+        expected.update(bag.get_sub_files_dict())
+
+        data = bag.read_all(max_workers=4, max_in_flight_bytes=16)
+        self.assertEqual(data, expected)
+        self.assertEqual(list(data), list(expected))
+
+        columnar = bag.read_all(columnar=True)
+        table = columnar[S3BagReader.BAG_FILE_METADATA]
+        self.assertIsInstance(table, BagCsvTable)
+        self.assertEqual(table.to_rows(), expected[S3BagReader.BAG_FILE_METADATA])
+
+
+class TestS3BagReaderSubFileBudgets(unittest.TestCase):
+    prefix = 'ayr-in/bag.tar.gz/bag/'
+    objects = {
+        prefix + 'bag-info.txt': b'Source-Organization: Example\n',
+        prefix + 'bagit.txt': b'BagIt-Version: 1.0\n',
+        prefix + 'manifest-sha256.txt': b'aa data/a.txt\n',
+        prefix + 'tagmanifest-sha256.txt': b'cc bag-info.txt\n',
+        prefix + 'data/a.txt': 'caf\u00e9 au lait'.encode(),
+        prefix + 'data/b.txt': b'',
+        prefix + 'data/c.csv': b'\xff1234567890',
+        prefix + 'data/d.txt': b'x' * 1000,
+        prefix + 'data/e.txt': b'y' * 1000
+    }
+
+    def get_bag(self):
+        return S3BagReader(
+            s3_bucket='b', file_list=list(self.objects), path_prefix=self.prefix,
+            s3_api=FakeS3Api(self.objects))
+
+    def test_truncate(self):
+        bag = self.get_bag()
+        entries = bag.get_sub_files_dict(max_file_bytes=4, max_total_bytes=10)['bag_sub_files']
+        self.assertEqual([e['object'][len(self.prefix):] for e in entries],
+                         ['data/a.txt', 'data/b.txt', 'data/c.csv', 'data/d.txt', 'data/e.txt'])
+        # 'é' is cut in half by the 4 byte limit, so is dropped
+        self.assertEqual(entries[0], {'object': self.prefix + 'data/a.txt', 'data': 'caf', 'size': 13, 'truncated': True})
+        self.assertEqual(entries[1]['data'], '')
+        self.assertFalse(entries[1]['truncated'])
+        self.assertEqual(entries[2]['data'], '\ufffd123')
+        # 2 bytes of the bag budget left, then none
+        self.assertEqual(entries[3]['data'], 'xx')
+        self.assertEqual(entries[4], {'object': self.prefix + 'data/e.txt', 'data': None, 'size': None, 'truncated': True})
+        self.assertLess(bag.s3_api.bytes_read, 100)
+
+        self.assertEqual(bag.read_all(max_workers=4, max_file_bytes=4, max_total_bytes=10)['bag_sub_files'], entries)
+
+    def test_reference_and_strict(self):
+        bag = self.get_bag()
+        entries = bag.get_sub_files_dict(overflow=SUB_FILE_OVERFLOW_REFERENCE, max_file_bytes=100)['bag_sub_files']
+        self.assertEqual(entries[3], {'object': self.prefix + 'data/d.txt', 'data': None, 'size': 1000, 'truncated': True})
+        self.assertEqual(entries[0]['data'], 'caf\u00e9 au lait')
+        with self.assertRaises(UnicodeDecodeError):
+            bag.get_sub_files_dict(errors='strict')
+        with self.assertRaises(BagError):
+            bag.get_sub_files_dict(overflow='spill')
+
+
+class TestBagFileMapperSubFiles(unittest.TestCase):
+    prefix = 'foo/bar.tar.gz/bar/'
+
+    def test_root_files_and_sub_files(self):
+        mapper = BagFileMapper(
+            file_list=[
+                self.prefix + 'bag-info.txt',
+                self.prefix + 'data/content/file-c1.txt',
+                self.prefix + 'manifest-sha256.txt',
+                'elsewhere/file.txt',
+                self.prefix + 'data/content/file-c2.txt',
+                self.prefix + 'data/file-d.txt'
+            ],
+            path_prefix=self.prefix,
+            only_expected_root_files=True)
+        self.assertEqual(mapper.bag_info_txt, self.prefix + 'bag-info.txt')
+        self.assertEqual(mapper.manifest_sha_256_txt, self.prefix + 'manifest-sha256.txt')
+        self.assertIsNone(mapper.bagit_txt)
+        self.assertEqual(list(mapper.iter_bag_sub_files()), [
+            self.prefix + 'data/content/file-c1.txt',
+            'elsewhere/file.txt',
+            self.prefix + 'data/content/file-c2.txt',
+            self.prefix + 'data/file-d.txt'])
+        self.assertEqual(mapper.bag_sub_file_count, 4)
+
+    def test_unexpected_root_file(self):
+        file_list = [self.prefix + 'bag-info.txt', self.prefix + 'notes.txt']
+        self.assertIsNone(BagFileMapper(file_list=file_list, path_prefix=self.prefix).bagit_txt)
+        with self.assertRaises(BagError):
+            BagFileMapper(file_list=file_list, path_prefix=self.prefix, only_expected_root_files=True)
+
+    def test_slots(self):
+        mapper = BagFileMapper(file_list=[self.prefix + 'bag-info.txt'], path_prefix=self.prefix)
+        with self.assertRaises(AttributeError):
+            mapper.unknown = 1
+
+
+class TestBagCsvTable(unittest.TestCase):
+    rows = [
+        {'Filepath': 'data/content', 'FileType': 'Folder', 'Filesize': None,
+         'LegalStatus': 'Public Record(s)', 'LastModified': None},
+        {'Filepath': 'data/content/a.txt', 'FileType': 'File', 'Filesize': '45',
+         'LegalStatus': 'Public Record(s)', 'LastModified': '2022-10-24T09:03:27'},
+        {'Filepath': 'data/content/b.txt', 'FileType': 'File', 'Filesize': '0',
+         'LegalStatus': 'Public Record(s)', 'LastModified': '2022-10-24T09:03:27.123456'}
+    ]
+
+    def test_round_trip(self):
+        table = BagCsvTable.from_rows(self.rows)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.to_rows(), self.rows)
+        self.assertEqual(table.kinds['Filesize'], BagCsvTable.KIND_SIZE)
+        self.assertEqual(table.kinds['LastModified'], BagCsvTable.KIND_DATE)
+        self.assertEqual(table.categories['LegalStatus'][0], [None, 'Public Record(s)'])
+        self.assertEqual(table.to_rows(typed=True)[1]['Filesize'], 45)
+
+    def test_unparseable_values_kept_as_strings(self):
+        rows = self.rows + [{'Filepath': 'x', 'Filesize': '045', 'LastModified': '24/10/2022'}]
+        table = BagCsvTable.from_rows(rows, field_names=list(self.rows[0]))
+        self.assertEqual(table.kinds['Filesize'], BagCsvTable.KIND_STR)
+        self.assertEqual(table.kinds['LastModified'], BagCsvTable.KIND_STR)
+        self.assertEqual(table.to_rows()[:3], self.rows)
+        self.assertEqual(table.to_rows()[3]['Filesize'], '045')
+
+    def test_oversized_number_kept_as_string(self):
+        rows = self.rows + [{'Filepath': 'x', 'Filesize': '99999999999999999999'}]
+        table = BagCsvTable.from_rows(rows, field_names=list(self.rows[0]))
+        self.assertEqual(table.kinds['Filesize'], BagCsvTable.KIND_STR)
+        self.assertEqual(table.to_rows()[3]['Filesize'], '99999999999999999999')
+
+    def test_extra_fields_dropped(self):
+        body = io.BytesIO(b'Filepath,FileType\r\ndata/a.txt,File,extra,fields\r\ndata/b.txt,File\r\n')
+        table = S3BagReader.get_csv_file_as_table({'Body': body})
+        self.assertEqual(table.field_names, ['Filepath', 'FileType'])
+        self.assertEqual(table.to_rows()[0], {'Filepath': 'data/a.txt', 'FileType': 'File'})
+
+    def test_column_operations(self):
+        table = BagCsvTable.from_rows(self.rows)
+        self.assertEqual(table.value_counts('FileType'), {'Folder': 1, 'File': 2})
+        self.assertEqual(table.where('FileType', 'File'), [1, 2])
+        self.assertEqual(table.where('FileType', 'Missing'), [])
+        self.assertEqual(table.total('Filesize'), 45)
+
+
+class TestBagFileIndex(unittest.TestCase):
+    manifest = [
+        {'object': 'data/content/a.txt', 'checksum': 'aa'},
+        {'object': 'data/content/b%25.txt', 'checksum': 'bb'},
+        {'object': 'data/content/c.txt', 'checksum': 'cc'}
+    ]
+    metadata = [
+        {'Filepath': 'data/content', 'FileType': 'Folder'},
+        {'Filepath': 'data/content/a.txt', 'FileType': 'File'},
+        {'Filepath': './data/content/b%.txt', 'FileType': 'File'},
+        {'Filepath': 'data/content/d.txt', 'FileType': 'File'}
+    ]
+    ffid = [{'Filepath': 'data/content/a.txt', 'PUID': 'x-fmt/111'}]
+
+    def test_join_and_lookup(self):
+        index = BagFileIndex(
+            manifest=self.manifest, metadata=BagCsvTable.from_rows(self.metadata), ffid=self.ffid)
+        record = index['data/content/a.txt']
+        self.assertEqual(record.checksum, 'aa')
+        self.assertEqual(record.metadata['FileType'], 'File')
+        self.assertEqual(record.ffid['PUID'], 'x-fmt/111')
+        self.assertIsNone(record.av)
+        self.assertEqual(index.get('data//content/b%.txt').checksum, 'bb')
+        self.assertIn('data/content/d.txt', index)
+        self.assertIsNone(index.get('data/content/missing.txt'))
+        self.assertEqual(
+            [r.filepath for r in index.iter_records(BagFileIndex.SOURCE_MANIFEST)],
+            ['data/content/a.txt', 'data/content/b%.txt', 'data/content/c.txt'])
+
+    def test_orphans(self):
+        index = BagFileIndex(manifest=self.manifest, metadata=self.metadata, ffid=self.ffid + self.ffid)
+        self.assertEqual(index.orphans(), {
+            'metadata': {'not_in_manifest': ['data/content/d.txt'], 'missing': ['data/content/c.txt']},
+            'ffid': {'not_in_manifest': [], 'missing': ['data/content/b%.txt', 'data/content/c.txt']}
+        })
+        self.assertEqual(index.duplicates, {'ffid': ['data/content/a.txt']})
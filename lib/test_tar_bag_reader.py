@@ -0,0 +1,62 @@
+import gzip
+import io
+import tarfile
+import unittest
+from s3_bag_reader import BagError
+from s3_bag_reader import S3BagReader
+from s3_bag_reader import SUB_FILE_OVERFLOW_REFERENCE
+from tar_bag_reader import TarBagReader
+from test_s3_bag_reader import FakeS3Api
+
+
+class TestTarBagReader(unittest.TestCase):
+    members = {
+        'bag/data/a.txt': 'café au lait'.encode() * 10,
+        'bag/data/b.pdf': b'%PDF' * 100,
+        'bag/bag-info.txt': b'Source-Organization: Example\nPayload-Oxum: 20.2\n',
+        'bag/data/sub/c.csv': b'x,y\n1,2\n',
+        'bag/readme.txt': b'not a sub file',
+        'bag/bagit.txt': b'BagIt-Version: 1.0\n',
+        'bag/data/d.txt': b'd' * 500,
+        'bag/file-metadata.csv': b'Filepath,Filesize\ndata/a.txt,130\n',
+        'bag/manifest-sha256.txt': b'aa data/a.txt\nbb data/b.pdf\n',
+        'bag/tagmanifest-sha256.txt': b'cc bag-info.txt\n',
+        'bag/data/e.txt': b'e' * 500
+    }
+    tar_key = 'ayr-in/bag.tar.gz'
+    output_prefix = tar_key + '/'
+
+    def get_s3(self):
+        output = io.BytesIO()
+        with tarfile.open(fileobj=output, mode='w') as tar:
+            for name, data in self.members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        objects = {self.output_prefix + name: data for name, data in self.members.items()}
+        objects[self.tar_key] = gzip.compress(output.getvalue())
+        return FakeS3Api(objects)
+
+    def test_same_as_unpacked(self):
+        s3 = self.get_s3()
+        for budget in [{}, {'max_file_bytes': 16, 'max_total_bytes': 100},
+                       {'max_file_bytes': 200, 'max_total_bytes': 300, 'overflow': SUB_FILE_OVERFLOW_REFERENCE}]:
+            with self.subTest(budget=budget):
+                unpacked = S3BagReader(
+                    s3_bucket='b', file_list=[self.output_prefix + name for name in self.members],
+                    path_prefix=self.output_prefix + 'bag/', s3_api=s3)
+                bag = TarBagReader('b', self.tar_key, output_prefix=self.output_prefix, s3_api=s3, **budget)
+                self.assertEqual(bag.read_all(max_workers=4), unpacked.read_all(max_workers=4, **budget))
+                self.assertEqual(bag.get_sub_files_dict(), unpacked.get_sub_files_dict(**budget))
+                self.assertEqual(bag.decompression['compression'], 'gz')
+
+    def test_budget_checked(self):
+        bag = TarBagReader('b', self.tar_key, output_prefix=self.output_prefix, s3_api=self.get_s3(),
+                           max_file_bytes=16)
+        bag.get_sub_files_dict(max_file_bytes=8)
+        with self.assertRaises(BagError):
+            bag.get_sub_files_dict(max_file_bytes=32)
+
+
+if __name__ == '__main__':
+    unittest.main()
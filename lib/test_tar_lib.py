@@ -0,0 +1,469 @@
+import hashlib
+import json
+import io
+import os
+import random
+import tarfile
+import threading
+import unittest
+import botocore.exceptions
+import fixity_lib
+import tar_lib
+
+
+class FakeBody(io.BytesIO):
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.read(chunk_size), b'')
+
+
+class FakeS3Client:
+    """
+    Minimal in-memory stand-in for the boto3 s3 client calls used by tar_lib
+    and object_lib; writes honour `IfNoneMatch='*'` and `IfMatch` as s3 does.
+    """
+
+    def __init__(self, fail_on_key=None):
+        self.objects = {}
+        self.metadata = {}
+        self.uploads = {}
+        self.puts = []
+        self.aborted = []
+        self.copied_ranges = []
+        self.fail_on_key = fail_on_key
+        self._lock = threading.Lock()
+
+    def _not_found(self, operation):
+        return botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, operation)
+
+    @staticmethod
+    def _etag(data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def _check_conditions(self, Bucket, Key, operation, IfNoneMatch=None, IfMatch=None):
+        exists = (Bucket, Key) in self.objects
+        if (IfNoneMatch == '*' and exists) or (
+                IfMatch is not None and (not exists or self._etag(self.objects[(Bucket, Key)]) != IfMatch)):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'PreconditionFailed'}, 'ResponseMetadata': {'HTTPStatusCode': 412}}, operation)
+
+    def _read(self, Bucket, Key, Range, operation, IfMatch=None):
+        if (Bucket, Key) not in self.objects:
+            raise self._not_found(operation)
+        self._check_conditions(Bucket, Key, operation, IfMatch=IfMatch)
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1 if end else len(data)]
+        return data
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        data = self._read(Bucket, Key, Range, 'GetObject', IfMatch)
+        return {'Body': FakeBody(data), 'ETag': self._etag(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        data = self.objects[(Bucket, Key)]
+        return {
+            'ContentLength': len(data),
+            'ETag': self._etag(data),
+            'Metadata': self.metadata.get((Bucket, Key), {})
+        }
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        with self._lock:
+            self._check_conditions(Bucket, Key, 'DeleteObject', IfMatch=IfMatch)
+            self.objects.pop((Bucket, Key), None)
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, IfNoneMatch=None, IfMatch=None, **kwargs):
+        if Key == self.fail_on_key:
+            raise IOError(f'put_object failed for {Key}')
+        if isinstance(Body, str):
+            Body = Body.encode()
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            self._check_conditions(Bucket, Key, 'PutObject', IfNoneMatch, IfMatch)
+            self.objects[(Bucket, Key)] = data
+            self.metadata[(Bucket, Key)] = Metadata or {}
+            self.puts.append(Key)
+        return {'ETag': self._etag(data)}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        with self._lock:
+            upload_id = str(len(self.uploads) + len(self.aborted) + len(self.objects))
+            self.uploads[upload_id] = {}
+            self.metadata[(Bucket, Key)] = Metadata or {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange,
+                         CopySourceIfMatch=None, **kwargs):
+        data = self._read(
+            CopySource['Bucket'], CopySource['Key'], CopySourceRange, 'UploadPartCopy', CopySourceIfMatch)
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = data
+            self.copied_ranges.append((PartNumber, CopySourceRange))
+        return {'CopyPartResult': {'ETag': f'"{PartNumber}"'}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, IfNoneMatch=None, **kwargs):
+        with self._lock:
+            self._check_conditions(Bucket, Key, 'CompleteMultipartUpload', IfNoneMatch)
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(
+                parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+            self.puts.append(Key)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+            self.aborted.append(Key)
+
+
+def make_tar(members: dict, mode='w:gz') -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode=mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+class TestUntarS3ObjectStreaming(unittest.TestCase):
+    members = {
+        './bag/bagit.txt': b'BagIt-Version: 1.0\n',
+        './bag/data/small.txt': b'small file',
+        './bag/data/large.bin': bytes(range(256)) * (48 * 1024)  # 12 MiB
+    }
+
+    def test_expected_data(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'ayr-in/bag.tar.gz')] = make_tar(self.members)
+        result = tar_lib.untar_s3_object_streaming(
+            input_bucket_name='in',
+            object_name='ayr-in/bag.tar.gz',
+            output_prefix='ayr-in/bag.tar.gz/',
+            buffer_size=tar_lib.S3_MIN_PART_SIZE,
+            s3_client=s3)
+
+        self.assertEqual(
+            result[tar_lib.KEY_FILES],
+            ['ayr-in/bag.tar.gz/' + n[2:] for n in self.members])
+        for name, data in self.members.items():
+            self.assertEqual(s3.objects[('in', 'ayr-in/bag.tar.gz/' + name[2:])], data)
+        report = result[tar_lib.KEY_MEMORY_REPORT]
+        self.assertEqual(report['multipart_members'], 1)
+        self.assertLessEqual(report['buffer_high_water_mark_bytes'], tar_lib.S3_MIN_PART_SIZE)
+
+    def test_buffer_size_too_small(self):
+        with self.assertRaises(ValueError):
+            tar_lib.untar_s3_object_streaming('in', 'x', buffer_size=1024, s3_client=FakeS3Client())
+
+    def test_concurrent_upload_order(self):
+        members = {f'./bag/data/{i:03d}.txt': f'file {i}'.encode() for i in range(50)}
+        members['./bag/data/large.bin'] = bytes(range(256)) * (48 * 1024)
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(members, mode='w')
+        result = tar_lib.untar_s3_object_streaming(
+            input_bucket_name='in',
+            object_name='bag.tar',
+            output_bucket_name='out',
+            buffer_size=tar_lib.S3_MIN_PART_SIZE,
+            max_workers=4,
+            max_in_flight_bytes=2 * tar_lib.S3_MIN_PART_SIZE,
+            s3_client=s3)
+
+        self.assertEqual(result[tar_lib.KEY_FILES], [n[2:] for n in members])
+        for name, data in members.items():
+            self.assertEqual(s3.objects[('out', name[2:])], data)
+        self.assertEqual(s3.uploads, {})
+        report = result[tar_lib.KEY_MEMORY_REPORT]
+        self.assertLessEqual(report['in_flight_high_water_mark_bytes'], 2 * tar_lib.S3_MIN_PART_SIZE)
+
+    def test_upload_failure_aborts(self):
+        members = dict(self.members)
+        members['./bag/data/later.txt'] = b'later'
+        s3 = FakeS3Client(fail_on_key='bag/data/small.txt')
+        s3.objects[('in', 'bag.tar.gz')] = make_tar(members)
+        with self.assertRaises(IOError):
+            tar_lib.untar_s3_object_streaming(
+                input_bucket_name='in',
+                object_name='bag.tar.gz',
+                buffer_size=tar_lib.S3_MIN_PART_SIZE,
+                max_workers=4,
+                s3_client=s3)
+        self.assertEqual(s3.uploads, {})
+
+
+class StopAfterPuts:
+    """
+    `should_stop` for a run that has time for `count` object writes; e.g.
+    skipping members before a checkpoint takes no time.
+    """
+
+    def __init__(self, s3, count):
+        self.s3 = s3
+        self.count = count
+        self.reset()
+
+    def reset(self):
+        self.start = len(self.s3.puts)
+
+    def __call__(self):
+        return len(self.s3.puts) - self.start > self.count
+
+
+class TestUntarS3ObjectStreamingResume(unittest.TestCase):
+    members = {f'./bag/data/{i:03d}.txt': f'file {i}'.encode() for i in range(20)}
+    members['./bag/data/large.bin'] = bytes(range(256)) * (48 * 1024)
+    members['./bag/data/last.txt'] = b'last'
+
+    def unpack_in_steps(self, mode, stop_after, **kwargs):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(self.members, mode=mode)
+        should_stop = StopAfterPuts(s3, stop_after)
+        results = []
+        while True:
+            should_stop.reset()
+            result = tar_lib.untar_s3_object_streaming(
+                input_bucket_name='in',
+                object_name='bag.tar',
+                buffer_size=tar_lib.S3_MIN_PART_SIZE,
+                max_workers=4,
+                should_stop=should_stop,
+                s3_client=s3,
+                **kwargs)
+            results.append(result)
+            if result[tar_lib.KEY_COMPLETE]:
+                return s3, results
+
+    def check_resumed(self, mode):
+        s3, results = self.unpack_in_steps(mode, stop_after=4)
+        self.assertGreater(len(results), 2)
+        self.assertFalse(results[0][tar_lib.KEY_COMPLETE])
+        self.assertEqual(results[-1][tar_lib.KEY_FILES], [n[2:] for n in self.members])
+        for name, data in self.members.items():
+            self.assertEqual(s3.objects[('in', name[2:])], data)
+        self.assertNotIn(('in', tar_lib.get_checkpoint_object_name('bag.tar')), s3.objects)
+        # Each member uploaded exactly once across all runs
+        member_puts = [k for k in s3.puts if not k.endswith(tar_lib.CHECKPOINT_SUFFIX)]
+        self.assertEqual(sorted(member_puts), sorted(n[2:] for n in self.members))
+
+    def test_resume_plain_tar(self):
+        self.check_resumed('w')
+
+    def test_resume_compressed_tar(self):
+        self.check_resumed('w:gz')
+
+    def test_index_after_resume(self):
+        s3, results = self.unpack_in_steps('w:gz', stop_after=4, build_index=True)
+        self.assertGreater(len(results), 2)
+        self.assertEqual(results[-1][tar_lib.KEY_TAR_INDEX], tar_lib.get_tar_index_object_name('bag.tar'))
+        reader = tar_lib.TarIndexReader('in', 'bag.tar', s3_client=s3)
+        self.assertEqual(reader.read_member('bag/data/large.bin'), self.members['./bag/data/large.bin'])
+
+    def test_skip_existing_members(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(self.members, mode='w:gz')
+        checkpoint = {
+            'source_etag': s3.head_object(Bucket='in', Key='bag.tar')['ETag'],
+            'output_bucket': 'in',
+            'output_prefix': '',
+            'compression': 'gz',
+            'member_index': 2,
+            'tar_offset': 0,
+            'extracted_object_names': ['bag/data/000.txt', 'bag/data/001.txt']
+        }
+        s3.put_object(Bucket='in', Key=tar_lib.get_checkpoint_object_name('bag.tar'),
+                      Body=json.dumps(checkpoint).encode())
+        s3.objects[('in', 'bag/data/002.txt')] = b'file 2'
+        s3.puts.clear()
+        result = tar_lib.untar_s3_object_streaming(
+            input_bucket_name='in',
+            object_name='bag.tar',
+            buffer_size=tar_lib.S3_MIN_PART_SIZE,
+            s3_client=s3)
+
+        self.assertEqual(result[tar_lib.KEY_FILES], [n[2:] for n in self.members])
+        self.assertEqual(result[tar_lib.KEY_MEMORY_REPORT]['members_skipped'], 1)
+        self.assertNotIn('bag/data/000.txt', s3.puts)
+        self.assertNotIn('bag/data/002.txt', s3.puts)
+
+    def test_stalled_unpack_raises(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(self.members, mode='w:gz')
+        checkpoint_name = tar_lib.get_checkpoint_object_name('bag.tar')
+        polls = []
+
+        def unpack(should_stop):
+            s3.puts.clear()
+            with self.assertRaises(tar_lib.TarUnpackStalledError):
+                tar_lib.untar_s3_object_streaming(
+                    input_bucket_name='in',
+                    object_name='bag.tar',
+                    buffer_size=tar_lib.S3_MIN_PART_SIZE,
+                    should_stop=should_stop,
+                    s3_client=s3)
+            self.assertEqual(s3.puts, [checkpoint_name])
+
+        unpack(lambda: True)
+        self.assertEqual(json.loads(s3.objects[('in', checkpoint_name)])['member_index'], 0)
+
+        # Time running out while skipping to the checkpoint of a compressed tar
+        checkpoint = json.loads(s3.objects[('in', checkpoint_name)])
+        checkpoint.update(member_index=10, extracted_object_names=[n[2:] for n in list(self.members)[:10]])
+        s3.objects[('in', checkpoint_name)] = json.dumps(checkpoint).encode()
+        unpack(lambda: polls.append(1) or len(polls) > 2)
+        self.assertEqual(len(polls), 3)
+        self.assertEqual(json.loads(s3.objects[('in', checkpoint_name)])['member_index'], 10)
+
+    def test_fixity_across_resume(self):
+        members = {'./bag/data/large.bin': bytes(range(256)) * (48 * 1024)}
+        members.update({f'./bag/data/{i:03d}.txt': f'file {i}'.encode() for i in range(10)})
+        manifest = ''.join(
+            f'{hashlib.sha256(d).hexdigest()} {n[len("./bag/"):]}\n' for n, d in members.items())
+        members['./bag/bag-info.txt'] = f'Payload-Oxum: {sum(len(d) for d in members.values())}.11\n'.encode()
+        members['./bag/manifest-sha256.txt'] = manifest.encode()
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(members, mode='w:gz')
+        should_stop = StopAfterPuts(s3, 5)
+        while True:
+            should_stop.reset()
+            result = tar_lib.untar_s3_object_streaming(
+                input_bucket_name='in',
+                object_name='bag.tar',
+                buffer_size=tar_lib.S3_MIN_PART_SIZE,
+                should_stop=should_stop,
+                fixity_checker=fixity_lib.BagFixityChecker(),
+                s3_client=s3)
+            if result[tar_lib.KEY_COMPLETE]:
+                break
+
+        report = result[tar_lib.KEY_FIXITY_REPORT]
+        self.assertTrue(report['valid'], report)
+        self.assertEqual(report['files_checked'], 11)
+
+
+class TestTarIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        words = [bytes(random.choice(b'abcdefgh') for _ in range(random.randint(2, 8))) for _ in range(200)]
+        cls.members = {
+            './bag/data/random.bin': os.urandom(300000),
+            './bag/data/text.txt': b' '.join(random.choice(words) for _ in range(100000)),
+            './bag/data/empty.txt': b'',
+            './bag/data/zeros.bin': bytes(200000),
+            './bag/data/mixed.bin': os.urandom(50000) + b' '.join(random.choice(words) for _ in range(50000))
+        }
+
+    def check_index(self, mode):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(self.members, mode=mode)
+        result = tar_lib.untar_s3_object_streaming(
+            input_bucket_name='in',
+            object_name='bag.tar',
+            output_bucket_name='out',
+            buffer_size=tar_lib.S3_MIN_PART_SIZE,
+            build_index=True,
+            index_span=64 * 1024,
+            s3_client=s3)
+
+        self.assertEqual(result[tar_lib.KEY_TAR_INDEX], tar_lib.get_tar_index_object_name('bag.tar'))
+        reader = tar_lib.TarIndexReader('in', 'bag.tar', s3_client=s3)
+        self.assertEqual(reader.member_names(), [n[2:] for n in self.members])
+        for name, data in self.members.items():
+            self.assertEqual(reader.read_member(name[2:]), data)
+        return reader
+
+    def test_gzip(self):
+        reader = self.check_index('w:gz')
+        self.assertGreater(len(reader.index['access_points']), 5)
+
+    def test_plain_tar(self):
+        reader = self.check_index('w')
+        self.assertEqual(reader.index['access_points'], [])
+
+    def test_unindexable_compression(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = make_tar(self.members, mode='w:bz2')
+        self.assertIsNone(tar_lib.build_tar_index('in', 'bag.tar', s3_client=s3))
+
+
+def zstd_compress(data):
+    import zstandard
+    return zstandard.ZstdCompressor().compress(data)
+
+
+class TestDecompression(unittest.TestCase):
+    members = {
+        './bag/bagit.txt': b'BagIt-Version: 1.0\n',
+        './bag/data/text.txt': b'some text\n' * 100000
+    }
+
+    def test_detect_compression(self):
+        tar = make_tar(self.members, mode='w')
+        self.assertEqual(tar_lib.detect_compression(tar), 'tar')
+        self.assertEqual(tar_lib.detect_compression(make_tar(self.members, mode='w:gz')), 'gz')
+        self.assertEqual(tar_lib.detect_compression(make_tar(self.members, mode='w:bz2')), 'bz2')
+        self.assertEqual(tar_lib.detect_compression(make_tar(self.members, mode='w:xz')), 'xz')
+        self.assertEqual(tar_lib.detect_compression(b'\x28\xb5\x2f\xfd' + tar[:100]), 'zst')
+        self.assertEqual(tar_lib.detect_compression(bytes(1024)), 'tar')
+        self.assertIsNone(tar_lib.detect_compression(b'not a tar' * 100))
+
+    def test_backends(self):
+        expected = make_tar(self.members, mode='w')
+        for mode in ['w', 'w:gz', 'w:bz2', 'w:xz']:
+            data = make_tar(self.members, mode=mode)
+            compression = tar_lib.detect_compression(data)
+            for backend in tar_lib.get_decompression_backends(compression):
+                with self.subTest(mode=mode, backend=backend):
+                    stream, name = tar_lib.open_decompressed_stream(io.BytesIO(data), compression, backend)
+                    self.assertEqual(name, backend)
+                    self.assertEqual(stream.read(), expected)
+
+    def test_unavailable_backend(self):
+        with self.assertRaises(tarfile.CompressionError):
+            tar_lib.open_decompressed_stream(io.BytesIO(), 'gz', 'no-such-backend')
+
+    def test_gzip_backend_without_index(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar.gz')] = make_tar(self.members)
+        backends = []
+        for build_index in [False, True]:
+            result = tar_lib.untar_s3_object_streaming(
+                input_bucket_name='in',
+                object_name='bag.tar.gz',
+                output_bucket_name='out',
+                build_index=build_index,
+                s3_client=s3)
+            backends.append(result[tar_lib.KEY_DECOMPRESSION]['backend'])
+        # The fastest installed backend unless zlib is needed to build the index
+        self.assertEqual(backends, [tar_lib.get_decompression_backends('gz')[0], 'zlib'])
+
+    def test_unrecognised_format(self):
+        s3 = FakeS3Client()
+        s3.objects[('in', 'bag.tar')] = b'not a tar' * 100
+        with self.assertRaises(tarfile.ReadError):
+            tar_lib.untar_s3_object_streaming(input_bucket_name='in', object_name='bag.tar', s3_client=s3)
+
+    @unittest.skipUnless(tar_lib.zstandard, 'zstandard not installed')
+    def test_unpack_zstd(self):
+        s3 = FakeS3Client()
+        # Two frames, as written by multi-threaded compressors
+        tar = make_tar(self.members, mode='w')
+        s3.objects[('in', 'bag.tar.zst')] = zstd_compress(tar[:10000]) + zstd_compress(tar[10000:])
+        result = tar_lib.untar_s3_object_streaming(
+            input_bucket_name='in',
+            object_name='bag.tar.zst',
+            output_bucket_name='out',
+            build_index=True,
+            s3_client=s3)
+
+        self.assertEqual(result[tar_lib.KEY_DECOMPRESSION], {'compression': 'zst', 'backend': 'zstandard'})
+        self.assertIsNone(result[tar_lib.KEY_TAR_INDEX])
+        for name, data in self.members.items():
+            self.assertEqual(s3.objects[('out', name[2:])], data)
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import unittest
+import unittest.mock
+import transfer_lib
+from transfer_lib import ByteBudget
+from transfer_lib import OrderedHasher
+
+
+class TestOrderedHasher(unittest.TestCase):
+    def test_out_of_order_chunks(self):
+        chunks = [b'alpha', b'bravo', b'charlie', b'delta']
+        consumed = []
+        hasher = OrderedHasher(hashlib.sha256(), on_consumed=consumed.append)
+        for index in [3, 1, 4, 2]:
+            hasher.submit(index, chunks[index - 1])
+        self.assertEqual(hasher.close(), hashlib.sha256(b''.join(chunks)).hexdigest())
+        self.assertEqual(consumed, [len(c) for c in chunks])
+
+    def test_missing_chunk(self):
+        hasher = OrderedHasher(hashlib.sha256())
+        hasher.submit(2, b'bravo')
+        with self.assertRaises(Exception):
+            hasher.close()
+
+    def test_cancel_releases_pending_chunks(self):
+        consumed = []
+        hasher = OrderedHasher(hashlib.sha256(), on_consumed=consumed.append)
+        hasher.submit(2, b'bravo')
+        hasher.submit(3, b'charlie')
+        hasher.cancel()
+        hasher.submit(4, b'delta')
+        with self.assertRaises(Exception):
+            hasher.close()
+        self.assertEqual(sorted(consumed), [5, 5, 7])
+
+
+class TestByteBudget(unittest.TestCase):
+    def test_oversized_request_allowed_when_idle(self):
+        budget = ByteBudget(10)
+        budget.acquire(25)
+        self.assertEqual(budget.in_flight, 25)
+        budget.release(25)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.high_water_mark, 25)
+
+    def test_cancel_wakes_waiting_acquire(self):
+        budget = ByteBudget(10)
+        budget.acquire(8)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(budget.acquire(8)))
+        thread.start()
+        budget.cancel()
+        thread.join(5)
+        self.assertEqual(results, [False])
+        self.assertEqual(budget.in_flight, 8)
+
+
+class TestRetryWithBackoff(unittest.TestCase):
+    def setUp(self):
+        patch = unittest.mock.patch.object(transfer_lib.time, 'sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def flaky(self, errors):
+        calls = []
+
+        def fn():
+            calls.append(len(calls) + 1)
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+
+        return fn, calls
+
+    def test_retried_until_success(self):
+        fn, calls = self.flaky([IOError('one'), IOError('two')])
+        result = transfer_lib.retry_with_backoff(fn, 'test', max_attempts=3, base_delay=1, max_delay=1.5)
+        self.assertEqual(result, 'done')
+        self.assertEqual(calls, [1, 2, 3])
+        # Full jitter, capped at max_delay
+        delays = [call.args[0] for call in self.sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= 1 and 0 <= delays[1] <= 1.5)
+
+    def test_final_error_raised(self):
+        fn, calls = self.flaky([IOError(str(i)) for i in range(5)])
+        with self.assertRaisesRegex(IOError, '2'):
+            transfer_lib.retry_with_backoff(fn, 'test', max_attempts=3)
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_non_retryable_error_raised_at_once(self):
+        fn, calls = self.flaky([IOError('transient'), ValueError('permanent')])
+        with self.assertRaises(ValueError):
+            transfer_lib.retry_with_backoff(
+                fn, 'test', max_attempts=5, is_retryable=lambda e: isinstance(e, IOError))
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(self.sleep.call_count, 1)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Helpers shared by the concurrent S3 transfer code paths (bounded in-flight
+bytes, in-order hashing on a background thread, read-ahead of streams,
+retries with backoff and throughput reporting).
+"""
+import logging
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STATS_LOG_INTERVAL_SECONDS = 10
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 20
+READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+READ_AHEAD_MAX_CHUNKS = 8
+
+
+class TransferError(Exception):
+    """
+    Used to indicate a transfer helper specific error condition.
+    """
+
+
+class ByteBudget:
+    """
+    Counting semaphore measured in bytes; used to cap the amount of data
+    buffered by concurrent workers. A single request larger than the whole
+    budget is allowed through when nothing else is in flight so that an
+    oversized item can never deadlock the caller. `cancel` wakes any waiting
+    caller, whose `acquire` then returns `False` without taking any bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        if max_bytes <= 0:
+            raise ValueError(f'max_bytes must be positive; got {max_bytes}')
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.high_water_mark = 0
+        self.cancelled = False
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> bool:
+        with self._condition:
+            while not self.cancelled and self.in_flight > 0 and self.in_flight + size > self.max_bytes:
+                self._condition.wait()
+            if self.cancelled:
+                return False
+            self.in_flight += size
+            self.high_water_mark = max(self.high_water_mark, self.in_flight)
+            return True
+
+    def release(self, size: int):
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+    def cancel(self):
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify_all()
+
+
+class OrderedHasher:
+    """
+    Feed numbered chunks (which may arrive out of order from worker threads)
+    into a hashlib object strictly in sequence, on a dedicated thread so that
+    hashing overlaps with network I/O.
+
+    :param hash_object: A hashlib object; e.g. `hashlib.sha256()`
+    :param first_index: Sequence number of the first expected chunk
+    :param on_consumed: Optional callback receiving each chunk's size once it
+    has been hashed (e.g. to release a `ByteBudget`)
+    """
+
+    _STOP = object()
+    _CANCEL = object()
+
+    def __init__(self, hash_object, first_index: int = 1, on_consumed=None):
+        self.hash_object = hash_object
+        self.next_index = first_index
+        self.on_consumed = on_consumed
+        self.error = None
+        self._pending = {}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='ordered-hasher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            if item is self._CANCEL:
+                if self.error is None:
+                    self.error = TransferError('Hashing cancelled')
+                self._release_pending()
+                continue
+            index, data = item
+            if self.error is not None:
+                # Keep draining so that callers waiting on budget never stall
+                if self.on_consumed:
+                    self.on_consumed(len(data))
+                continue
+            self._pending[index] = data
+            try:
+                while self.next_index in self._pending:
+                    chunk = self._pending.pop(self.next_index)
+                    self.hash_object.update(chunk)
+                    self.next_index += 1
+                    if self.on_consumed:
+                        self.on_consumed(len(chunk))
+            except Exception as e:
+                self.error = e
+                self._release_pending()
+
+    def _release_pending(self):
+        # Later chunks parked behind a missing one will never be hashed
+        for chunk in self._pending.values():
+            if self.on_consumed:
+                self.on_consumed(len(chunk))
+        self._pending.clear()
+
+    def submit(self, index: int, data: bytes):
+        self._queue.put((index, data))
+
+    def close(self) -> str:
+        """
+        Wait for all submitted chunks to be hashed and return the hex digest.
+        """
+        self._queue.put(self._STOP)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        if self._pending:
+            raise TransferError(
+                f'Hash incomplete; chunk {self.next_index} never arrived '
+                f'({len(self._pending)} later chunk(s) pending)')
+        return self.hash_object.hexdigest()
+
+    def cancel(self):
+        """
+        Stop hashing (e.g. after a chunk failed and will never arrive);
+        chunks already waiting, and any submitted later, are passed straight
+        to `on_consumed`.
+        """
+        self._queue.put(self._CANCEL)
+
+    def abort(self):
+        self.cancel()
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+
+class TransferStats:
+    """
+    Thread safe throughput counters for a single transfer; logged at most
+    every `log_interval` seconds while the transfer runs.
+    """
+
+    def __init__(self, mode: str, log_interval: float = STATS_LOG_INTERVAL_SECONDS):
+        self.mode = mode
+        self.log_interval = log_interval
+        self.bytes_transferred = 0
+        self.parts_completed = 0
+        self.parts_in_flight = 0
+        self.parts_in_flight_max = 0
+        self.start_time = time.monotonic()
+        self._last_log_time = self.start_time
+        self._lock = threading.Lock()
+
+    def part_started(self):
+        with self._lock:
+            self.parts_in_flight += 1
+            self.parts_in_flight_max = max(self.parts_in_flight_max, self.parts_in_flight)
+
+    def part_finished(self, size: int):
+        with self._lock:
+            self.parts_in_flight -= 1
+            self.parts_completed += 1
+            self.bytes_transferred += size
+        self.log_if_due()
+
+    def part_failed(self):
+        with self._lock:
+            self.parts_in_flight -= 1
+
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def bytes_per_second(self) -> float:
+        elapsed = self.elapsed_seconds()
+        return self.bytes_transferred / elapsed if elapsed > 0 else 0.0
+
+    def log_if_due(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_log_time < self.log_interval:
+                return
+            self._last_log_time = now
+        logger.info(f'transfer progress: {self.as_dict()}')
+
+    def as_dict(self) -> dict:
+        return {
+            'mode': self.mode,
+            'bytes': self.bytes_transferred,
+            'parts': self.parts_completed,
+            'seconds': round(self.elapsed_seconds(), 3),
+            'bytes_per_second': round(self.bytes_per_second()),
+            'parts_in_flight': self.parts_in_flight,
+            'parts_in_flight_max': self.parts_in_flight_max
+        }
+
+
+def retry_with_backoff(
+        fn,
+        description: str,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY_SECONDS,
+        max_delay: float = RETRY_MAX_DELAY_SECONDS,
+        is_retryable=None):
+    """
+    Call `fn` until it succeeds, sleeping with exponential backoff and full
+    jitter between attempts. Errors for which `is_retryable(error)` returns
+    `False`, or the error from the final attempt, are raised to the caller.
+    """
+    attempt = 1
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_attempts or (is_retryable and not is_retryable(e)):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.warning(
+                f'{description}: attempt {attempt} of {max_attempts} failed '
+                f'({type(e).__name__}: {e}); retrying in {delay:.2f}s')
+            time.sleep(delay)
+            attempt += 1
+
+
+class ReadAheadReader:
+    """
+    File-like wrapper that reads `raw` (e.g. an s3 `StreamingBody`) on a
+    background thread, keeping up to `max_chunks` chunks of `chunk_size`
+    bytes queued so that network reads overlap with the consumer's work.
+    """
+
+    _EOF = object()
+
+    def __init__(self, raw, chunk_size: int = READ_AHEAD_CHUNK_SIZE, max_chunks: int = READ_AHEAD_MAX_CHUNKS):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = b''
+        self._position = 0
+        self._closed = threading.Event()
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, name='read-ahead', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._closed.is_set():
+                chunk = self.raw.read(self.chunk_size)
+                if not chunk:
+                    break
+                self._put(chunk)
+            self._put(self._EOF)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size: int = -1) -> bytes:
+        available = len(self._buffer) - self._position
+        if self._eof or (0 <= size <= available):
+            return self._take(size)
+        pieces = [self._buffer[self._position:]]
+        while not self._eof and (size < 0 or available < size):
+            item = self._queue.get()
+            if item is self._EOF:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._eof = True
+                raise item
+            else:
+                pieces.append(item)
+                available += len(item)
+        self._buffer = b''.join(pieces)
+        self._position = 0
+        return self._take(size)
+
+    def _take(self, size: int) -> bytes:
+        end = len(self._buffer) if size < 0 else self._position + size
+        data = self._buffer[self._position:end]
+        self._position += len(data)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self._closed.set()